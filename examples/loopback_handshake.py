@@ -0,0 +1,57 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Runs client and server TLS handshakes in-process over an in-memory transport and reports
+handshake and record throughput. No external server required.
+'''
+
+import os
+import sys
+import threading
+import time
+
+try:
+    # This import works from the project directory
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+    sys.path.append(basedir)
+    from scapy_ssl_tls.ssl_tls import *
+except ImportError:
+    # If you installed this package via pip, you just need to execute this
+    from scapy.layers.ssl_tls import *
+
+tls_version = TLSVersion.TLS_1_2
+cipher_suites = [TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA]
+
+
+def loopback_session(certificates, keyfile):
+    client, server = tls_socketpair()
+    server.tls_ctx.rsa_load_keys_from_file(keyfile)
+    server_thread = threading.Thread(target=tls_do_server_handshake, args=(server, certificates))
+    server_thread.start()
+    tls_do_handshake(client, tls_version, cipher_suites)
+    server_thread.join()
+    return client, server
+
+
+def main(handshakes=20, records=200, record_size=2**14):
+    with open(os.path.join(basedir, "tests/integration/keys/cert.der"), "rb") as f:
+        certificates = [TLSCertificate(data=f.read())]
+    keyfile = os.path.join(basedir, "tests/integration/keys/key.pem")
+
+    t_start = time.time()
+    for _ in range(handshakes):
+        client, server = loopback_session(certificates, keyfile)
+    t_diff = time.time() - t_start
+    print ("handshakes: %d in %.3fs (%.1f/s)" % (handshakes, t_diff, handshakes / t_diff))
+
+    data = "A" * record_size
+    t_start = time.time()
+    for _ in range(records):
+        client.sendall(to_raw(TLSPlaintext(data=data), client.tls_ctx))
+        server.recvall()
+    t_diff = time.time() - t_start
+    print ("records: %d x %d bytes in %.3fs (%.1f KiB/s)" % (records, record_size, t_diff,
+                                                             records * record_size / 1024.0 / t_diff))
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
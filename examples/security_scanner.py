@@ -22,12 +22,16 @@ try:
     basedir = os.path.abspath(os.path.join(os.path.dirname(__file__),"../"))
     sys.path.append(basedir)
     from scapy_ssl_tls.ssl_tls import *
-    from scapy_ssl_tls.ssl_tls_crypto import x509_extract_pubkey_from_der
+    from scapy_ssl_tls.ssl_tls_crypto import TLSCertificateStore, x509_extract_pubkey_from_der
+    from scapy_ssl_tls.ssl_tls_capture import tls_bpf_filter
 except ImportError:
     # If you installed this package via pip, you just need to execute this
     from scapy.layers.ssl_tls import *
     from scapy.layers.ssl_tls import x509_extract_pubkey_from_der
+    from scapy.layers.ssl_tls_crypto import TLSCertificateStore
+    from scapy.layers.ssl_tls_capture import tls_bpf_filter
 
+import binascii
 import socket
 from collections import namedtuple
 import time
@@ -70,6 +74,8 @@ class TCPConnection(object):
         return SSL(''.join(resp))
 
 class TLSInfo(object):
+    # Interning store shared by all TLSInfo. Certificates seen in many sessions are held and evaluated once
+    certificate_store = TLSCertificateStore()
     # https://en.wikipedia.org/wiki/RSA_numbers
     RSA_MODULI_KNOWN_FACTORED = (1522605027922533360535618378132637429718068114961380688657908494580122963258952897654000350692006139, # RSA-100
                                  35794234179725868774991807832568455403003778024228226193532908190484670252364677411513516111204504060317568667, # RSA-110
@@ -110,6 +116,7 @@ class TLSInfo(object):
         self.info.server.sessions_established = 0
         self.info.server.fallback_scsv = None
         self.info.server.heartbeat = None
+        # fingerprints in certificate_store
         self.info.server.certificates = set([])
         self.info.server.extensions = set([])
 
@@ -146,7 +153,7 @@ class TLSInfo(object):
              self.info.server.sessions_established,
              self.info.server.fallback_scsv,
              self.info.server.heartbeat,
-             repr(self.info.server.certificates))
+             repr([binascii.hexlify(fingerprint) for fingerprint in self.info.server.certificates]))
 
     def get_events(self):
         events=[]
@@ -199,16 +206,16 @@ class TLSInfo(object):
                         events.append(("SLOTH - %s announces capability of signature/hash algorithm: RSA/%s"%(tlsinfo.__name__,TLS_HASH_ALGORITHMS.get(alg.hash_algorithm)),alg))
 
             try:
-                for certlist in tlsinfo.certificates:
-                    for cert in certlist.certificates:
-                        pubkey = x509_extract_pubkey_from_der(str(cert.data))
-                        pubkey_size = pubkey.size() + 1
-                        if pubkey_size < 2048:
-                            events.append(("INSUFFICIENT SERVER CERT PUBKEY SIZE - 2048 >= %d bits"%pubkey_size,cert))
-                        if pubkey_size % 2048 != 0:
-                            events.append(("SUSPICIOUS SERVER CERT PUBKEY SIZE - %d not a multiple of 2048 bits"%pubkey_size,cert))
-                        if pubkey.n in self.RSA_MODULI_KNOWN_FACTORED:
-                            events.append(("SERVER CERT PUBKEY FACTORED - trivial private_key recovery possible due to known factors n = p x q. See https://en.wikipedia.org/wiki/RSA_numbers | grep %s"%pubkey.n,cert))
+                for fingerprint in tlsinfo.certificates:
+                    cert = self.certificate_store.get_certificate(fingerprint)
+                    pubkey = x509_extract_pubkey_from_der(self.certificate_store.get_der(fingerprint))
+                    pubkey_size = pubkey.size() + 1
+                    if pubkey_size < 2048:
+                        events.append(("INSUFFICIENT SERVER CERT PUBKEY SIZE - 2048 >= %d bits"%pubkey_size,cert))
+                    if pubkey_size % 2048 != 0:
+                        events.append(("SUSPICIOUS SERVER CERT PUBKEY SIZE - %d not a multiple of 2048 bits"%pubkey_size,cert))
+                    if pubkey.n in self.RSA_MODULI_KNOWN_FACTORED:
+                        events.append(("SERVER CERT PUBKEY FACTORED - trivial private_key recovery possible due to known factors n = p x q. See https://en.wikipedia.org/wiki/RSA_numbers | grep %s"%pubkey.n,cert))
             except AttributeError:
                 pass        # tlsinfo.client has no attribute certificates
 
@@ -271,7 +278,15 @@ class TLSInfo(object):
                 tlsinfo.ciphers.update(record[SSLv2ServerHello].cipher_suites)
 
             if record.haslayer(TLSCertificateList):
-                tlsinfo.certificates.add(record[TLSCertificateList])
+                for certificate in record[TLSCertificateList].certificates:
+                    fingerprint = self.certificate_store.add(certificate)
+                    # One reference per TLSInfo
+                    if fingerprint in tlsinfo.certificates:
+                        self.certificate_store.release(fingerprint)
+                    else:
+                        tlsinfo.certificates.add(fingerprint)
+                # History keeps the shared DER only
+                self.certificate_store.detach(record)
 
             if record.haslayer(TLSFinished):
                 tlsinfo.session.established +=1
@@ -285,6 +300,12 @@ class TLSInfo(object):
             # track packet
             self.history.append(pkt)
 
+    def release_certificates(self):
+        """ Drops the references this TLSInfo holds in certificate_store """
+        for fingerprint in self.info.server.certificates:
+            self.certificate_store.release(fingerprint)
+        self.info.server.certificates = set([])
+
 class TLSScanner(object):
     def __init__(self, workers=10):
         self.workers = workers
@@ -320,12 +341,9 @@ class TLSScanner(object):
             return
         if iface:
             conf.iface=iface
+        # Only handshake and alert records are of interest, leave everything else in the kernel
+        bpf = tls_bpf_filter(target[:1], target[1:2], handshake_only=True)
         while True:
-            bpf = None
-            if len(target):
-                bpf = "host %s"%target[0]
-            if len(target)==2:
-                bpf += " and tcp port %d"%target[1]
             sniff(filter=bpf,
                     prn=_process,
                     store=0,
@@ -29,180 +29,111 @@ except ImportError:
 
 import socket
 
-class L4TcpReassembler(object):
-    ''' WARNING - this is not a valid TCP Stream Reassembler.
-                  It is not L5+ aware and only operates at L4
-                  Only works for the assumption that a consecutive stream will be split in segments of the max segment size (mss). It will concat segments == mss until a segment < mss is found. it will then spit out a reassembled (fake) TCP packet with the full payload.
-    '''
-    class TCPFlags:
-        FIN = 0x01
-        SYN = 0x02
-        RST = 0x04
-        PSH = 0x08
-        ACK = 0x10
-        URG = 0x20
-        ECE = 0x40
-        CWR = 0x80
-
-    class TCPStream(object):
-        def __init__(self, pkt):
-            self.pktlist = []
-            self.stream_id = L4TcpReassembler.TCPStream.stream_id(pkt)
-
-            if not pkt[TCP].flags & L4TcpReassembler.TCPFlags.SYN:
-                #raise Exception("NOT THE BEGINNING OF A STREAM: %s"%repr(self.stream_id))
-                return
-
-            self.syn = pkt[TCP]
-            self.syn.payload=None   # strip payload
-            self.initial_seq = pkt[TCP].seq
-
-            self.last_seq = self.initial_seq
-            self.relative_seq = 0
-
-            self.mss = ( option[1] for option in pkt[TCP].options if option[0]=="MSS").next()
-
-        @staticmethod
-        def stream_id(pkt):
-            return (pkt[IP].src, pkt[TCP].sport, pkt[IP].dst, pkt[TCP].dport)
-
-        def process(self, pkt):
-            self.last_seq = pkt[TCP].seq
-            payload_size = len(pkt[TCP].payload)
-
-            if payload_size < self.mss:
-                # flush pktlist as [pkt stack, current_pkt]
-                if len(self.pktlist)>1:
-                    # create fake packet
-                    p_reassembled = pkt
-                    del(p_reassembled[IP].len)
-                    del(p_reassembled[IP].chksum)
-                    del(p_reassembled[TCP].chksum)
-                    #p_reassembled.name = "TCPReassembled"
-                    p_reassembled[TCP].payload = ''.join(str(p[TCP].payload) for p in self.pktlist) + str(p_reassembled[TCP].payload)
-                    p_reassembled[TCP] = TCP(str(p_reassembled[TCP]))       # force re-dissect
-
-                    self.pktlist=[]
-                    return p_reassembled
-                # otherwise just return current pkt
-                return pkt
-            # segment size > track it
-            self.pktlist.append(pkt)
-            return None
-
-        def __repr__(self, *args, **kwargs):
-            return "<<TCPSTream: %s | mss=%s seq_init=%s seq_last=%s seq_diff=%s pktlist=%s>>"%(repr(self.stream_id),self.mss,self.initial_seq, self.last_seq, self.last_seq-self.initial_seq,self.pktlist )
-
-    def __init__(self):
-        # track streams
-        self.streams = {}
-
-    def get_stream(self, pkt):
-        stream_id = L4TcpReassembler.TCPStream.stream_id(pkt)
-        stream_obj = self.streams.get(stream_id)                # get stream tracker
-        if not stream_obj:
-            stream_obj = L4TcpReassembler.TCPStream(pkt)
-            self.streams[stream_id]=stream_obj
-        return stream_obj
+try:
+    import scapy_ssl_tls.ssl_tls_capture as ssl_tls_capture
+except ImportError:
+    import scapy.layers.ssl_tls_capture as ssl_tls_capture
 
-    def reassemble(self, pktlist):
-        '''Defragment and Reassemble Streams
-        '''
-        # defragment L3
-        for pkt in defragment(pktlist):
-            if not pkt.haslayer(TCP):
-                # Not TCP, return
-                yield pkt
-                continue
-            # get Stream object
-            stream = self.get_stream(pkt)
-            p = stream.process(pkt)
-            if not p:
-                # assume stream not complete
-                continue
-            # assume stream complete
-            yield p
 
 class Sniffer(object):
     ''' Sniffer()
         .rdpcap(pcap)
         or
         .sniff()
+
+        Every TCP connection gets its own TLSSessionCtx, created on ClientHello and released on FIN/RST, after
+        idle_timeout seconds or when more than max_flows connections are tracked.
     '''
-    def __init__(self):
-        self.ssl_session_map = {}
+    def __init__(self, max_flows=65536, idle_timeout=300.0):
+        self.max_flows = max_flows
+        self.idle_timeout = idle_timeout
+        self.key_store = ssl_tls_crypto.TLSRSAKeyStore()
+        self.decryptor = None
 
-    def _create_context(self, target, keyfile=None):
+    def _create_decryptor(self, target, keyfile=None):
         self.target = target
         self.keyfile = keyfile
 
-        session = ssl_tls_crypto.TLSSessionCtx()
         if keyfile:
             print ( "* load servers privatekey for ciphertext decryption (RSA key only): %s"%keyfile)
-            session.rsa_load_keys_from_file(keyfile)
-
-            session.print (ed=False)
-            self.ssl_session_map[target]=session
+            self.key_store.load_file(keyfile)
         else:
             print ( "!! missing private key")
+        reassembler = ssl_tls_capture.TCPReassembler(idle_timeout=self.idle_timeout, max_flows=self.max_flows)
+        self.decryptor = ssl_tls_capture.TLSFlowDecryptor(self._create_context, reassembler)
+
+    def _create_context(self):
+        session = ssl_tls_crypto.TLSSessionCtx()
+        session.rsa_key_store = self.key_store
+        session.printed = False
+        return session
+
+    @staticmethod
+    def endpoint(endpoint):
+        address, port = endpoint
+        return socket.inet_ntop(socket.AF_INET if len(address) == 4 else socket.AF_INET6, address), port
+
+    @staticmethod
+    def segment(pkt):
+        ip = pkt.getlayer(IP) or pkt.getlayer(IPv6)
+        if ip is None:
+            return None
+        return ssl_tls_capture.parse_tcp_frame(ssl_tls_capture.DLT_RAW, str(ip))
 
-    def process_ssl(self, p):
-            if not p.haslayer(SSL):
-                return
-            session = self.ssl_session_map.get((p[IP].dst,p[TCP].dport)) or self.ssl_session_map.get((p[IP].src,p[TCP].sport))
-            if not session:
-                print ( "|   %-16s:%-5d => %-16s:%-5d | %s"%(p[IP].src,p[TCP].sport,p[IP].dst,p[TCP].dport,repr(p[SSL])))
-                return
-            p_ssl = p[SSL]
-            source = (p[IP].src,p[TCP].sport)
-
-            if p_ssl.haslayer(SSLv2Record):
-                print ( "SSLv2 not supported - skipping..",repr(p))
-                return
-
-            if p_ssl.haslayer(TLSServerHello):
-                    session.print (ed=False)
-                    session.crypto.session.master_secret=None
-                    session.match_server = source
-                    #reset the session and print ( it next time)
-            if p_ssl.haslayer(TLSClientHello):
-                session.match_client = source
-
-            session.insert(p_ssl)
-
-            if session.crypto.session.master_secret and session.print (ed==False:)
-                print ( repr(session))
-                session.print (ed = True)
-
-            print ( "|   %-16s:%-5d => %-16s:%-5d | %s"%(p[IP].src,p[TCP].sport,p[IP].dst,p[TCP].dport,repr(p_ssl)))
-            if p.haslayer(TLSCiphertext) or (p.haslayer(TLSAlert) and p.haslayer(Raw)):
-                if source == session.match_client:
-                    session.set_mode(server=True)
-                elif source == session.match_server:
-                    session.set_mode(client=True)
-                else:
-                    Exception("src packet mismatch: %s"%repr(source))
-                try:
-                    p = SSL(str(p_ssl),ctx=session)
-                    print ( "|-> %-48s | %s"%("decrypted record",repr(p)))
-                except ValueError as  ve:
-                    print ( "Exception:", repr(ve))
+    def process_packet(self, pkt):
+        segment = self.segment(pkt)
+        if segment is None:
+            return
+        self.process_segment(segment, getattr(pkt, "time", None))
+
+    def process_segment(self, segment, timestamp):
+        dissected = self.decryptor.dissect(segment, timestamp)
+        if dissected is None:
+            return
+        session, _, p_ssl = dissected
+        source, dest = self.endpoint(segment.src), self.endpoint(segment.dst)
+
+        if session.crypto.session.master_secret and session.printed==False:
+            print ( repr(session))
+            session.printed = True
+
+        print ( "|   %-16s:%-5d => %-16s:%-5d | %s"%(source[0],source[1],dest[0],dest[1],repr(p_ssl)))
 
     def sniff(self, target, keyfile=None, iface=None):
-        self._tcp_reassembler = L4TcpReassembler()
-        def reassemble(p):
-            for rp in (pkt for pkt in self._tcp_reassembler.reassemble([p]) if pkt.haslayer(SSL)):
-                self.process_ssl(p)
         if iface:
             conf.iface=iface
-        self._create_context(target=target,keyfile=keyfile)
+        self._create_decryptor(target=target,keyfile=keyfile)
+        if hasattr(socket, "AF_PACKET"):
+            return self.sniff_ring(target, conf.iface)
         while True:
-            sniff(filter="host %s and tcp port %d"%(target[0],target[1]),prn=reassemble,store=0,timeout=3)
+            for p in defragment(sniff(filter=ssl_tls_capture.tls_bpf_filter([target[0]], [target[1]]),store=1,timeout=3)):
+                self.process_packet(p)
+            print ( "* %s"%repr(self.decryptor))
+
+    def sniff_ring(self, target, iface, processes=0):
+        ''' Linux only: a capture thread reads raw frames from a memory mapped ring and hands them to decrypt
+            worker processes, connections are spread over the workers. Capture never waits on decryption, batches
+            the workers cannot take in time are dropped and counted.
+        '''
+        ring = ssl_tls_capture.PacketRingReader(iface, bpf=ssl_tls_capture.tls_bpf_filter([target[0]], [target[1]]),
+                                                idle=1)
+        with ring, ssl_tls_capture.TLSCapturePipeline(ring, self._create_context, processes=processes) as pipeline:
+            while True:
+                for record in pipeline.records(idle=3):
+                    print ( "|   %-16s:%-5d => %-16s:%-5d | %s%s %s"%(record.src[0],record.src[1],record.dst[0],record.dst[1],
+                                                                  TLS_CONTENT_TYPES.get(record.content_type, record.content_type),
+                                                                  " (encrypted)" if record.encrypted else "", repr(record.data)))
+                print ( "* %s %s"%(repr(ring.stats()), repr(pipeline.stats())))
 
     def rdpcap(self, target, keyfile, pcap):
-        self._create_context(target=target,keyfile=keyfile)
-        for p in (pkt for pkt in L4TcpReassembler().reassemble(rdpcap(pcap)) if pkt.haslayer(SSL)):
-            self.process_ssl(p)
+        self._create_decryptor(target=target,keyfile=keyfile)
+        # Streamed record by record, the capture is never loaded in memory. IP fragments are not reassembled
+        with ssl_tls_capture.PcapFileReader(pcap) as reader:
+            for frame, timestamp, _ in reader:
+                segment = ssl_tls_capture.parse_tcp_frame(reader.linktype, frame)
+                if segment is not None:
+                    self.process_segment(segment, timestamp)
+        print ( "* %s"%repr(self.decryptor))
 
 
 def main(target,pcap=None, iface=None, keyfile=None):
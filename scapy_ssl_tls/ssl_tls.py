@@ -4,6 +4,8 @@
 # http://www.secdev.org/projects/scapy/doc/build_dissect.html
 
 import os
+import socket
+import threading
 import time
 
 from scapy.packet import bind_layers, Packet, Raw
@@ -239,7 +241,10 @@ TLS_CIPHER_SUITES.update({
     0x0063: 'DHE_DSS_EXPORT1024_WITH_DES_CBC_SHA',
     0x0064: 'RSA_EXPORT1024_WITH_RC4_56_SHA',
     0x0065: 'DHE_DSS_EXPORT1024_WITH_RC4_56_SHA',
-    0x0066: 'DHE_DSS_WITH_RC4_128_SHA'})
+    0x0066: 'DHE_DSS_WITH_RC4_128_SHA',
+    0xcca8: 'ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256',
+    0xcca9: 'ECDHE_ECDSA_WITH_CHACHA20_POLY1305_SHA256',
+    0xccaa: 'DHE_RSA_WITH_CHACHA20_POLY1305_SHA256'})
 TLSCipherSuite = EnumStruct(TLS_CIPHER_SUITES)
 
 TLS_COMPRESSION_METHODS = registry.TLS_COMPRESSION_METHOD_IDENTIFIERS
@@ -316,6 +321,11 @@ class TLSRecord(StackedLenPacket):
             if cls == Raw().__class__ or p.length > len(payload) :
                 # length does not fit len raw_bytes, assume its corrupt or encrypted
                 cls = TLSCiphertext
+            elif cls == TLSHandshake and p.type == TLSHandshakeType.HELLO_REQUEST and len(payload) > len(TLSHandshake()) \
+                    and self.tls_ctx is not None and self.tls_ctx.sec_params is not None and self.tls_ctx.sec_params.aead:
+                # AEAD explicit nonces are usually the sequence number. Its leading zero bytes make an encrypted
+                # handshake record look like a hello request followed by garbage
+                cls = TLSCiphertext
         except AttributeError:
             # e.g. TLSChangeCipherSpec might land here
             pass
@@ -654,8 +664,11 @@ class TLSDecryptablePacket(PacketLengthFieldPayload):
         if self.tls_ctx is not None:
             hash_size = self.tls_ctx.sec_params.mac_key_length
             iv_size = self.tls_ctx.sec_params.iv_length
+            # AEAD mode. Explicit nonce and tag were already stripped on decryption
+            if self.tls_ctx.sec_params.aead:
+                data = raw_bytes
             # CBC mode
-            if self.tls_ctx.sec_params.negotiated_crypto_param["cipher"]["mode"] is not None:
+            elif self.tls_ctx.sec_params.negotiated_crypto_param["cipher"]["mode"] is not None:
                 try:
                     self.padding_len = ord(raw_bytes[-1])
                     self.padding = raw_bytes[-self.padding_len - 1:-1]
@@ -927,6 +940,79 @@ class TLSSocket(object):
         return TLSSocket(client_socket, client=False, tls_ctx=copy.deepcopy(self.tls_ctx)), peer
 
 
+class LoopbackSocket(object):
+    """ In-memory, socket like endpoint. Two endpoints connected through tls_socketpair() behave like a
+        connected stream socket pair, without kernel round trips or TCP setup.
+
+        recv() blocks (up to the configured timeout) until the peer sends data. Once data was handed out,
+        a recv() on an empty buffer returns immediately with socket.timeout, so that TLSSocket.recvall()
+        returns as soon as a flight was drained instead of idling for the full timeout.
+    """
+
+    def __init__(self):
+        self.peer = None
+        self.closed = False
+        self._buffer = []
+        self._draining = False
+        self._timeout = None
+        self._cond = threading.Condition()
+
+    def _push(self, data):
+        with self._cond:
+            self._buffer.append(data)
+            self._cond.notify_all()
+
+    def sendall(self, data):
+        if self.closed or self.peer is None:
+            raise socket.error("Loopback socket is not connected")
+        if len(data):
+            self.peer._push(data)
+
+    def send(self, data):
+        self.sendall(data)
+        return len(data)
+
+    def recv(self, size):
+        with self._cond:
+            if not self._buffer and self._draining:
+                self._draining = False
+                raise socket.timeout("timed out")
+            deadline = None if self._timeout is None else time.time() + self._timeout
+            while not self._buffer and not self.closed:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout("timed out")
+                self._cond.wait(remaining)
+            if not self._buffer:
+                # Connection closed, behave like EOF
+                return ""
+            data = "".join(self._buffer)
+            self._buffer = [data[size:]] if len(data) > size else []
+            self._draining = True
+            return data[:size]
+
+    def settimeout(self, timeout):
+        self._timeout = timeout
+
+    def gettimeout(self):
+        return self._timeout
+
+    def close(self):
+        for endpoint in (self, self.peer):
+            if endpoint is not None:
+                with endpoint._cond:
+                    endpoint.closed = True
+                    endpoint._cond.notify_all()
+
+
+def tls_socketpair(client_ctx=None, server_ctx=None):
+    """ Returns a connected (client, server) TLSSocket pair running over an in-memory transport
+    """
+    client_s, server_s = LoopbackSocket(), LoopbackSocket()
+    client_s.peer, server_s.peer = server_s, client_s
+    return TLSSocket(client_s, client=True, tls_ctx=client_ctx), TLSSocket(server_s, client=False, tls_ctx=server_ctx)
+
+
 # entry class
 class SSL(Packet):
     """
@@ -1011,9 +1097,15 @@ class SSL(Packet):
                 if encrypted_payload is not None:
                     try:
                         if self.tls_ctx.client:
-                            cleartext = self.tls_ctx.crypto.server.dec.decrypt(encrypted_payload)
+                            dec_cipher = self.tls_ctx.crypto.server.dec
                         else:
-                            cleartext = self.tls_ctx.crypto.client.dec.decrypt(encrypted_payload)
+                            dec_cipher = self.tls_ctx.crypto.client.dec
+                        # AEAD ciphers authenticate the record header
+                        if self.tls_ctx.sec_params.aead:
+                            cleartext = dec_cipher.decrypt(encrypted_payload, record[TLSRecord].content_type,
+                                                           record[TLSRecord].version)
+                        else:
+                            cleartext = dec_cipher.decrypt(encrypted_payload)
                         pkt = layer(cleartext, ctx=self.tls_ctx)
                         original_record = record
                         record[self.guessed_next_layer].payload = pkt
@@ -1081,18 +1173,102 @@ class TLSProtocolError(Exception):
             self.pkt = None
         Exception.__init__(self, *args, **kwargs)
 
-def tls_do_handshake(tls_socket, version, ciphers):
+def tls_do_handshake(tls_socket, version, ciphers, session_id="", ticket=None):
+    """ Runs a client handshake. To resume a session, pass the session ID or ticket of a session recorded in the
+        session cache of the socket context. ticket="" requests a session ticket from the server.
+        Falls back to a full handshake if the server does not resume.
+    """
     client_hello = TLSRecord(version=version)/TLSHandshake()/TLSClientHello(version=version, compression_methods=(TLSCompressionMethod.NULL),
                                                                             cipher_suites=ciphers)
+    if ticket is not None:
+        client_hello[TLSClientHello].extensions = [TLSExtension()/TLSExtSessionTicketTLS(data=ticket)]
+        # The server signals ticket acceptance by echoing the session ID (RFC 5077 section 3.4)
+        if ticket and not session_id:
+            session_id = os.urandom(32)
+    client_hello[TLSClientHello].session_id = session_id
     tls_socket.sendall(client_hello)
     r = tls_socket.recvall()
     if r.haslayer(TLSAlert):
         raise TLSProtocolError("Alert returned by server", r)
+    if tls_socket.tls_ctx.params.negotiated.resumed:
+        # Abbreviated handshake. The server sends its Finished first
+        if not r.haslayer(TLSFinished):
+            _tls_recv_finished(tls_socket, 0.5)
+        client_ccs = TLSRecord(version=version)/TLSChangeCipherSpec()
+        tls_socket.sendall(TLS.from_records([client_ccs, to_raw(TLSFinished(), tls_socket.tls_ctx)]))
+        return
     client_key_exchange = TLSRecord(version=version)/TLSHandshake()/tls_socket.tls_ctx.get_client_kex_data()
     client_ccs = TLSRecord(version=version)/TLSChangeCipherSpec()
     tls_socket.sendall(TLS.from_records([client_key_exchange, client_ccs]))
     tls_socket.sendall(to_raw(TLSFinished(), tls_socket.tls_ctx))
-    tls_socket.recvall()
+    r = tls_socket.recvall()
+    # NewSessionTicket may be sent ahead of the server ChangeCipherSpec and Finished
+    while r.records and not r.haslayer(TLSFinished) and not r.haslayer(TLSAlert):
+        r = tls_socket.recvall()
+
+def tls_do_server_handshake(tls_socket, certificates, ciphers=None, timeout=2, issue_ticket=False):
+    """ Server counterpart of tls_do_handshake(). Requires the server RSA keys to be loaded in the socket context.
+        The first cipher suite offered by the client and accepted in ciphers (any RSA kex cipher if None) is picked.
+        Sessions found in the session cache of the socket context are resumed with an abbreviated handshake.
+        With issue_ticket, clients sending the SessionTicket extension get a ticket. Tickets are opaque handles
+        to the server session cache.
+    """
+    import ssl_tls_crypto as tlsc
+
+    r = tls_socket.recvall(timeout=timeout)
+    if not r.haslayer(TLSClientHello):
+        raise TLSProtocolError("Expected a client hello", r)
+    client_hello = r[TLSClientHello]
+    version = client_hello.version
+    if ciphers is None:
+        ciphers = [cipher for cipher, params in tlsc.TLSSecurityParameters.crypto_params.items()
+                   if params["key_exchange"]["name"] == TLSKexNames.RSA]
+    session = tls_socket.tls_ctx.crypto.session.resumption
+    if session is not None and session.version == version and session.cipher_suite in client_hello.cipher_suites:
+        # Abbreviated handshake: no certificate and no key exchange (RFC 5246 section 7.3)
+        server_hello = TLSRecord(version=version)/TLSHandshake()/TLSServerHello(version=version,
+                                                                                cipher_suite=session.cipher_suite,
+                                                                                compression_method=session.compression,
+                                                                                session_id=client_hello.session_id,
+                                                                                random_bytes=os.urandom(28))
+        tls_socket.sendall(server_hello)
+        server_ccs = TLSRecord(version=version)/TLSChangeCipherSpec()
+        tls_socket.sendall(TLS.from_records([server_ccs, to_raw(TLSFinished(), tls_socket.tls_ctx)]))
+        _tls_recv_finished(tls_socket, timeout)
+        return
+    try:
+        cipher = next(cipher for cipher in client_hello.cipher_suites if cipher in ciphers)
+    except StopIteration:
+        raise TLSProtocolError("No shared cipher suite", r)
+    if not isinstance(certificates, TLSCertificateList):
+        certificates = TLSCertificateList(certificates=certificates)
+    issue_ticket = issue_ticket and tls_socket.tls_ctx.get_offered_session_ticket() is not None
+    server_hello = TLSRecord(version=version)/TLSHandshake()/TLSServerHello(version=version, cipher_suite=cipher,
+                                                                            session_id=os.urandom(32),
+                                                                            random_bytes=os.urandom(28))
+    if issue_ticket:
+        server_hello[TLSServerHello].extensions = [TLSExtension()/TLSExtSessionTicketTLS()]
+    server_certs = TLSRecord(version=version)/TLSHandshake()/certificates
+    server_done = TLSRecord(version=version)/TLSHandshake(type=TLSHandshakeType.SERVER_HELLO_DONE)
+    tls_socket.sendall(TLS.from_records([server_hello, server_certs, server_done]))
+    _tls_recv_finished(tls_socket, timeout)
+    if issue_ticket:
+        new_ticket = TLSRecord(version=version)/TLSHandshake(type=TLSHandshakeType.NEWSESSIONTICKET)/TLSSessionTicket(
+            ticket=os.urandom(32))
+        tls_socket.sendall(new_ticket)
+    server_ccs = TLSRecord(version=version)/TLSChangeCipherSpec()
+    server_finished = to_raw(TLSFinished(), tls_socket.tls_ctx)
+    tls_socket.sendall(TLS.from_records([server_ccs, server_finished]))
+
+def _tls_recv_finished(tls_socket, timeout):
+    # Peer flight is sent in multiple writes. Read until the peer Finished is seen
+    r = tls_socket.recvall(timeout=timeout)
+    while not r.haslayer(TLSFinished):
+        if r.haslayer(TLSAlert):
+            raise TLSProtocolError("Alert returned by peer", r)
+        if not r.records:
+            raise TLSProtocolError("Peer did not complete the handshake", r)
+        r = tls_socket.recvall(timeout=timeout)
 
 def tls_fragment_payload(pkt, record=None, size=2**14):
     if size <= 0:
@@ -0,0 +1,1187 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Decryption of the TLS sessions found in packet captures, offline or live
+
+    for record in decrypt_pcap("capture.pcap", processes=0):
+        print(record.src, record.dst, record.content_type, repr(record.data))
+
+    with TLSCapturePipeline(PacketRingReader("eth0", idle=1)) as pipeline:
+        for record in pipeline.records():
+            print(record.src, record.dst, record.content_type, repr(record.data))
+
+Contexts are created by ctx_factory, TLSSessionCtx by default. Keys are provided through the shared context
+helpers, for instance TLSSessionCtx.rsa_key_store or TLSSessionCtx.keylog.
+'''
+import ctypes
+import functools
+import mmap
+import multiprocessing
+import os
+import Queue
+import select
+import socket
+import struct
+import subprocess
+import threading
+import warnings
+
+from collections import deque, namedtuple, OrderedDict
+from Crypto import Random
+from scapy.layers import ssl_tls as tls
+from scapy.layers import ssl_tls_crypto as tlsc
+
+DLT_EN10MB = 1
+DLT_RAW = 101
+DLT_LINUX_SLL = 113
+ETHERTYPE_IPV4 = 0x0800
+ETHERTYPE_IPV6 = 0x86dd
+ETHERTYPE_VLAN = (0x8100, 0x88a8)
+IPPROTO_TCP = 6
+TCP_FIN = 0x01
+TCP_SYN = 0x02
+TCP_RST = 0x04
+TCP_ACK = 0x10
+TCP_SEQ_MASK = 0xffffffff
+# Linux AF_PACKET, see linux/if_packet.h
+ETH_P_ALL = 0x0003
+SOL_PACKET = 263
+PACKET_RX_RING = 5
+PACKET_STATISTICS = 6
+PACKET_VERSION = 10
+TPACKET_V3 = 2
+TP_STATUS_KERNEL = 0
+TP_STATUS_USER = 1
+SO_ATTACH_FILTER = 26
+# Link type of the frames read off a SOCK_RAW packet socket by ARPHRD device type, see linux/if_arp.h. Ethernet and
+# loopback devices carry an Ethernet header. PPP, raw IP, IPIP, IP6IP6, SIT and tun devices have no link header
+ARPHRD_LINKTYPES = {1: DLT_EN10MB, 772: DLT_EN10MB,
+                    512: DLT_RAW, 519: DLT_RAW, 768: DLT_RAW, 769: DLT_RAW, 776: DLT_RAW, 0xfffe: DLT_RAW}
+# Magic: (byte order, timestamp fraction resolution). pcapng is not supported
+PCAP_MAGICS = {"\xd4\xc3\xb2\xa1": ("<", 1e-6), "\xa1\xb2\xc3\xd4": (">", 1e-6),
+               "\x4d\x3c\xb2\xa1": ("<", 1e-9), "\xa1\xb2\x3c\x4d": (">", 1e-9)}
+
+TCPSegment = namedtuple("TCPSegment", ["src", "dst", "seq", "flags", "payload"])
+PacketRingStats = namedtuple("PacketRingStats", ["packets", "drops", "freezes"])
+TLSPipelineStats = namedtuple("TLSPipelineStats", ["frames", "segments", "batches", "dropped_batches",
+                                                   "dropped_segments", "dropped_flows", "backlog"])
+TLSCaptureRecord = namedtuple("TLSCaptureRecord", ["index", "timestamp", "src", "dst", "from_client", "content_type",
+                                                   "version", "encrypted", "data"])
+# certificate is the DER of the server certificate
+RSAKeyExchange = namedtuple("RSAKeyExchange", ["certificate", "encrypted_premaster_secret"])
+
+
+def parse_tcp_frame(linktype, frame):
+    """ Returns the TCPSegment carried by a link layer frame, or None for anything else than an unfragmented TCP
+        segment. Only headers are parsed, src and dst are (packed address, port) tuples
+    """
+    try:
+        if linktype == DLT_EN10MB:
+            ethertype, offset = struct.unpack_from("!H", frame, 12)[0], 14
+            while ethertype in ETHERTYPE_VLAN:
+                ethertype, offset = struct.unpack_from("!H", frame, offset + 2)[0], offset + 4
+        elif linktype == DLT_LINUX_SLL:
+            ethertype, offset = struct.unpack_from("!H", frame, 14)[0], 16
+        elif linktype == DLT_RAW:
+            ethertype, offset = ETHERTYPE_IPV6 if ord(frame[0]) >> 4 == 6 else ETHERTYPE_IPV4, 0
+        else:
+            return None
+        if ethertype == ETHERTYPE_IPV4:
+            total_length, fragment, protocol = struct.unpack_from("!H2xHxB", frame, offset + 2)
+            # Fragments are not reassembled
+            if protocol != IPPROTO_TCP or fragment & 0x3fff:
+                return None
+            src, dst = frame[offset + 12:offset + 16], frame[offset + 16:offset + 20]
+            end = offset + total_length
+            offset += (ord(frame[offset]) & 0x0f) * 4
+        elif ethertype == ETHERTYPE_IPV6:
+            payload_length, next_header = struct.unpack_from("!HB", frame, offset + 4)
+            # Extension headers are not walked
+            if next_header != IPPROTO_TCP:
+                return None
+            src, dst = frame[offset + 8:offset + 24], frame[offset + 24:offset + 40]
+            offset += 40
+            end = offset + payload_length
+        else:
+            return None
+        sport, dport, seq, data_offset, flags = struct.unpack_from("!HHI4xBB", frame, offset)
+        # Link layer padding is stripped by honoring the IP length
+        return TCPSegment((src, sport), (dst, dport), seq, flags, frame[offset + (data_offset >> 4) * 4:end])
+    except (IndexError, struct.error):
+        return None
+
+
+class PcapFileReader(object):
+    """ Streams the records of a pcap file by walking record headers over a read only mmap
+
+        Only the frame being yielded is copied out of the map, so memory use does not grow with the capture size.
+
+        with PcapFileReader("capture.pcap") as reader:
+            for frame, timestamp, wire_length in reader:
+                segment = parse_tcp_frame(reader.linktype, frame)
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._file = open(filename, "rb")
+        try:
+            if os.fstat(self._file.fileno()).st_size < 24:
+                raise ValueError("Not a pcap file: %s" % filename)
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                byte_order, self.resolution = PCAP_MAGICS[self._map[:4]]
+            except KeyError:
+                self._map.close()
+                raise ValueError("Not a pcap file: %s" % filename)
+        except Exception:
+            self._file.close()
+            raise
+        self.version_major, self.version_minor, _, _, self.snaplen, self.linktype = \
+            struct.unpack_from(byte_order + "HHiIII", self._map, 4)
+        self._record_header = struct.Struct(byte_order + "IIII")
+        # Offset of the next record
+        self.offset = 24
+
+    def __repr__(self):
+        return "<PcapFileReader: %s linktype=%d offset=%d>" % (self.filename, self.linktype, self.offset)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __iter__(self):
+        """ Yields (frame, timestamp, wire length) tuples """
+        map_, record_header, resolution = self._map, self._record_header, self.resolution
+        size = len(map_)
+        while self.offset + record_header.size <= size:
+            sec, fraction, captured_length, wire_length = record_header.unpack_from(map_, self.offset)
+            start = self.offset + record_header.size
+            if start + captured_length > size:
+                warnings.warn("Truncated pcap record at offset %d in %s" % (self.offset, self.filename))
+                break
+            self.offset = start + captured_length
+            yield map_[start:self.offset], sec + fraction * resolution, wire_length
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+class PacketRingReader(object):
+    """ Captures the frames of a Linux interface through an AF_PACKET socket with a TPACKET_V3 receive ring
+
+        The kernel writes frames into blocks of block_size bytes and hands a block over once it is full or after
+        timeout_ms. Frames are sliced out of the mapped ring a whole block at a time, then the block is handed back.
+        linktype follows the device type of iface. Interfaces whose frames parse_tcp_frame() cannot read are
+        rejected with ValueError. bpf is a filter expression, compiled by tcpdump for iface, or a list of compiled
+        (code, jt, jf, k) instructions. It is attached to the socket. Iteration stops after idle seconds without
+        frames, never when idle is None, and once the reader is closed.
+
+        with PacketRingReader("eth0", bpf=tls_bpf_filter(handshake_only=True)) as ring:
+            for frame, timestamp, wire_length in ring:
+                segment = parse_tcp_frame(ring.linktype, frame)
+            print(ring.stats())
+    """
+    _block_header = struct.Struct("=IIIIIIQ")
+    _packet_header = struct.Struct("=IIIIIIHH")
+
+    def __init__(self, iface, bpf=None, block_size=1 << 22, block_count=64, frame_size=1 << 11, timeout_ms=100,
+                 idle=None):
+        from scapy.arch.linux import get_if_raw_hwaddr
+        device_type = get_if_raw_hwaddr(iface)[0]
+        if device_type not in ARPHRD_LINKTYPES:
+            raise ValueError("Unsupported device type %d of interface %s" % (device_type, iface))
+        self.iface = iface
+        self.linktype = ARPHRD_LINKTYPES[device_type]
+        self.block_size = block_size
+        self.block_count = block_count
+        self.timeout_ms = timeout_ms
+        self.idle = idle
+        # Index of the next block handed over by the kernel
+        self.block = 0
+        self.packets = 0
+        self.drops = 0
+        self.freezes = 0
+        self._socket = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(ETH_P_ALL))
+        try:
+            if bpf is not None:
+                self._attach_filter(compile_bpf(iface, bpf) if isinstance(bpf, basestring) else bpf)
+            self._socket.setsockopt(SOL_PACKET, PACKET_VERSION, TPACKET_V3)
+            # struct tpacket_req3
+            self._socket.setsockopt(SOL_PACKET, PACKET_RX_RING,
+                                    struct.pack("=IIIIIII", block_size, block_count, frame_size,
+                                                block_size // frame_size * block_count, timeout_ms, 0, 0))
+            self._map = mmap.mmap(self._socket.fileno(), block_size * block_count, mmap.MAP_SHARED,
+                                  mmap.PROT_READ | mmap.PROT_WRITE)
+            self._socket.bind((iface, ETH_P_ALL))
+        except Exception:
+            self._socket.close()
+            raise
+        self._poll = select.poll()
+        self._poll.register(self._socket.fileno(), select.POLLIN | select.POLLERR)
+
+    def __repr__(self):
+        return "<PacketRingReader: %s block=%d packets=%d drops=%d>" % (self.iface, self.block, self.packets,
+                                                                       self.drops)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _attach_filter(self, instructions):
+        # struct sock_filter array, pointed to by a struct sock_fprog. The kernel copies both
+        program = ctypes.create_string_buffer("".join(struct.pack("=HBBI", *instruction)
+                                                      for instruction in instructions))
+        self._socket.setsockopt(socket.SOL_SOCKET, SO_ATTACH_FILTER,
+                                struct.pack("HP", len(instructions), ctypes.addressof(program)))
+
+    def __iter__(self):
+        """ Yields (frame, timestamp, wire length) tuples """
+        map_, block_header, packet_header = self._map, self._block_header, self._packet_header
+        idle = 0.0
+        while (self.idle is None or idle < self.idle) and self._map is not None:
+            offset = self.block * self.block_size
+            _, _, status, packets, pos, _, _ = block_header.unpack_from(map_, offset)
+            if not status & TP_STATUS_USER:
+                if not self._poll.poll(self.timeout_ms):
+                    idle += self.timeout_ms / 1000.0
+                continue
+            idle = 0.0
+            pos += offset
+            try:
+                for _ in range(packets):
+                    next_offset, sec, nsec, captured_length, wire_length, _, mac, _ = \
+                        packet_header.unpack_from(map_, pos)
+                    yield map_[pos + mac:pos + mac + captured_length], sec + nsec * 1e-9, wire_length
+                    pos += next_offset
+            finally:
+                # Hand the block back to the kernel, also when iteration is abandoned, so that no frame is yielded
+                # twice. Not possible once closed
+                if self._map is not None:
+                    map_[offset + 8:offset + 12] = struct.pack("=I", TP_STATUS_KERNEL)
+                    self.block = (self.block + 1) % self.block_count
+
+    def stats(self):
+        """ Returns the PacketRingStats of the socket since it was opened. drops counts the frames the kernel could
+            not queue because the ring was full
+        """
+        packets, drops, freezes = struct.unpack("=III", self._socket.getsockopt(SOL_PACKET, PACKET_STATISTICS, 12))
+        # The kernel resets its counters on each read
+        self.packets += packets
+        self.drops += drops
+        self.freezes += freezes
+        return PacketRingStats(self.packets, self.drops, self.freezes)
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._socket.close()
+
+
+def compile_bpf(iface, expression):
+    """ Returns the (code, jt, jf, k) instructions of a BPF filter expression, compiled by tcpdump for the link type
+        of iface. Raises ValueError when tcpdump is missing or rejects the expression
+    """
+    from scapy.config import conf
+    try:
+        process = subprocess.Popen([conf.prog.tcpdump, "-i", iface, "-ddd", "-s", "65535", expression],
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    except OSError as oe:
+        raise ValueError("Unable to run tcpdump: %s" % oe)
+    output, error = process.communicate()
+    if process.returncode:
+        raise ValueError("Invalid filter %r: %s" % (expression, error.strip()))
+    lines = output.splitlines()
+    return [tuple(int(value) for value in line.split()) for line in lines[1:int(lines[0]) + 1]]
+
+
+def tls_bpf_filter(hosts=(), ports=(443,), handshake_only=False,
+                   content_types=(tls.TLSContentType.HANDSHAKE, tls.TLSContentType.ALERT)):
+    """ Returns a BPF expression for the TCP traffic of hosts and ports, any host or port when empty
+
+        With handshake_only set, the kernel only passes segments whose payload starts with a record of one of
+        content_types or with a SSLv2 ClientHello, along with SYN, FIN and RST segments for connection tracking.
+        Only the first segment of a record spanning several segments passes, so large Certificate messages are cut.
+        libpcap cannot index TCP payload over IPv6, IPv6 segments are not filtered on payload.
+    """
+    clauses = ["tcp"]
+    if hosts:
+        clauses.append("(%s)" % " or ".join("host %s" % host for host in hosts))
+    if ports:
+        clauses.append("(%s)" % " or ".join("port %d" % port for port in ports))
+    if handshake_only:
+        payload = "tcp[((tcp[12:1] & 0xf0) >> 2)%s]"
+        records = "(%s) and %s = 0x03" % (" or ".join("%s = 0x%02x" % (payload % "", content_type)
+                                                       for content_type in content_types), payload % " + 1")
+        sslv2 = "%s & 0x80 != 0 and %s = 0x%02x" % (payload % "", payload % " + 2",
+                                                   tls.SSLv2MessageType.CLIENT_HELLO)
+        clauses.append("(tcp[tcpflags] & (tcp-syn|tcp-fin|tcp-rst) != 0 or (%s) or (%s) or ip6)" % (records, sslv2))
+    return " and ".join(clauses)
+
+
+def flow_key(segment):
+    """ Returns a direction independent key for the flow of a TCPSegment """
+    return (segment.src, segment.dst) if segment.src <= segment.dst else (segment.dst, segment.src)
+
+
+def _endpoint_to_str(endpoint):
+    address, port = endpoint
+    return socket.inet_ntop(socket.AF_INET if len(address) == 4 else socket.AF_INET6, address), port
+
+
+class TCPStream(object):
+    """ One direction of a TCP connection. Payload is released in sequence number order
+
+        Retransmitted and overlapping bytes are delivered once. Segments received ahead of a gap are held until the
+        gap is filled. Once more than max_buffer bytes are held, the gap is skipped and counted in gaps.
+    """
+
+    def __init__(self, max_buffer=1 << 20):
+        self.max_buffer = max_buffer
+        # Sequence number of the next byte to deliver. Unknown until the first segment
+        self.next_seq = None
+        # seq: payload of segments received ahead of next_seq
+        self.pending = {}
+        self.buffered = 0
+        self.gaps = 0
+        self.fin = False
+
+    def __repr__(self):
+        return "<TCPStream: next_seq=%s pending=%d buffered=%d gaps=%d fin=%s>" % (
+            self.next_seq, len(self.pending), self.buffered, self.gaps, self.fin)
+
+    def _distance(self, seq):
+        # Signed distance to next_seq, modulo 2**32
+        distance = (seq - self.next_seq) & TCP_SEQ_MASK
+        return distance - (TCP_SEQ_MASK + 1) if distance & 0x80000000 else distance
+
+    def feed(self, seq, payload, syn=False, fin=False):
+        """ Returns the contiguous bytes made available by a segment, "" if none """
+        if syn:
+            # SYN consumes one sequence number
+            seq = (seq + 1) & TCP_SEQ_MASK
+            self.next_seq = seq
+        elif self.next_seq is None:
+            # Picked up mid stream
+            self.next_seq = seq
+        self.fin = self.fin or fin
+        if not payload:
+            return ""
+        chunks = []
+        if self._distance(seq) > 0:
+            held = self.pending.get(seq, "")
+            if len(payload) <= len(held):
+                return ""
+            self.pending[seq] = payload
+            self.buffered += len(payload) - len(held)
+            if self.buffered <= self.max_buffer:
+                return ""
+            # The gap will not be filled in time
+            self.gaps += 1
+            self.next_seq = min(self.pending, key=self._distance)
+        else:
+            self._append(chunks, seq, payload)
+        while self.pending:
+            seq = min(self.pending, key=self._distance)
+            if self._distance(seq) > 0:
+                break
+            payload = self.pending.pop(seq)
+            self.buffered -= len(payload)
+            self._append(chunks, seq, payload)
+        return "".join(chunks)
+
+    def _append(self, chunks, seq, payload):
+        # Drop bytes that were already delivered
+        payload = payload[-self._distance(seq):]
+        if payload:
+            chunks.append(payload)
+            self.next_seq = (self.next_seq + len(payload)) & TCP_SEQ_MASK
+
+
+class TCPFlow(object):
+    """ Both directions of a TCP connection. state is free for use by the consumer of the reassembled streams """
+
+    def __init__(self, key, max_buffer=1 << 20):
+        self.key = key
+        self.streams = dict((endpoint, TCPStream(max_buffer)) for endpoint in key)
+        self.last_seen = None
+        self.closed = False
+        self.state = None
+
+    def __repr__(self):
+        return "<TCPFlow: %r closed=%s streams=%r>" % (self.key, self.closed, self.streams.values())
+
+
+class TCPReassembler(object):
+    """ Table of the TCP connections of a capture, reassembled from segments in capture order
+
+        Connections are keyed by both endpoints, which with TCP makes up the 5-tuple. They are torn down on RST and
+        once both sides sent FIN. A SYN on a known connection starts a new one. Connections without segments for
+        idle_timeout seconds, measured on segment timestamps, are evicted. With max_flows set, the least recently
+        active connection is evicted to make room for a new one. on_evict is called with each TCPFlow dropped
+        without being returned by feed.
+    """
+
+    def __init__(self, max_buffer=1 << 20, idle_timeout=300.0, max_flows=None, on_evict=None):
+        if max_flows is not None and max_flows < 1:
+            raise ValueError("Flow table size must be positive: %d" % max_flows)
+        self.max_buffer = max_buffer
+        self.idle_timeout = idle_timeout
+        self.max_flows = max_flows
+        self.on_evict = on_evict
+        # flow key: TCPFlow, least recently active first
+        self.flows = OrderedDict()
+        self.opened = 0
+        self.closed = 0
+        self.idle_evicted = 0
+        self.lru_evicted = 0
+
+    def __len__(self):
+        return len(self.flows)
+
+    def __contains__(self, key):
+        return key in self.flows
+
+    def __repr__(self):
+        return "<%s active=%d opened=%d closed=%d idle_evicted=%d lru_evicted=%d>" % (
+            self.__class__.__name__, len(self), self.opened, self.closed, self.idle_evicted, self.lru_evicted)
+
+    @property
+    def evicted(self):
+        return self.idle_evicted + self.lru_evicted
+
+    def _evict(self, flow):
+        flow.closed = True
+        if self.on_evict is not None:
+            self.on_evict(flow)
+
+    def feed(self, segment, timestamp=None):
+        """ Returns the TCPFlow of a TCPSegment and the contiguous bytes it made available in its direction.
+            The flow is None for a RST on an unknown connection
+        """
+        key = flow_key(segment)
+        flow = self.flows.pop(key, None)
+        syn = bool(segment.flags & TCP_SYN)
+        if flow is not None and syn and not segment.flags & TCP_ACK and \
+                flow.streams[segment.src].next_seq != (segment.seq + 1) & TCP_SEQ_MASK:
+            # Port reuse
+            self.closed += 1
+            self._evict(flow)
+            flow = None
+        if flow is None:
+            if segment.flags & TCP_RST:
+                return None, ""
+            flow = TCPFlow(key, self.max_buffer)
+            self.opened += 1
+            while self.max_flows is not None and len(self.flows) >= self.max_flows:
+                self.lru_evicted += 1
+                self._evict(self.flows.popitem(last=False)[1])
+        flow.last_seen = timestamp
+        if segment.flags & TCP_RST:
+            flow.closed = True
+            data = ""
+        else:
+            data = flow.streams[segment.src].feed(segment.seq, segment.payload, syn, bool(segment.flags & TCP_FIN))
+            flow.closed = all(stream.fin for stream in flow.streams.values())
+        if flow.closed:
+            self.closed += 1
+        else:
+            self.flows[key] = flow
+        if timestamp is not None:
+            self.evict_idle(timestamp)
+        return flow, data
+
+    def evict_idle(self, now):
+        """ Drops the connections without segments for idle_timeout seconds. Returns the number dropped """
+        evicted = 0
+        while self.flows:
+            key, flow = next(iter(self.flows.items()))
+            if flow.last_seen is None or flow.last_seen + self.idle_timeout >= now:
+                break
+            del self.flows[key]
+            evicted += 1
+            self._evict(flow)
+        self.idle_evicted += evicted
+        return evicted
+
+
+class TLSPrefilter(object):
+    """ Byte level check that a payload starts with a TLS record, run before any dissection
+
+        A TLS record header must carry a known content type, a SSL 3.0 to TLS 1.3 record version and a length of at
+        most TLSRecordStream.MAX_LENGTH. A SSLv2 header has the high bit set and a non zero length. Headers cut
+        short are checked as far as they go. Rejected payloads are counted per reason in rejected.
+    """
+    REASONS = ("empty", "content_type", "version", "length")
+
+    def __init__(self):
+        self.accepted = 0
+        self.rejected = dict.fromkeys(self.REASONS, 0)
+
+    def __repr__(self):
+        return "<%s accepted=%d rejected=%r>" % (self.__class__.__name__, self.accepted, self.rejected)
+
+    def __call__(self, payload):
+        """ Returns whether payload may start with a TLS record, and counts it """
+        reason = self.classify(payload)
+        if reason is None:
+            self.accepted += 1
+            return True
+        self.rejected[reason] += 1
+        return False
+
+    @staticmethod
+    def classify(payload):
+        """ Returns None when payload may start with a TLS record, the reason for rejecting it otherwise """
+        if not payload:
+            return "empty"
+        first = ord(payload[0])
+        if first & 0x80:
+            if len(payload) > 1 and not (first & 0x7f or ord(payload[1])):
+                return "length"
+            return None
+        if first not in tls.TLS_CONTENT_TYPES:
+            return "content_type"
+        if len(payload) > 1 and payload[1] != "\x03" or len(payload) > 2 and ord(payload[2]) > 4:
+            return "version"
+        if len(payload) > 4 and struct.unpack_from("!H", payload, 3)[0] > TLSRecordStream.MAX_LENGTH:
+            return "length"
+        return None
+
+
+class TLSRecordStream(object):
+    """ Splits one direction of a reassembled TCP stream into whole TLS or SSLv2 records """
+    # Largest ciphertext allowed by RFC 5246 section 6.2.3
+    MAX_LENGTH = 2 ** 14 + 2048
+
+    def __init__(self):
+        self.buffer = ""
+        self.records = 0
+        self.bytes = 0
+
+    def feed(self, data):
+        """ Returns the whole records made available by data, concatenated, and counts them. Raises ValueError when
+            the stream does not carry TLS records
+        """
+        buffer = self.buffer + data
+        pos = 0
+        while pos < len(buffer):
+            reason = TLSPrefilter.classify(buffer[pos:pos + 5])
+            if reason is not None:
+                raise ValueError("Invalid TLS record header %s: %s" % (reason, repr(buffer[pos:pos + 5])))
+            if ord(buffer[pos]) & 0x80:
+                # SSLv2 two byte header
+                if len(buffer) - pos < 2:
+                    break
+                end = pos + 2 + ((ord(buffer[pos]) & 0x7f) << 8 | ord(buffer[pos + 1]))
+            else:
+                if len(buffer) - pos < 5:
+                    break
+                end = pos + 5 + struct.unpack_from("!H", buffer, pos + 3)[0]
+            if end > len(buffer):
+                break
+            pos = end
+            self.records += 1
+        self.bytes += pos
+        self.buffer = buffer[pos:]
+        return buffer[:pos]
+
+
+def _record_content_types(records):
+    """ Yields the content type of each whole record of a TLSRecordStream chunk, None for SSLv2 records """
+    pos = 0
+    while pos < len(records):
+        if ord(records[pos]) & 0x80:
+            yield None
+            pos += 2 + ((ord(records[pos]) & 0x7f) << 8 | ord(records[pos + 1]))
+        else:
+            yield ord(records[pos])
+            pos += 5 + struct.unpack_from("!H", records, pos + 3)[0]
+
+
+def _record_fragments(records):
+    """ Yields (content type, fragment) for each whole TLS record of a TLSRecordStream chunk. SSLv2 records are
+        skipped
+    """
+    pos = 0
+    while pos < len(records):
+        if ord(records[pos]) & 0x80:
+            pos += 2 + ((ord(records[pos]) & 0x7f) << 8 | ord(records[pos + 1]))
+        else:
+            end = pos + 5 + struct.unpack_from("!H", records, pos + 3)[0]
+            yield ord(records[pos]), records[pos + 5:end]
+            pos = end
+
+
+# State of a TLS session carried by a TCPFlow. record_streams and finished are keyed by endpoint. finished is False
+# between an endpoint's ChangeCipherSpec and its Finished, True after. done is set once the handshake is over
+TLSFlowSession = namedtuple("TLSFlowSession", ["ctx", "client", "record_streams", "finished", "done"])
+
+
+class TLSFlowDecryptor(object):
+    """ Tracks TLS sessions per TCP connection and decrypts their records
+
+        Segments must be fed in capture order. They are reassembled by a TCPReassembler and split into whole records
+        before dissection. A session starts with a ClientHello, connections joined mid session are ignored. Sessions
+        are dropped when reassembly has to skip a gap. A context lives as long as its connection stays in the
+        reassembler table, the decryptor takes over reassembler.on_evict to release it. On connections without a
+        session, payload is only dissected once prefilter accepts it.
+
+        With metadata_only set, a session is done once both Finished messages or a fatal alert went by. Its later
+        records are only framed and counted in its record_streams, never dissected nor decrypted.
+    """
+
+    def __init__(self, ctx_factory=None, reassembler=None, prefilter=None, metadata_only=False):
+        self.ctx_factory = ctx_factory or tlsc.TLSSessionCtx
+        self.reassembler = TCPReassembler() if reassembler is None else reassembler
+        self.reassembler.on_evict = self._release
+        self.prefilter = prefilter or TLSPrefilter()
+        self.metadata_only = metadata_only
+        self.created = 0
+        self.released = 0
+
+    def __len__(self):
+        return self.created - self.released
+
+    def __repr__(self):
+        return "<%s active=%d created=%d released=%d reassembler=%r prefilter=%r>" % (
+            self.__class__.__name__, len(self), self.created, self.released, self.reassembler, self.prefilter)
+
+    @staticmethod
+    def _is_client_hello(payload):
+        return len(payload) > 5 and payload[0] == chr(tls.TLSContentType.HANDSHAKE) and \
+            payload[5] == chr(tls.TLSHandshakeType.CLIENT_HELLO)
+
+    @staticmethod
+    def has_secret(tls_ctx):
+        """ Tells whether the context can derive the keys of its session rather than from a random premaster secret
+        """
+        session = tls_ctx.crypto.session
+        if session.keylog_master_secret is not None or tls_ctx.params.negotiated.resumed:
+            return True
+        if tls_ctx.session_keys is not None and tls_ctx.session_keys.client_random == session.randombytes.client:
+            return True
+        if tls_ctx.params.negotiated.key_exchange == tls.TLSKexNames.RSA:
+            return tls_ctx.crypto.server.rsa.privkey is not None or (
+                tls_ctx.rsa_premaster_secrets is not None and
+                session.encrypted_premaster_secret in tls_ctx.rsa_premaster_secrets)
+        return False
+
+    def _release(self, flow):
+        if flow.state is None:
+            return
+        flow.state.ctx.release_certificates()
+        flow.state = None
+        self.released += 1
+
+    def _drop(self, flow, reason):
+        warnings.warn("Dropping TLS session on %s: %s" % (repr(flow.key), reason))
+        self._release(flow)
+
+    def reset(self, key, reason="segments lost upstream"):
+        """ Forgets the connection of a flow key, along with its session. Later segments of the connection are
+            treated as picked up mid stream. Returns whether the connection was known
+        """
+        flow = self.reassembler.flows.pop(key, None)
+        if flow is None:
+            return False
+        flow.closed = True
+        if flow.state is not None:
+            self._drop(flow, reason)
+        return True
+
+    def dissect(self, segment, timestamp=None):
+        """ Returns (TLSSessionCtx, from_client, SSL) for the records completed by a TCPSegment, or None """
+        flow, data = self.reassembler.feed(segment, timestamp)
+        try:
+            return self._dissect(flow, segment, data)
+        finally:
+            if flow is not None and flow.closed:
+                self._release(flow)
+
+    def _dissect(self, flow, segment, data):
+        if flow.state is None:
+            if not self.prefilter(data) or not self._is_client_hello(data):
+                return None
+            flow.state = TLSFlowSession(self.ctx_factory(), segment.src,
+                                        dict((endpoint, TLSRecordStream()) for endpoint in flow.key), {}, False)
+            self.created += 1
+        elif not data:
+            return None
+        session = flow.state
+        if flow.streams[segment.src].gaps:
+            self._drop(flow, "segments lost")
+            return None
+        try:
+            payload = session.record_streams[segment.src].feed(data)
+        except ValueError as ve:
+            self._drop(flow, ve)
+            return None
+        if not payload or session.done:
+            return None
+        tls_ctx = session.ctx
+        from_client = segment.src == session.client
+        tls_ctx.set_mode(server=from_client)
+        if tls_ctx.sec_params is not None and not self.has_secret(tls_ctx):
+            # Keys are unknown. Keep records encrypted
+            ssl = tls.SSL(payload)
+        else:
+            try:
+                ssl = tls.SSL(payload, ctx=tls_ctx)
+            except ValueError as ve:
+                # The context no longer matches the peers
+                self._drop(flow, ve)
+                return tls_ctx, from_client, tls.SSL(payload)
+        if self.metadata_only and self._handshake_done(session, segment.src, payload, ssl):
+            flow.state = session._replace(done=True)
+        return tls_ctx, from_client, ssl
+
+    @staticmethod
+    def _handshake_done(session, src, payload, ssl):
+        for content_type in _record_content_types(payload):
+            if content_type == tls.TLSContentType.CHANGE_CIPHER_SPEC:
+                session.finished[src] = False
+            elif content_type == tls.TLSContentType.HANDSHAKE and session.finished.get(src) is False:
+                session.finished[src] = True
+        for record in ssl.records:
+            # Encrypted alerts can only be read once decrypted
+            if record.haslayer(tls.TLSAlert) and record[tls.TLSAlert].level == tls.TLSAlertLevel.FATAL and \
+                    (ssl.tls_ctx is not None or record.length == 2):
+                return True
+        return len(session.finished) == 2 and all(session.finished.values())
+
+    def process(self, index, timestamp, segment):
+        """ Returns the TLSCaptureRecords completed by a TCPSegment """
+        dissected = self.dissect(segment, timestamp)
+        if dissected is None:
+            return []
+        _, from_client, ssl = dissected
+        src, dst = _endpoint_to_str(segment.src), _endpoint_to_str(segment.dst)
+        records = []
+        for record in ssl.records:
+            if record.haslayer(tls.TLSPlaintext):
+                encrypted, data = False, record[tls.TLSPlaintext].data
+            elif record.haslayer(tls.TLSCiphertext):
+                encrypted, data = True, record[tls.TLSCiphertext].data
+            else:
+                encrypted, data = False, str(record.payload)
+            records.append(TLSCaptureRecord(index, timestamp, src, dst, from_client,
+                                            getattr(record, "content_type", None), getattr(record, "version", None),
+                                            encrypted, data))
+        return records
+
+
+class _RSAKeyExchangeScan(object):
+    """ Reads the RSA key exchange of a TLS session off its plaintext handshake messages, without dissection """
+
+    def __init__(self, client, key):
+        self.client = client
+        self.record_streams = dict((endpoint, TLSRecordStream()) for endpoint in key)
+        # endpoint: handshake message bytes received ahead of their end
+        self.handshakes = dict.fromkeys(key, "")
+        self.version = None
+        self.cipher_suite = None
+        self.certificate = None
+        self.done = False
+
+    def feed(self, src, data):
+        """ Returns the RSAKeyExchange completed by the stream bytes data of src, or None. Raises ValueError when
+            the stream does not carry TLS records
+        """
+        for content_type, fragment in _record_fragments(self.record_streams[src].feed(data)):
+            if content_type == tls.TLSContentType.CHANGE_CIPHER_SPEC:
+                # Later handshake messages are encrypted
+                self.done = True
+            if self.done:
+                return None
+            if content_type != tls.TLSContentType.HANDSHAKE:
+                continue
+            buffer = self.handshakes[src] + fragment
+            while len(buffer) >= 4:
+                end = 4 + struct.unpack("!I", "\x00" + buffer[1:4])[0]
+                if len(buffer) < end:
+                    break
+                key_exchange = self._handshake(src == self.client, ord(buffer[0]), buffer[4:end])
+                buffer = buffer[end:]
+                if self.done:
+                    return key_exchange
+            self.handshakes[src] = buffer
+        return None
+
+    def _handshake(self, from_client, handshake_type, body):
+        if handshake_type == tls.TLSHandshakeType.SERVER_HELLO and not from_client and len(body) > 34:
+            version, session_id_length = struct.unpack_from("!H32xB", body)
+            cipher_suite = body[35 + session_id_length:37 + session_id_length]
+            if len(cipher_suite) < 2:
+                self.done = True
+                return None
+            self.version, self.cipher_suite = version, struct.unpack("!H", cipher_suite)[0]
+            key_exchange = tlsc.TLSSecurityParameters.crypto_params.get(self.cipher_suite, {}).get("key_exchange", {})
+            # Ephemeral and unknown key exchanges can not be decrypted with the server key
+            self.done = key_exchange.get("name") != tls.TLSKexNames.RSA
+        elif handshake_type == tls.TLSHandshakeType.CERTIFICATE and not from_client and self.certificate is None:
+            if len(body) >= 6:
+                length = struct.unpack("!I", "\x00" + body[3:6])[0]
+                self.certificate = body[6:6 + length]
+        elif handshake_type == tls.TLSHandshakeType.CLIENT_KEY_EXCHANGE and from_client:
+            self.done = True
+            if self.cipher_suite is None or self.certificate is None:
+                return None
+            if len(body) >= 2 and struct.unpack_from("!H", body)[0] == len(body) - 2:
+                return RSAKeyExchange(self.certificate, body[2:])
+            if self.version == tls.TLSVersion.SSL_3_0 and body:
+                # SSL 3.0 does not prefix the encrypted premaster secret with its length
+                return RSAKeyExchange(self.certificate, body)
+        return None
+
+
+def extract_encrypted_premaster_secrets(pcap, prefilter=None):
+    """ Returns the RSAKeyExchanges of the sessions of a pcap file, without duplicates. The file is streamed
+
+        Only TCP, TLS record and handshake headers are parsed, nothing is dissected. A connection is scanned from
+        its ClientHello, once prefilter accepted it, up to the first ChangeCipherSpec. Sessions negotiating an other
+        key exchange than RSA are skipped. Decrypt the result with tlsc.decrypt_premaster_secrets(), or have
+        decrypt_pcap() do both through rsa_key_store.
+    """
+    prefilter = prefilter or TLSPrefilter()
+    reassembler = TCPReassembler()
+    key_exchanges = OrderedDict()
+    reader = PcapFileReader(pcap)
+    try:
+        for _, timestamp, segment in _segments(reader, enumerate(reader)):
+            flow, data = reassembler.feed(segment, timestamp)
+            if flow is None or not data:
+                continue
+            if flow.state is None:
+                if not prefilter(data) or not TLSFlowDecryptor._is_client_hello(data):
+                    continue
+                flow.state = _RSAKeyExchangeScan(segment.src, flow.key)
+            scan = flow.state
+            if scan.done or flow.streams[segment.src].gaps:
+                scan.done = True
+                continue
+            try:
+                key_exchange = scan.feed(segment.src, data)
+            except ValueError:
+                scan.done = True
+                continue
+            if key_exchange is not None:
+                key_exchanges[key_exchange] = None
+    finally:
+        reader.close()
+    return list(key_exchanges)
+
+
+def _premaster_secrets_ctx(ctx_factory, premaster_secrets):
+    tls_ctx = ctx_factory()
+    tls_ctx.rsa_premaster_secrets = premaster_secrets
+    return tls_ctx
+
+
+def _decrypt_worker(ctx_factory, metadata_only, in_queue, out_queue):
+    # PyCrypto refuses to use RNG state inherited through fork()
+    if hasattr(Random, "atfork"):
+        Random.atfork()
+    decryptor = TLSFlowDecryptor(ctx_factory, metadata_only=metadata_only)
+    for batch in iter(in_queue.get, None):
+        results = []
+        for index, timestamp, segment in batch:
+            if index is None:
+                # Drop marker carrying the key of a flow whose segments were lost before reaching the worker
+                decryptor.reset(segment)
+            else:
+                results.append((index, decryptor.process(index, timestamp, segment)))
+        out_queue.put(results)
+
+
+def decrypt_pcap(pcap, ctx_factory=None, processes=None, batch_size=64, queue_size=64, metadata_only=False,
+                 rsa_key_store=None):
+    """ Yields the TLSCaptureRecords of all TLS sessions of a pcap file, in capture order. The file is streamed
+
+        With processes set (0 means one per CPU), flows are sharded by a hash of their addresses and ports over
+        worker processes, each holding its own contexts. Packet order is kept within each flow and results are
+        merged back into capture order. batch_size packets are sent to a worker at once and at most queue_size
+        batches are queued per worker. A partial batch is sent early when it holds back the merge. Reading stops
+        once as many packets as all queues hold wait for the oldest result. With metadata_only set, records
+        following the handshake are not yielded, see TLSFlowDecryptor.
+
+        With rsa_key_store set, a TLSRSAKeyStore or a single private key, a first pass over the file collects the
+        RSA key exchanges. Their premaster secrets are decrypted at once, over processes as well, and handed to
+        all contexts through rsa_premaster_secrets.
+    """
+    ctx_factory = ctx_factory or tlsc.TLSSessionCtx
+    if rsa_key_store is not None:
+        premaster_secrets = tlsc.decrypt_premaster_secrets(rsa_key_store, extract_encrypted_premaster_secrets(pcap),
+                                                           processes)
+        ctx_factory = functools.partial(_premaster_secrets_ctx, ctx_factory, premaster_secrets)
+    reader = PcapFileReader(pcap)
+    try:
+        segments = _segments(reader, enumerate(reader))
+        if processes is None:
+            decryptor = TLSFlowDecryptor(ctx_factory, metadata_only=metadata_only)
+            for index, timestamp, segment in segments:
+                for record in decryptor.process(index, timestamp, segment):
+                    yield record
+        else:
+            for record in _decrypt_sharded(segments, ctx_factory, processes or multiprocessing.cpu_count(),
+                                           batch_size, queue_size, metadata_only):
+                yield record
+    finally:
+        reader.close()
+
+
+def _segments(source, frames):
+    """ Yields (index, timestamp, TCPSegment) for the TCP frames of (index, (frame, timestamp, wire length)) """
+    linktype = source.linktype
+    for index, (frame, timestamp, _) in frames:
+        segment = parse_tcp_frame(linktype, frame)
+        if segment is not None:
+            yield index, timestamp, segment
+
+
+def _start_decrypt_workers(ctx_factory, metadata_only, processes, queue_size):
+    """ Returns the input queues, shared output queue and processes of decrypt workers """
+    in_queues = [multiprocessing.Queue(queue_size) for _ in range(processes)]
+    out_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=_decrypt_worker, args=(ctx_factory, metadata_only, in_queue, out_queue))
+               for in_queue in in_queues]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    return in_queues, out_queue, workers
+
+
+def _stop_decrypt_workers(in_queues, workers):
+    for in_queue in in_queues:
+        try:
+            in_queue.put_nowait(None)
+        except Queue.Full:
+            pass
+    for worker in workers:
+        worker.join(1)
+        if worker.is_alive():
+            worker.terminate()
+
+
+def _decrypt_sharded(segments, ctx_factory, processes, batch_size, queue_size, metadata_only):
+    in_queues, out_queue, workers = _start_decrypt_workers(ctx_factory, metadata_only, processes, queue_size)
+    batches = [[] for _ in range(processes)]
+    # (index, shard) of the segments batched or sent, in capture order, and results received out of order
+    pending, results = deque(), {}
+    in_flight = 0
+    # Segments read ahead of the oldest one without result. Past this, reading waits for the workers
+    max_pending = processes * queue_size * batch_size
+
+    def receive(block):
+        for index, records in out_queue.get(block):
+            results[index] = records
+        while pending and pending[0][0] in results:
+            for record in results.pop(pending.popleft()[0]):
+                yield record
+
+    try:
+        for index, timestamp, segment in segments:
+            shard = hash(flow_key(segment)) % processes
+            batches[shard].append((index, timestamp, segment))
+            pending.append((index, shard))
+            if len(batches[shard]) >= batch_size:
+                in_queues[shard].put(batches[shard])
+                batches[shard] = []
+                in_flight += 1
+            while True:
+                # A quiet flow must not hold back the others: once a batch per worker piled up behind the oldest
+                # segment, its batch is sent partial
+                head, shard = pending[0] if pending else (None, None)
+                if len(pending) >= processes * batch_size and batches[shard] and batches[shard][0][0] == head:
+                    in_queues[shard].put(batches[shard])
+                    batches[shard] = []
+                    in_flight += 1
+                block = len(pending) >= max_pending
+                if not in_flight or not (block or not out_queue.empty()):
+                    break
+                in_flight -= 1
+                for record in receive(block):
+                    yield record
+        for shard, batch in enumerate(batches):
+            if batch:
+                in_queues[shard].put(batch)
+                in_flight += 1
+        while in_flight:
+            in_flight -= 1
+            for record in receive(True):
+                yield record
+    finally:
+        _stop_decrypt_workers(in_queues, workers)
+
+
+class TLSCapturePipeline(object):
+    """ Live decryption with a capture thread feeding a pool of decrypt worker processes
+
+        The capture thread reads (frame, timestamp, wire length) tuples from source, a PacketRingReader or any
+        iterable with a linktype. Segments are sharded by flow over the workers, so each connection is decrypted in
+        order by a single TLSFlowDecryptor. They are sent in batches of batch_size, or once flush_interval seconds
+        of capture time passed. The capture thread never waits on the workers: when the queue of a worker already
+        holds queue_size batches, the batch is dropped and counted. The connections of a dropped batch are reset
+        by their worker ahead of the next batch it receives, rather than waiting on the lost segments. Records
+        come out of records() as workers complete batches.
+
+        Capture ends with source, or on stop(). The stop is noticed between frames and whenever an idle source,
+        such as a PacketRingReader with idle timeout, stops iterating. A source that blocks without frames is
+        closed by stop().
+    """
+
+    def __init__(self, source, ctx_factory=None, processes=0, batch_size=64, queue_size=64, flush_interval=0.1,
+                 metadata_only=False):
+        self.source = source
+        self.ctx_factory = ctx_factory
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+        self.flush_interval = flush_interval
+        self.metadata_only = metadata_only
+        self.frames = 0
+        self.segments = 0
+        self.batches = 0
+        self.dropped_batches = 0
+        self.dropped_segments = 0
+        self.dropped_flows = 0
+        self.received = 0
+        # shard: keys of the flows that lost segments, to reset ahead of the next batch of the shard
+        self._lost = {}
+        self._stop = threading.Event()
+        self._thread = None
+        self._workers = None
+
+    def __repr__(self):
+        return "<%s %r>" % (self.__class__.__name__, self.stats())
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def start(self):
+        self._in_queues, self._out_queue, self._workers = _start_decrypt_workers(
+            self.ctx_factory, self.metadata_only, self.processes, self.queue_size)
+        self._thread = threading.Thread(target=self._capture, name="TLSCapturePipeline capture")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """ Stops capturing and shuts the workers down. Batches still queued are discarded. A capture thread
+            still blocked in source after timeout seconds is released by closing source
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive() and hasattr(self.source, "close"):
+                self.source.close()
+                self._thread.join(timeout)
+            if self._thread.is_alive():
+                warnings.warn("Capture thread did not stop within %.1f seconds" % timeout)
+        if self._workers is not None:
+            _stop_decrypt_workers(self._in_queues, self._workers)
+            self._workers = None
+
+    def stats(self):
+        """ Returns TLSPipelineStats. dropped_flows counts the connections reset after losing segments to a
+            dropped batch. backlog is the number of batches queued or being decrypted
+        """
+        return TLSPipelineStats(self.frames, self.segments, self.batches, self.dropped_batches,
+                                self.dropped_segments, self.dropped_flows, self.batches - self.received)
+
+    def _send(self, shard, batch):
+        lost = self._lost.get(shard)
+        try:
+            self._in_queues[shard].put_nowait([(None, None, key) for key in lost or ()] + batch)
+        except Queue.Full:
+            self.dropped_batches += 1
+            self.dropped_segments += len(batch)
+            lost = self._lost.setdefault(shard, set())
+            for _, _, segment in batch:
+                key = flow_key(segment)
+                if key not in lost:
+                    lost.add(key)
+                    self.dropped_flows += 1
+            return
+        self._lost.pop(shard, None)
+        self.batches += 1
+
+    def _frames(self):
+        """ Yields the frames of source, and None whenever it stops iterating because it is idle """
+        while True:
+            for frame, timestamp, _ in self.source:
+                self.frames += 1
+                yield frame, timestamp
+                if self._stop.is_set():
+                    return
+            if self._stop.is_set() or not getattr(self.source, "idle", None):
+                return
+            yield None
+
+    def _capture(self):
+        linktype = self.source.linktype
+        batches = [[] for _ in range(self.processes)]
+        flushed = None
+
+        def flush():
+            for shard, batch in enumerate(batches):
+                if batch:
+                    self._send(shard, batch)
+                    batches[shard] = []
+
+        try:
+            for frame in self._frames():
+                if frame is None:
+                    flush()
+                    continue
+                frame, timestamp = frame
+                segment = parse_tcp_frame(linktype, frame)
+                if segment is None:
+                    continue
+                shard = hash(flow_key(segment)) % self.processes
+                batches[shard].append((self.frames - 1, timestamp, segment))
+                self.segments += 1
+                if len(batches[shard]) >= self.batch_size:
+                    self._send(shard, batches[shard])
+                    batches[shard] = []
+                if flushed is None:
+                    flushed = timestamp
+                elif timestamp - flushed >= self.flush_interval:
+                    flush()
+                    flushed = timestamp
+            flush()
+        except (ValueError, IOError, OSError, socket.error, select.error):
+            # source was closed under the capture thread by stop()
+            if not self._stop.is_set():
+                raise
+        finally:
+            self._stop.set()
+
+    def records(self, idle=None):
+        """ Yields TLSCaptureRecords, in capture order within each connection. Returns once the capture stopped and
+            all batches were decrypted, or after idle seconds without records when idle is set
+        """
+        waited = 0.0
+        while self._workers is not None:
+            try:
+                results = self._out_queue.get(True, 0.1)
+            except Queue.Empty:
+                if self._stop.is_set() and self.batches == self.received:
+                    return
+                waited += 0.1
+                if idle is not None and waited >= idle:
+                    return
+                continue
+            waited = 0.0
+            self.received += 1
+            for _, records in results:
+                for record in records:
+                    yield record
@@ -3,25 +3,66 @@
 # Author : tintinweb@oststrom.com <github.com/tintinweb>
 # http://www.secdev.org/projects/scapy/doc/build_dissect.html
 
+import atexit
 import binascii
 import copy
+import datetime
+import glob
+import mmap
+import multiprocessing
 import os
+import random
+import socket
 import struct
+import threading
+import time
 import zlib
 import re
 import warnings
+import weakref
 from scapy.layers import pkcs7
 from scapy.layers import ssl_tls as tls
 import tinyec.ec as ec
 import tinyec.registry as ec_reg
 
-from collections import namedtuple
+from collections import deque, namedtuple, OrderedDict
+from Crypto import Random
 from Crypto.Cipher import AES, ARC2, ARC4, DES, DES3, PKCS1_v1_5
 from Crypto.Hash import HMAC, MD5, SHA, SHA256, SHA384
 from Crypto.PublicKey import DSA, RSA
 from Crypto.Signature import PKCS1_v1_5 as Sig_PKCS1_v1_5
 from Crypto.Util.asn1 import DerSequence
 from scapy.asn1.asn1 import ASN1_SEQUENCE
+from scapy.packet import NoPayload, Raw
+
+try:
+    # Optional OpenSSL backed crypto. tinyec and pycrypto are used if unavailable
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives import hashes as crypto_hashes, hmac as crypto_hmac
+    from cryptography.hazmat.primitives.asymmetric import ec as crypto_ec
+    from cryptography.hazmat.primitives.ciphers import Cipher as CryptoCipher, algorithms as crypto_algorithms, \
+        modes as crypto_modes
+except ImportError:
+    crypto_ec = None
+    crypto_hashes = crypto_hmac = CryptoCipher = crypto_algorithms = crypto_modes = None
+
+try:
+    from cryptography.exceptions import InvalidTag
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM as CryptoAESGCM, \
+        ChaCha20Poly1305 as CryptoChaCha20Poly1305
+except ImportError:
+    CryptoAESGCM = CryptoChaCha20Poly1305 = None
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+try:
+    # pycryptodome only. pycrypto provides no AEAD cipher
+    from Crypto.Cipher import ChaCha20_Poly1305
+except ImportError:
+    ChaCha20_Poly1305 = None
 
 
 '''
@@ -46,6 +87,17 @@ def pem_get_objects(data):
     return d
 
 def x509_extract_pubkey_from_der(der_certificate):
+    """ Returns the RSA public key of a DER certificate. Keys are cached in X509_PUBKEY_CACHE, keyed by a digest
+        of the certificate bytes
+    """
+    digest = SHA256.new(str(der_certificate)).digest()
+    pub_key = X509_PUBKEY_CACHE.get(digest)
+    if pub_key is None:
+        pub_key = _x509_extract_pubkey_from_der(der_certificate)
+        X509_PUBKEY_CACHE.put(digest, pub_key)
+    return pub_key
+
+def _x509_extract_pubkey_from_der(der_certificate):
     # Extract subjectPublicKeyInfo field from X.509 certificate (see RFC3280)
     try:
         # try to extract pubkey from scapy.layers.x509 X509Cert type in case
@@ -100,23 +152,1154 @@ def x509_extract_pubkey_from_pem(public_key_string):
     return x509_extract_pubkey_from_der(der)
 
 
+X509Metadata = namedtuple("X509Metadata", ["fingerprint", "serial", "issuer", "subject", "not_before", "not_after",
+                                           "spki", "key_type", "key_size", "san"])
+
+DER_TAG_OID = 0x06
+DER_TAG_UTC_TIME = 0x17
+DER_TAG_GENERALIZED_TIME = 0x18
+DER_TAG_SEQUENCE = 0x30
+X509_KEY_TYPES = {"1.2.840.113549.1.1.1": "RSA", "1.2.840.10045.2.1": "EC", "1.2.840.10040.4.1": "DSA"}
+X509_EC_CURVE_SIZES = {"1.2.840.10045.3.1.7": 256, "1.3.132.0.34": 384, "1.3.132.0.35": 521, "1.3.132.0.10": 256}
+X509_OID_SUBJECT_ALT_NAME = "2.5.29.17"
+
+
+def _der_read(der, offset, end=None):
+    """ Returns (tag, content start, content end) of the DER element at offset """
+    end = len(der) if end is None else end
+    if offset + 2 > end:
+        raise ValueError("Truncated DER element at offset %d" % offset)
+    tag = ord(der[offset])
+    length = ord(der[offset + 1])
+    start = offset + 2
+    if length & 0x80:
+        num_bytes = length & 0x7f
+        if num_bytes == 0 or start + num_bytes > end:
+            raise ValueError("Invalid DER length at offset %d" % offset)
+        length = int(binascii.hexlify(der[start:start + num_bytes]), 16)
+        start += num_bytes
+    if start + length > end:
+        raise ValueError("DER element at offset %d exceeds its container" % offset)
+    return tag, start, start + length
+
+
+def _der_children(der, start, end):
+    """ Yields (tag, element start, content start, content end) for the elements in der[start:end] """
+    while start < end:
+        tag, content_start, content_end = _der_read(der, start, end)
+        yield tag, start, content_start, content_end
+        start = content_end
+
+
+def _der_decode_oid(oid):
+    values = []
+    value = 0
+    for char in oid:
+        value = (value << 7) | (ord(char) & 0x7f)
+        if not ord(char) & 0x80:
+            values.append(value)
+            value = 0
+    # The first subidentifier packs the first two arcs. Only arc 2 has a second arc of 40 or more (X.690 8.19.4)
+    first = min(values[0] // 40, 2)
+    return ".".join(str(v) for v in [first, values[0] - 40 * first] + values[1:])
+
+
+def _der_decode_integer(value):
+    # Two's complement, big endian
+    number = int(binascii.hexlify(value), 16)
+    if ord(value[0]) & 0x80:
+        number -= 1 << (8 * len(value))
+    return number
+
+
+def _der_decode_time(tag, value):
+    if tag == DER_TAG_UTC_TIME:
+        # Two digit years: 50 to 99 map to 19xx (RFC 5280 section 4.1.2.5.1)
+        year = int(value[:2])
+        value = "%d%s" % (1900 + year if year >= 50 else 2000 + year, value[2:])
+    elif tag != DER_TAG_GENERALIZED_TIME:
+        raise ValueError("Unexpected DER time tag 0x%02x" % tag)
+    return datetime.datetime(int(value[:4]), int(value[4:6]), int(value[6:8]), int(value[8:10]), int(value[10:12]),
+                             int(value[12:14]))
+
+
+def _der_int_bits(der_int):
+    der_int = der_int.lstrip("\x00")
+    return len(der_int) * 8 - (8 - len(bin(ord(der_int[0]))[2:])) if der_int else 0
+
+
+def _x509_key_info(der, spki_start, spki_end):
+    algorithm, key = list(_der_children(der, spki_start, spki_end))[:2]
+    algorithm_params = list(_der_children(der, algorithm[2], algorithm[3]))
+    oid = _der_decode_oid(der[algorithm_params[0][2]:algorithm_params[0][3]])
+    key_type = X509_KEY_TYPES.get(oid, oid)
+    # Skip the unused bits byte of the BIT STRING
+    key_start, key_end = key[2] + 1, key[3]
+    key_size = None
+    if key_type == "RSA":
+        _, seq_start, seq_end = _der_read(der, key_start, key_end)
+        modulus = next(_der_children(der, seq_start, seq_end))
+        key_size = _der_int_bits(der[modulus[2]:modulus[3]])
+    elif key_type == "EC":
+        curve = algorithm_params[1] if len(algorithm_params) > 1 else None
+        if curve is not None and curve[0] == DER_TAG_OID:
+            key_size = X509_EC_CURVE_SIZES.get(_der_decode_oid(der[curve[2]:curve[3]]))
+        if key_size is None and ord(der[key_start]) == 0x04:
+            # Uncompressed point: 0x04 + x + y
+            key_size = (key_end - key_start - 1) // 2 * 8
+    elif key_type == "DSA" and len(algorithm_params) > 1:
+        p = next(_der_children(der, algorithm_params[1][2], algorithm_params[1][3]))
+        key_size = _der_int_bits(der[p[2]:p[3]])
+    return key_type, key_size
+
+
+def _x509_subject_alt_names(der, start, end):
+    names = []
+    for tag, _, value_start, value_end in _der_children(der, start, end):
+        value = der[value_start:value_end]
+        if tag == 0x82:
+            # dNSName
+            names.append(value)
+        elif tag == 0x87:
+            # iPAddress
+            names.append(socket.inet_ntop(socket.AF_INET if len(value) == 4 else socket.AF_INET6, value))
+    return names
+
+
+def x509_extract_metadata(der_certificate):
+    """ Extracts certificate metadata with a single pass over the DER encoding, without building ASN.1 objects
+
+        Returns an X509Metadata with the SHA256 fingerprint, serial number, raw DER subject and issuer names,
+        validity as datetimes, raw DER SubjectPublicKeyInfo, key type ("RSA", "EC", "DSA" or the algorithm OID),
+        key size in bits (None if unknown) and the DNS names and IP addresses of the subjectAltName extension.
+        Raises ValueError on malformed certificates.
+    """
+    der = str(der_certificate)
+    try:
+        _, cert_start, cert_end = _der_read(der, 0)
+        tag, tbs_start, tbs_end = _der_read(der, cert_start, cert_end)
+        if tag != DER_TAG_SEQUENCE:
+            raise ValueError("TBSCertificate is not a SEQUENCE")
+        fields = list(_der_children(der, tbs_start, tbs_end))
+        # Skip the optional [0] EXPLICIT version
+        if fields[0][0] == 0xa0:
+            fields = fields[1:]
+        serial, _, issuer, validity, subject, spki = fields[:6]
+        not_before, not_after = [_der_decode_time(tag_, der[start:end])
+                                 for tag_, _, start, end in _der_children(der, validity[2], validity[3])]
+        key_type, key_size = _x509_key_info(der, spki[2], spki[3])
+        san = []
+        for tag, _, start, end in fields[6:]:
+            # [3] EXPLICIT Extensions
+            if tag != 0xa3:
+                continue
+            _, extensions_start, extensions_end = _der_read(der, start, end)
+            for _, _, extension_start, extension_end in _der_children(der, extensions_start, extensions_end):
+                extension = list(_der_children(der, extension_start, extension_end))
+                if _der_decode_oid(der[extension[0][2]:extension[0][3]]) == X509_OID_SUBJECT_ALT_NAME:
+                    value = extension[-1]
+                    _, names_start, names_end = _der_read(der, value[2], value[3])
+                    san = _x509_subject_alt_names(der, names_start, names_end)
+    except (IndexError, StopIteration) as e:
+        raise ValueError("Malformed certificate: %r" % e)
+    return X509Metadata(fingerprint=SHA256.new(der).digest(),
+                        serial=_der_decode_integer(der[serial[2]:serial[3]]),
+                        issuer=der[issuer[1]:issuer[3]],
+                        subject=der[subject[1]:subject[3]],
+                        not_before=not_before,
+                        not_after=not_after,
+                        spki=der[spki[1]:spki[3]],
+                        key_type=key_type,
+                        key_size=key_size,
+                        san=san)
+
+
 def int_to_str(int_):
     hex_ = "%x" % int_
     return binascii.unhexlify("%s%s" % ("" if len(hex_) % 2 == 0 else "0", hex_))
 
 
+def str_xor(a, b):
+    """ XOR two equally long strings as big integers instead of one character at a time
+    """
+    if len(a) != len(b):
+        raise ValueError("Cannot XOR strings of different length: %d != %d" % (len(a), len(b)))
+    if len(a) == 0:
+        return a
+    xored = int(binascii.hexlify(a), 16) ^ int(binascii.hexlify(b), 16)
+    return binascii.unhexlify("%0*x" % (2 * len(a), xored))
+
+
+class LRUCache(object):
+    """ Thread safe mapping holding at most size entries. The least recently used entry is evicted first
+    """
+
+    def __init__(self, size=128):
+        if size < 1:
+            raise ValueError("Cache size must be positive: %d" % size)
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __contains__(self, key):
+        with self._lock:
+            return key in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def __repr__(self):
+        return "<%s size=%d entries=%d hits=%d misses=%d>" % (self.__class__.__name__, self.size, len(self),
+                                                              self.hits, self.misses)
+
+
+# Public keys extracted by x509_extract_pubkey_from_der(). Resize with X509_PUBKEY_CACHE.size
+X509_PUBKEY_CACHE = LRUCache(size=1024)
+# Premaster secrets decrypted by rsa_decrypt_pms(), keyed by modulus and encrypted premaster secret
+RSA_PMS_CACHE = LRUCache(size=256)
+# PKCS1_v1_5 cipher objects used by rsa_decrypt_pms(), one per private key
+RSA_PKCS1_CIPHERS = LRUCache(size=64)
+
+
+def rsa_decrypt_pms(priv_key, encrypted_pms):
+    """ Decrypts an RSA encrypted premaster secret. Returns None if decryption fails
+
+        Retransmitted or re-dissected ClientKeyExchange messages are served from RSA_PMS_CACHE instead of
+        performing the private key operation again
+    """
+    key = (priv_key.n, encrypted_pms)
+    premaster_secret = RSA_PMS_CACHE.get(key)
+    if premaster_secret is None:
+        cipher = RSA_PKCS1_CIPHERS.get(priv_key.n)
+        if cipher is None:
+            cipher = PKCS1_v1_5.new(priv_key)
+            RSA_PKCS1_CIPHERS.put(priv_key.n, cipher)
+        premaster_secret = cipher.decrypt(encrypted_pms, None)
+        # Failures are not cached
+        if premaster_secret is not None:
+            RSA_PMS_CACHE.put(key, premaster_secret)
+    return premaster_secret
+
+
+def _ec_field_len(ec_curve):
+    return (ec_curve.field.p.bit_length() + 7) // 8
+
+
+def _modular_sqrt(a, p):
+    # Tonelli-Shanks. Returns one of the two square roots of a modulo the odd prime p
+    a %= p
+    if a == 0:
+        return 0
+    if pow(a, (p - 1) // 2, p) != 1:
+        raise ValueError("%d has no square root modulo %d" % (a, p))
+    if p % 4 == 3:
+        return pow(a, (p + 1) // 4, p)
+    q, s = p - 1, 0
+    while q % 2 == 0:
+        q //= 2
+        s += 1
+    z = 2
+    while pow(z, (p - 1) // 2, p) != p - 1:
+        z += 1
+    m, c, t, r = s, pow(z, q, p), pow(a, q, p), pow(a, (q + 1) // 2, p)
+    while t != 1:
+        i, t2 = 0, t
+        while t2 != 1:
+            t2 = t2 * t2 % p
+            i += 1
+        b = pow(c, 1 << (m - i - 1), p)
+        m, c, t, r = i, b * b % p, t * b * b % p, r * b % p
+    return r
+
+
 def str_to_ec_point(ansi_str, ec_curve):
-    if not ansi_str.startswith("\x04"):
-        raise ValueError("ANSI octet string missing point prefix (0x04)")
-    ansi_str = ansi_str[1:]
-    if len(ansi_str) % 2 != 0:
-        raise ValueError("Can't parse curve point. Odd ANSI string length")
     str_to_int = lambda x: int(binascii.hexlify(x), 16)
-    x, y = str_to_int(ansi_str[:len(ansi_str) // 2]), str_to_int(ansi_str[len(ansi_str) // 2:])
+    prefix, ansi_str = ansi_str[:1], ansi_str[1:]
+    if prefix == "\x04":
+        if len(ansi_str) % 2 != 0:
+            raise ValueError("Can't parse curve point. Odd ANSI string length")
+        x, y = str_to_int(ansi_str[:len(ansi_str) // 2]), str_to_int(ansi_str[len(ansi_str) // 2:])
+    elif prefix in ("\x02", "\x03"):
+        # Compressed point (X9.62 section 4.2.1). Recover y from the curve equation and the parity bit
+        if len(ansi_str) != _ec_field_len(ec_curve):
+            raise ValueError("Can't parse compressed curve point. Invalid ANSI string length")
+        p = ec_curve.field.p
+        x = str_to_int(ansi_str)
+        y = _modular_sqrt(x**3 + ec_curve.a * x + ec_curve.b, p)
+        if y % 2 != ord(prefix) % 2:
+            y = p - y
+    else:
+        raise ValueError("ANSI octet string missing point prefix (0x02, 0x03 or 0x04)")
     return ec.Point(ec_curve, x, y)
 
 
+def ec_point_to_str(point, compressed=False):
+    # Fixed length ANSI X9.62 encoding. Coordinates are padded to the field size
+    field_len = _ec_field_len(point.curve)
+    if compressed:
+        return "%s%s" % (chr(2 + point.y % 2), binascii.unhexlify("%0*x" % (field_len * 2, point.x)))
+    return "\x04%s" % binascii.unhexlify("%0*x%0*x" % (field_len * 2, point.x, field_len * 2, point.y))
+
+
+class TinyECBackend(object):
+    """ Pure python elliptic curve arithmetic through tinyec. Works for every curve in the tinyec registry """
+    name = "tinyec"
+
+    def supports(self, curve_name):
+        try:
+            ec_reg.get_curve(curve_name)
+        except ValueError:
+            return False
+        return True
+
+    def make_keypair(self, curve_name):
+        return ec.make_keypair(ec_reg.get_curve(curve_name))
+
+    def load_keypair(self, curve_name, priv):
+        return ec.Keypair(ec_reg.get_curve(curve_name), priv)
+
+    def get_secret(self, curve_name, priv, pub):
+        """ Returns the x coordinate of priv * pub, as a fixed length octet string (RFC 4492 section 5.10) """
+        ec_curve = ec_reg.get_curve(curve_name)
+        secret_point = priv * pub
+        return binascii.unhexlify("%0*x" % (_ec_field_len(ec_curve) * 2, secret_point.x))
+
+
+class CryptographyECBackend(TinyECBackend):
+    """ OpenSSL backed elliptic curve arithmetic through cryptography
+
+        Keys are still handed out as tinyec Keypair and Point objects so the rest of the context is unaffected.
+        Curves OpenSSL does not provide are delegated to tinyec.
+    """
+    name = "cryptography"
+
+    def __init__(self):
+        if crypto_ec is None:
+            raise ImportError("cryptography is required for the %s EC backend" % self.name)
+        self.backend = default_backend()
+        self.curves = {}
+        for curve_name, curve_type in (("secp192r1", "SECP192R1"), ("secp224r1", "SECP224R1"),
+                                       ("secp256r1", "SECP256R1"), ("secp384r1", "SECP384R1"),
+                                       ("secp521r1", "SECP521R1"), ("secp256k1", "SECP256K1"),
+                                       ("brainpoolP256r1", "BrainpoolP256R1"),
+                                       ("brainpoolP384r1", "BrainpoolP384R1"),
+                                       ("brainpoolP512r1", "BrainpoolP512R1")):
+            # Older cryptography releases lack some curve types, and linked OpenSSL may not provide all of them
+            curve = getattr(crypto_ec, curve_type, None)
+            if curve is not None and self.backend.elliptic_curve_supported(curve()):
+                self.curves[curve_name] = curve
+
+    def _to_keypair(self, curve_name, private_key):
+        ec_curve = ec_reg.get_curve(curve_name)
+        numbers = private_key.private_numbers()
+        return ec.Keypair(ec_curve, numbers.private_value,
+                          ec.Point(ec_curve, numbers.public_numbers.x, numbers.public_numbers.y))
+
+    def make_keypair(self, curve_name):
+        if curve_name not in self.curves:
+            return super(CryptographyECBackend, self).make_keypair(curve_name)
+        return self._to_keypair(curve_name, crypto_ec.generate_private_key(self.curves[curve_name](), self.backend))
+
+    def load_keypair(self, curve_name, priv):
+        if curve_name not in self.curves:
+            return super(CryptographyECBackend, self).load_keypair(curve_name, priv)
+        return self._to_keypair(curve_name, crypto_ec.derive_private_key(priv, self.curves[curve_name](),
+                                                                         self.backend))
+
+    def get_secret(self, curve_name, priv, pub):
+        if curve_name not in self.curves:
+            return super(CryptographyECBackend, self).get_secret(curve_name, priv, pub)
+        curve = self.curves[curve_name]()
+        private_key = crypto_ec.derive_private_key(priv, curve, self.backend)
+        # Raises ValueError if the peer point is not on the curve
+        public_key = crypto_ec.EllipticCurvePublicNumbers(pub.x, pub.y, curve).public_key(self.backend)
+        return private_key.exchange(crypto_ec.ECDH(), public_key)
+
+
+def get_ec_backend(name=None):
+    """ Returns an EC backend instance by name. Without a name, the fastest available backend is returned """
+    backends = {TinyECBackend.name: TinyECBackend, CryptographyECBackend.name: CryptographyECBackend}
+    if name is None:
+        name = CryptographyECBackend.name if crypto_ec is not None else TinyECBackend.name
+    try:
+        return backends[name]()
+    except KeyError:
+        raise ValueError("Unknown EC backend: %s. Available backends: %s" % (name, ", ".join(backends.keys())))
+
+
+class PyCryptodomeAEAD(object):
+    """ AEAD primitive on top of pycryptodome, with the cryptography AEAD interface
+    """
+
+    def __init__(self, new_cipher, tag_length):
+        self._new_cipher = new_cipher
+        self.tag_length = tag_length
+
+    @classmethod
+    def new(cls, cipher_type, key):
+        """ Returns None if the installed pycrypto flavour does not provide cipher_type """
+        if cipher_type is AESGCMCipher and hasattr(AES, "MODE_GCM"):
+            return cls(lambda nonce: AES.new(key, AES.MODE_GCM, nonce=nonce, mac_len=cipher_type.tag_length),
+                       cipher_type.tag_length)
+        if cipher_type is ChaCha20Poly1305Cipher and ChaCha20_Poly1305 is not None:
+            return cls(lambda nonce: ChaCha20_Poly1305.new(key=key, nonce=nonce), cipher_type.tag_length)
+        return None
+
+    def encrypt(self, nonce, data, associated_data):
+        cipher = self._new_cipher(nonce)
+        cipher.update(associated_data)
+        ciphertext, tag = cipher.encrypt_and_digest(data)
+        return "%s%s" % (ciphertext, tag)
+
+    def decrypt(self, nonce, data, associated_data):
+        cipher = self._new_cipher(nonce)
+        cipher.update(associated_data)
+        # Raises ValueError if the tag does not match
+        return cipher.decrypt_and_verify(data[:-self.tag_length], data[-self.tag_length:])
+
+
+class CryptographyAEAD(object):
+    """ Thin wrapper around cryptography AEAD primitives, raising ValueError on authentication failure like pycrypto
+    """
+
+    def __init__(self, aead):
+        self._aead = aead
+
+    @classmethod
+    def new(cls, cipher_type, key):
+        """ Returns None if cryptography is not installed or too old to provide cipher_type """
+        if cipher_type is AESGCMCipher and CryptoAESGCM is not None:
+            return cls(CryptoAESGCM(key))
+        if cipher_type is ChaCha20Poly1305Cipher and CryptoChaCha20Poly1305 is not None:
+            return cls(CryptoChaCha20Poly1305(key))
+        return None
+
+    def encrypt(self, nonce, data, associated_data):
+        return self._aead.encrypt(nonce, data, associated_data)
+
+    def decrypt(self, nonce, data, associated_data):
+        try:
+            return self._aead.decrypt(nonce, data, associated_data)
+        except InvalidTag:
+            raise ValueError("MAC check failed")
+
+
+class PyCryptoBackend(object):
+    """ Symmetric ciphers and HMAC straight from the pycrypto types referenced in TLSSecurityParameters.crypto_params
+    """
+    name = "pycrypto"
+    # pycrypto has no AEAD support, pycryptodome has. Fall back to cryptography if neither provides the cipher
+    aead_factories = (PyCryptodomeAEAD.new, CryptographyAEAD.new)
+
+    def new_cipher(self, cipher_type, key, mode=None, iv=None):
+        # Stream ciphers
+        if mode is None:
+            return cipher_type.new(key)
+        return cipher_type.new(key, mode=mode, IV=iv)
+
+    def new_hmac(self, key, hash_type):
+        return HMAC.new(key, digestmod=hash_type)
+
+    def new_aead(self, cipher_type, key, fixed_iv):
+        """ Returns an AEADCipher record cipher of cipher_type """
+        for factory in self.aead_factories:
+            aead = factory(cipher_type, key)
+            if aead is not None:
+                return cipher_type(aead, fixed_iv)
+        raise RuntimeError("%s requires pycryptodome or cryptography" % cipher_type.__name__)
+
+
+class CryptographyCipher(object):
+    """ Implements a pycrypto like interface on top of a cryptography cipher context.
+        Like pycrypto objects, CBC chaining state is kept across calls
+    """
+
+    def __init__(self, cipher, mode, block_size, iv=None):
+        self._cipher = cipher
+        self._encryptor = None
+        self._decryptor = None
+        self.mode = mode
+        self.block_size = block_size
+        self.IV = iv
+
+    def _check_alignment(self, data):
+        if self.mode is not None and len(data) % self.block_size != 0:
+            raise ValueError("Input strings must be a multiple of %d in length" % self.block_size)
+
+    def encrypt(self, cleartext):
+        self._check_alignment(cleartext)
+        if self._encryptor is None:
+            self._encryptor = self._cipher.encryptor()
+        return self._encryptor.update(cleartext)
+
+    def decrypt(self, ciphertext):
+        self._check_alignment(ciphertext)
+        if self._decryptor is None:
+            self._decryptor = self._cipher.decryptor()
+        return self._decryptor.update(ciphertext)
+
+
+class CryptographyHMAC(object):
+    """ Implements a pycrypto like interface on top of a cryptography HMAC context
+    """
+
+    def __init__(self, ctx, digest_size):
+        self._ctx = ctx
+        self.digest_size = digest_size
+
+    def update(self, data):
+        self._ctx.update(data)
+
+    def copy(self):
+        return CryptographyHMAC(self._ctx.copy(), self.digest_size)
+
+    def digest(self):
+        # finalize() invalidates the context, pycrypto objects can keep being updated after digest()
+        return self._ctx.copy().finalize()
+
+    def hexdigest(self):
+        return binascii.hexlify(self.digest())
+
+
+class CryptographyBackend(PyCryptoBackend):
+    """ OpenSSL backed symmetric ciphers and HMAC through cryptography
+
+        Algorithms cryptography does not provide (or the linked OpenSSL lacks) are delegated to pycrypto
+    """
+    name = "cryptography"
+    aead_factories = (CryptographyAEAD.new, PyCryptodomeAEAD.new)
+
+    def __init__(self):
+        if CryptoCipher is None:
+            raise ImportError("cryptography is required for the %s crypto backend" % self.name)
+        self.backend = default_backend()
+        self.ciphers = {}
+        for cipher_type, algorithm in ((AES, "AES"), (DES3, "TripleDES"), (ARC4, "ARC4")):
+            algorithm = getattr(crypto_algorithms, algorithm, None)
+            if algorithm is not None:
+                self.ciphers[cipher_type] = algorithm
+        self.modes = {AES.MODE_CBC: crypto_modes.CBC}
+        self.hashes = {MD5: crypto_hashes.MD5, SHA: crypto_hashes.SHA1, SHA256: crypto_hashes.SHA256,
+                       SHA384: crypto_hashes.SHA384}
+
+    def new_cipher(self, cipher_type, key, mode=None, iv=None):
+        if cipher_type not in self.ciphers or (mode is not None and mode not in self.modes):
+            return super(CryptographyBackend, self).new_cipher(cipher_type, key, mode, iv)
+        algorithm = self.ciphers[cipher_type](key)
+        cipher = CryptoCipher(algorithm, None if mode is None else self.modes[mode](iv), self.backend)
+        return CryptographyCipher(cipher, mode, cipher_type.block_size, iv)
+
+    def new_hmac(self, key, hash_type):
+        if hash_type not in self.hashes:
+            return super(CryptographyBackend, self).new_hmac(key, hash_type)
+        algorithm = self.hashes[hash_type]()
+        return CryptographyHMAC(crypto_hmac.HMAC(key, algorithm, self.backend), algorithm.digest_size)
+
+
+CRYPTO_BACKENDS = {PyCryptoBackend.name: PyCryptoBackend, CryptographyBackend.name: CryptographyBackend}
+
+
+def get_crypto_backend(name=PyCryptoBackend.name):
+    """ Returns a symmetric crypto backend instance by name """
+    try:
+        return CRYPTO_BACKENDS[name]()
+    except KeyError:
+        raise ValueError("Unknown crypto backend: %s. Available backends: %s" % (name, ", ".join(CRYPTO_BACKENDS.keys())))
+
+
+def benchmark_crypto_backend(backend, cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, data_len=2**14,
+                             rounds=64):
+    """ Returns the CBC/stream encryption + HMAC throughput of backend for cipher_suite, in bytes per second """
+    import time
+    crypto_param = TLSSecurityParameters.crypto_params[cipher_suite]
+    cipher_type = crypto_param["cipher"]["type"]
+    hash_type = crypto_param["hash"]["type"]
+    block_size = cipher_type.block_size
+    iv = "\x00" * block_size if crypto_param["cipher"]["mode"] is not None else None
+    cipher = backend.new_cipher(cipher_type, "\x00" * crypto_param["cipher"]["key_len"], crypto_param["cipher"]["mode"],
+                                iv)
+    hmac = backend.new_hmac("\x00" * hash_type.digest_size, hash_type)
+    data = os.urandom(data_len - data_len % max(block_size, 1))
+    start = time.time()
+    for _ in range(rounds):
+        mac = hmac.copy()
+        mac.update(data)
+        mac.digest()
+        cipher.encrypt(data)
+    elapsed = time.time() - start
+    return len(data) * rounds / elapsed if elapsed > 0 else float("inf")
+
+
+def select_fastest_crypto_backend(cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, data_len=2**14,
+                                  rounds=64):
+    """ Benchmarks all available crypto backends, and makes the fastest one the default for all new contexts """
+    backends = []
+    for name in CRYPTO_BACKENDS:
+        try:
+            backends.append(get_crypto_backend(name))
+        except ImportError:
+            pass
+    fastest = max(backends, key=lambda backend: benchmark_crypto_backend(backend, cipher_suite, data_len, rounds))
+    TLSSessionCtx.crypto_backend = fastest
+    return fastest
+
+
+class TLSKexKeyPool(object):
+    """ Pool of pre-generated ephemeral client key pairs for DHE groups and named curves
+
+        Groups and curves are registered on first use (or upfront via register_*) and topped up to size
+        by a background refill thread. At most max_groups groups are kept, the least recently used one is
+        dropped to make room for a new one. A key pair is handed out exactly once. An empty pool falls back
+        to synchronous key generation, so a pool never blocks a handshake.
+
+        pool = TLSKexKeyPool(size=32).start()
+        TLSSessionCtx.kex_pool = pool   # all contexts, or tls_ctx.kex_pool = pool for a single one
+
+        EC key pairs are generated through ec_backend, which defaults to the fastest available backend.
+    """
+
+    def __init__(self, size=16, ec_backend=None, max_groups=8):
+        if size <= 0:
+            raise ValueError("Pool size must be strictly positive")
+        if max_groups <= 0:
+            raise ValueError("Group count must be strictly positive")
+        self.size = size
+        self.max_groups = max_groups
+        self.ec_backend = ec_backend or get_ec_backend()
+        self.hits = 0
+        self.misses = 0
+        # (kind, group): deque of key pairs, least recently used first
+        self._pools = OrderedDict()
+        self._lock = threading.Lock()
+        self._refill = threading.Event()
+        self._running = False
+        self._thread = None
+
+    def __repr__(self):
+        return "<TLSKexKeyPool: size=%d groups=%d hits=%d misses=%d>" % (self.size, len(self._pools),
+                                                                        self.hits, self.misses)
+
+    @staticmethod
+    def _generate_dh_keypair(group):
+        p, g = group
+        # Same key space as TLSSessionCtx.get_client_dh_pubkey()
+        a = random.randint(0, 2**256 - 1)
+        return a, pow(g, a, p)
+
+    def _generate_ecdh_keypair(self, curve_name):
+        return self.ec_backend.make_keypair(curve_name)
+
+    def _register(self, key):
+        with self._lock:
+            self._register_locked(key)
+        self._refill.set()
+
+    def _register_locked(self, key):
+        if key in self._pools:
+            self._pools[key] = self._pools.pop(key)
+            return
+        while len(self._pools) >= self.max_groups:
+            self._pools.popitem(last=False)
+        self._pools[key] = deque()
+
+    def register_dh_group(self, p, g):
+        self._register(("dh", (p, g)))
+
+    def register_curve(self, curve_name):
+        # Raises ValueError early for curves tinyec does not know about
+        ec_reg.get_curve(curve_name)
+        self._register(("ecdh", curve_name))
+
+    def _get(self, key, generator):
+        with self._lock:
+            self._register_locked(key)
+            pool = self._pools[key]
+            keypair = pool.popleft() if pool else None
+            if keypair is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        self._refill.set()
+        if keypair is None:
+            return generator(key[1])
+        return keypair
+
+    def get_dh_keypair(self, p, g):
+        """ Returns a (private exponent, public value) tuple for group (p, g) """
+        return self._get(("dh", (p, g)), self._generate_dh_keypair)
+
+    def get_ecdh_keypair(self, curve_name):
+        """ Returns a tinyec Keypair on the named curve """
+        return self._get(("ecdh", curve_name), self._generate_ecdh_keypair)
+
+    def fill(self):
+        """ Tops up all registered pools synchronously """
+        generators = {"dh": self._generate_dh_keypair, "ecdh": self._generate_ecdh_keypair}
+        with self._lock:
+            keys = list(self._pools.keys())
+        for key in keys:
+            while True:
+                with self._lock:
+                    # Dropped while refilling
+                    if key not in self._pools or len(self._pools[key]) >= self.size:
+                        break
+                keypair = generators[key[0]](key[1])
+                with self._lock:
+                    if key in self._pools:
+                        self._pools[key].append(keypair)
+
+    def _refill_loop(self):
+        while self._running:
+            self._refill.wait()
+            self._refill.clear()
+            if self._running:
+                self.fill()
+
+    def start(self):
+        if self._thread is None:
+            self._running = True
+            self._thread = threading.Thread(target=self._refill_loop, name="TLSKexKeyPool")
+            self._thread.daemon = True
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        self._refill.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+CachedSession = namedtuple("CachedSession", ["version", "cipher_suite", "compression", "master_secret", "expires"])
+
+
+class TLSSessionCache(object):
+    """ Resumable sessions, keyed by session ID and by session ticket (RFC 5246 section 7.3, RFC 5077)
+
+        A context holding a cache records every session it completes, once both Finished messages were seen. It
+        resumes sessions offered in a ClientHello and accepted by the ServerHello (abbreviated handshake). hits
+        and misses count lookups of offered session IDs and tickets.
+
+        cache = TLSSessionCache()
+        TLSSessionCtx.session_cache = cache   # all contexts, or tls_ctx.session_cache = cache for a single one
+    """
+
+    def __init__(self, size=1024, lifetime=7200):
+        self.lifetime = lifetime
+        self.hits = 0
+        self.misses = 0
+        self._sessions = LRUCache(size)
+
+    def __repr__(self):
+        return "<TLSSessionCache: sessions=%d hits=%d misses=%d>" % (len(self), self.hits, self.misses)
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def __deepcopy__(self, memo):
+        # Contexts copied by TLSSocket.accept() keep sharing the cache
+        return self
+
+    def store(self, tls_ctx):
+        """ Records the session of tls_ctx under its session ID and session ticket, if any """
+        if tls_ctx.crypto.session.master_secret is None or tls_ctx.params.handshake.server is None:
+            return
+        session = CachedSession(tls_ctx.params.negotiated.version, tls_ctx.params.negotiated.ciphersuite,
+                                tls_ctx.params.negotiated.compression, tls_ctx.crypto.session.master_secret,
+                                time.time() + self.lifetime)
+        session_id = tls_ctx.params.handshake.server.session_id
+        if session_id:
+            self._sessions.put(("session_id", session_id), session)
+        if tls_ctx.crypto.session.ticket:
+            self._sessions.put(("ticket", tls_ctx.crypto.session.ticket), session)
+
+    def lookup(self, session_id=None, ticket=None):
+        """ Returns the CachedSession for ticket, or else session_id. None if unknown or expired """
+        session = None
+        if ticket:
+            session = self._sessions.get(("ticket", ticket))
+        if session is None and session_id:
+            session = self._sessions.get(("session_id", session_id))
+        if session is not None and session.expires < time.time():
+            session = None
+        if session is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return session
+
+    def clear(self):
+        self._sessions.clear()
+        self.hits = 0
+        self.misses = 0
+
+
+class TLSKeyLog(object):
+    """ Index of the CLIENT_RANDOM entries of an NSS key log file (SSLKEYLOGFILE)
+
+        The file is memory mapped. Only the offset of each master secret is kept in memory, keyed by client random,
+        so multi-GB key logs can be indexed. Later entries for the same client random win. refresh() indexes lines
+        appended since the last scan, and rebuilds the index when the file was truncated or replaced (rotation).
+
+        keylog = TLSKeyLog("/tmp/sslkeylog.txt")
+        TLSSessionCtx.keylog = keylog   # all contexts, or tls_ctx.keylog = keylog for a single one
+    """
+    REX_CLIENT_RANDOM = re.compile(r"^CLIENT_RANDOM ([0-9a-fA-F]{64}) ([0-9a-fA-F]{96})[ \t]*\r?$", re.MULTILINE)
+    MASTER_SECRET_HEX_LEN = 96
+
+    def __init__(self, path):
+        self.path = path
+        self._index = {}
+        self._map = None
+        self._indexed = 0
+        # (st_dev, st_ino) of the indexed file
+        self._file_id = None
+        self.refresh()
+
+    def __repr__(self):
+        return "<TLSKeyLog: %s entries=%d>" % (self.path, len(self))
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, client_random):
+        return client_random in self._index
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def refresh(self):
+        """ Indexes complete lines added to the key log since the last call. Starts over if the file shrank or was
+            replaced
+        """
+        with open(self.path, "rb") as f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            file_id = (stat.st_dev, stat.st_ino)
+            if file_id != self._file_id or size < self._indexed:
+                self.close()
+                self._file_id = file_id
+            if size == 0 or size == self._indexed:
+                return
+            map_ = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        for match in self.REX_CLIENT_RANDOM.finditer(map_, self._indexed, size):
+            self._index[binascii.unhexlify(match.group(1))] = match.start(2)
+        # A truncated last line does not match. It is scanned again on the next refresh
+        end = map_.rfind("\n", self._indexed) + 1 or self._indexed
+        if self._map is not None:
+            self._map.close()
+        self._map = map_
+        self._indexed = end
+
+    def get_master_secret(self, client_random):
+        """ Returns the 48 bytes master secret logged for client_random, or None """
+        offset = self._index.get(client_random)
+        if offset is None:
+            return None
+        return binascii.unhexlify(self._map[offset:offset + self.MASTER_SECRET_HEX_LEN])
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+        self._index = {}
+        self._indexed = 0
+        self._file_id = None
+
+
+# Live TLSKeyLogWriters, flushed at exit
+_KEYLOG_WRITERS = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_keylog_writers():
+    for writer in list(_KEYLOG_WRITERS):
+        writer.flush()
+
+
+class TLSKeyLogWriter(object):
+    """ Appends CLIENT_RANDOM lines in NSS key log format (SSLKEYLOGFILE) for sessions set up by contexts
+
+        Lines are buffered and written in batches of batch_size lines, or by a timer flush_interval seconds after
+        the first pending line was buffered. Each batch is a single append, made under an exclusive file lock where
+        fcntl is available, so threads and processes can share a key log. Pending lines are flushed at exit.
+
+        writer = TLSKeyLogWriter("/tmp/sslkeylog.txt")
+        TLSSessionCtx.keylog_writer = writer   # all contexts, or tls_ctx.keylog_writer = writer for a single one
+    """
+
+    def __init__(self, path, batch_size=64, flush_interval=1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.written = 0
+        self._lines = []
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._timer = None
+        _KEYLOG_WRITERS.add(self)
+
+    def __repr__(self):
+        return "<TLSKeyLogWriter: %s written=%d pending=%d>" % (self.path, self.written, len(self._lines))
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def _check_fork(self):
+        # A forked child inherits the parent's pending lines, which the parent flushes itself
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._lock = threading.Lock()
+            self._lines = []
+            self._timer = None
+
+    def write(self, client_random, master_secret):
+        self._check_fork()
+        line = "CLIENT_RANDOM %s %s\n" % (binascii.hexlify(client_random), binascii.hexlify(master_secret))
+        with self._lock:
+            self._lines.append(line)
+            if len(self._lines) < self.batch_size:
+                if self._timer is None:
+                    self._timer = threading.Timer(self.flush_interval, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+            lines, self._lines = self._lines, []
+            self._write(lines)
+
+    def flush(self):
+        self._check_fork()
+        with self._lock:
+            lines, self._lines = self._lines, []
+            self._write(lines)
+
+    def _write(self, lines):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not lines:
+            return
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o600)
+        try:
+            if fcntl is not None:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+            data = "".join(lines)
+            while data:
+                data = data[os.write(fd, data):]
+        finally:
+            os.close(fd)
+        self.written += len(lines)
+
+
+class TLSRSAKeyStore(object):
+    """ Process wide store of RSA private keys, indexed by a SHA256 fingerprint of the public modulus
+
+        Keys are imported once. Contexts holding a store pick the private key matching the server certificate
+        as soon as the TLSCertificateList is seen.
+
+        key_store = TLSRSAKeyStore()
+        key_store.load_directory("/etc/ssl/private")
+        TLSSessionCtx.rsa_key_store = key_store   # all contexts, or tls_ctx.rsa_key_store = key_store for a single one
+    """
+
+    def __init__(self):
+        self._keys = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<TLSRSAKeyStore: keys=%d>" % len(self)
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, pub_key):
+        return self.fingerprint(pub_key) in self._keys
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @staticmethod
+    def fingerprint(pub_key):
+        return SHA256.new(int_to_str(pub_key.n)).digest()
+
+    def add_key(self, priv_key):
+        """ Adds a PEM or DER encoded key, or an RSA key object. Returns the fingerprint """
+        if not hasattr(priv_key, "publickey"):
+            priv_key = RSA.importKey(priv_key)
+        if not priv_key.has_private():
+            raise ValueError("Not an RSA private key")
+        fingerprint = self.fingerprint(priv_key)
+        with self._lock:
+            self._keys[fingerprint] = (priv_key, priv_key.publickey())
+        return fingerprint
+
+    def load_file(self, path):
+        """ Adds all private keys found in a PEM file. Returns the number of keys added """
+        with open(path, "r") as f:
+            data = f.read()
+        loaded = 0
+        for full, pemtype, _ in REX_PEM.findall(data):
+            if "PRIVATE" in pemtype.upper():
+                try:
+                    self.add_key(full)
+                    loaded += 1
+                except ValueError:
+                    warnings.warn("Unable to load %s from %s" % (pemtype.strip(), path))
+        return loaded
+
+    def load_directory(self, path, pattern="*.pem"):
+        """ Adds the private keys of all files matching pattern in path. Returns the number of keys added """
+        return sum(self.load_file(key_file) for key_file in sorted(glob.glob(os.path.join(path, pattern))))
+
+    def get_keys(self, pub_key):
+        """ Returns the (private key, public key) tuple matching pub_key, or None """
+        return self._keys.get(self.fingerprint(pub_key))
+
+
+class TLSCertificateStore(object):
+    """ Process wide interning store for certificates, keyed by the SHA256 fingerprint of their DER encoding
+
+        The first occurrence of a certificate is kept. Later occurrences have their dissected X509Cert replaced by
+        the stored one, so contexts and history packets of all sessions share a single DER string and a single
+        X509Cert per distinct certificate. Each add() takes a reference which is dropped by release(). Shared
+        certificates must be treated as immutable.
+
+        certificate_store = TLSCertificateStore()
+        TLSSessionCtx.certificate_store = certificate_store
+        ...
+        tls_ctx.release_certificates()   # when done with a session
+
+        Dissection leaves private copies of the DER in the raw caches of every enclosing layer. detach() drops
+        those so that the shared DER string is the only copy a record retains.
+    """
+
+    def __init__(self):
+        # fingerprint: [der, X509Cert, refcount]
+        self._certificates = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<TLSCertificateStore: certificates=%d, references=%d>" % (
+            len(self), sum(entry[2] for entry in self._certificates.values()))
+
+    def __len__(self):
+        return len(self._certificates)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._certificates
+
+    def __deepcopy__(self, memo):
+        return self
+
+    @staticmethod
+    def fingerprint(der):
+        return SHA256.new(der).digest()
+
+    def add(self, certificate):
+        """ Takes a reference on the DER of a TLSCertificate and points it at the shared X509Cert.
+            Returns the fingerprint
+        """
+        der = str(certificate.data)
+        fingerprint = self.fingerprint(der)
+        with self._lock:
+            entry = self._certificates.get(fingerprint)
+            if entry is None:
+                entry = self._certificates[fingerprint] = [der, certificate.data, 0]
+                # original is the dissected copy of the DER. Keep the shared string instead
+                certificate.data.original = der
+            entry[2] += 1
+        if certificate.data is not entry[1]:
+            certificate.data = entry[1]
+        return fingerprint
+
+    @staticmethod
+    def detach(record):
+        """ Drops the raw bytes cached by the layers of a record enclosing its certificates, down to the
+            TLSCertificate layers. These are rebuilt from their fields when needed
+        """
+        layers = []
+        layer = record
+        while not isinstance(layer, NoPayload):
+            layers.append(layer)
+            if isinstance(layer, tls.TLSCertificateList):
+                layers.extend(layer.certificates)
+                break
+            layer = layer.payload
+        for layer in layers:
+            layer.original = None
+            layer.raw_packet_cache = None
+            layer.raw_packet_cache_fields = None
+
+    def release(self, fingerprint):
+        """ Drops a reference. The certificate is removed from the store once unreferenced """
+        with self._lock:
+            entry = self._certificates[fingerprint]
+            entry[2] -= 1
+            if entry[2] <= 0:
+                del self._certificates[fingerprint]
+
+    def refcount(self, fingerprint):
+        entry = self._certificates.get(fingerprint)
+        return 0 if entry is None else entry[2]
+
+    def get_der(self, fingerprint):
+        """ Returns the shared DER string of a certificate, or None """
+        entry = self._certificates.get(fingerprint)
+        return None if entry is None else entry[0]
+
+    def get_certificate(self, fingerprint):
+        """ Returns the shared X509Cert of a certificate, or None """
+        entry = self._certificates.get(fingerprint)
+        return None if entry is None else entry[1]
+
+
 class TLSSessionCtx(object):
+    # Optional TLSKexKeyPool used for ephemeral client key pairs. Set on the class to share it across contexts
+    kex_pool = None
+    # Optional TLSSessionCache enabling session resumption. Set on the class to share it across contexts
+    session_cache = None
+    # Optional TLSKeyLog providing master secrets by client random. Set on the class to share it across contexts
+    keylog = None
+    # Optional TLSKeyLogWriter recording master secrets of new sessions. Set on the class to share it across contexts
+    keylog_writer = None
+    # Optional TLSRSAKeyStore providing server private keys. Set on the class to share it across contexts
+    rsa_key_store = None
+    # Optional TLSCertificateStore interning certificates. Set on the class to share it across contexts
+    certificate_store = None
+    # Optional mapping of RSA encrypted to decrypted premaster secret. See decrypt_premaster_secrets()
+    rsa_premaster_secrets = None
+    # Elliptic curve arithmetic backend used for ECDHE. See get_ec_backend()
+    ec_backend = get_ec_backend()
+    # Symmetric cipher and HMAC backend used for record protection. See get_crypto_backend()
+    crypto_backend = PyCryptoBackend()
 
     def __init__(self, client=True):
         self.client = client
@@ -124,6 +1307,7 @@ class TLSSessionCtx(object):
         self.packets = namedtuple('packets',['history','client','server'])
         self.packets.history=[]         #packet history
         self.sec_params = None
+        self.session_keys = None
         self.packets.client = namedtuple('client',['sequence'])
         self.packets.client.sequence=0
         self.packets.server = namedtuple('server',['sequence'])
@@ -134,6 +1318,11 @@ class TLSSessionCtx(object):
         self.params.handshake = namedtuple('handshake',['client','server'])
         self.params.handshake.client=None
         self.params.handshake.server=None
+        # Fingerprints of the certificates interned in certificate_store, in order of appearance
+        self.params.handshake.certificates = []
+        # ChangeCipherSpec and Finished messages seen. A Finished is the first handshake record following a CCS
+        self.params.handshake.change_cipher_specs = 0
+        self.params.handshake.finished = 0
         self.params.negotiated = namedtuple('negotiated', ['ciphersuite',
                                                             'key_exchange',
                                                             'encryption',
@@ -151,6 +1340,7 @@ class TLSSessionCtx(object):
         self.params.negotiated.compression_algo = None
         self.params.negotiated.version = None
         self.params.negotiated.sig = None
+        self.params.negotiated.resumed = False
         self.compression = namedtuple("compression", ["method"])
         self.compression.method = None
         self.crypto = namedtuple('crypto', ['client','server'])
@@ -199,6 +1389,11 @@ class TLSSessionCtx(object):
         self.crypto.session.premaster_secret = None
         self.crypto.session.master_secret = None
         self.crypto.session.prf = None
+        self.crypto.session.ticket = None
+        # Master secret found in the key log for the client random
+        self.crypto.session.keylog_master_secret = None
+        # CachedSession matching the session ID or ticket offered by the client
+        self.crypto.session.resumption = None
         self.crypto.session.randombytes = namedtuple('randombytes',['client','server'])
         self.crypto.session.randombytes.client = None
         self.crypto.session.randombytes.server = None
@@ -364,6 +1559,8 @@ class TLSSessionCtx(object):
         '''
         fill context
         '''
+        if p.haslayer(tls.TLSRecord):
+            self._track_finished(p[tls.TLSRecord].content_type)
         if p.haslayer(tls.TLSHandshake):
             # requires handshake messages
             if p.haslayer(tls.TLSClientHello):
@@ -377,6 +1574,13 @@ class TLSSessionCtx(object):
                     # Generate a random PMS. Overriden at decryption time if private key is provided
                     if self.crypto.session.premaster_secret is None:
                         self.crypto.session.premaster_secret = self._generate_random_pms(self.params.negotiated.version)
+                    session_id = p[tls.TLSClientHello].session_id
+                    ticket = self.get_offered_session_ticket()
+                    if self.session_cache is not None and (session_id or ticket):
+                        self.crypto.session.resumption = self.session_cache.lookup(session_id, ticket)
+                    if self.keylog is not None:
+                        self.crypto.session.keylog_master_secret = self.keylog.get_master_secret(
+                            self.crypto.session.randombytes.client)
             if p.haslayer(tls.TLSServerHello):
                 if not self.params.handshake.server:
                     self.params.handshake.server = p[tls.TLSServerHello]
@@ -403,16 +1607,39 @@ class TLSSessionCtx(object):
                                                          TLSSecurityParameters.crypto_params[self.params.negotiated.ciphersuite]["cipher"]["key_len"],
                                                          TLSSecurityParameters.crypto_params[self.params.negotiated.ciphersuite]["cipher"]["mode_name"])
                         self.params.negotiated.mac = TLSSecurityParameters.crypto_params[self.params.negotiated.ciphersuite]["hash"]["name"]
+                        self.crypto.session.prf = TLSPRF.for_cipher_suite(self.params.negotiated.version,
+                                                                          self.params.negotiated.ciphersuite)
                     except KeyError:
                         warnings.warn("Cipher 0x%04x not supported. Crypto operations will fail" %
                                       self.params.negotiated.ciphersuite)
+                    else:
+                        self._resume_session(p[tls.TLSServerHello])
+                        # Key exchange is irrelevant when the master secret is known. This covers (EC)DHE and resumption
+                        if not self.params.negotiated.resumed and self.crypto.session.keylog_master_secret is not None:
+                            self._init_sec_params(master_secret=self.crypto.session.keylog_master_secret)
+
+            if p.haslayer(tls.TLSSessionTicket):
+                self.crypto.session.ticket = p[tls.TLSSessionTicket].ticket
 
             if p.haslayer(tls.TLSCertificateList):
+                certificates = p[tls.TLSCertificateList].certificates
+                fingerprints = []
+                if self.certificate_store is not None:
+                    fingerprints = [self.certificate_store.add(certificate) for certificate in certificates]
+                    self.params.handshake.certificates.extend(fingerprints)
+                    self.certificate_store.detach(p)
                 # TODO: Probably don't want to do that if rsa_load_priv*() is called
                 if self.params.negotiated.key_exchange is not None and (self.params.negotiated.key_exchange == tls.TLSKexNames.RSA or self.params.negotiated.sig == RSA):
                     # fetch server pubkey // PKCS1_v1_5
-                    cert = p[tls.TLSCertificateList].certificates[0].data
-                    self.crypto.server.rsa.pubkey = x509_extract_pubkey_from_der(str(cert))
+                    if fingerprints:
+                        cert = self.certificate_store.get_der(fingerprints[0])
+                    else:
+                        cert = str(certificates[0].data)
+                    self.crypto.server.rsa.pubkey = x509_extract_pubkey_from_der(cert)
+                    if self.rsa_key_store is not None and self.crypto.server.rsa.privkey is None:
+                        keys = self.rsa_key_store.get_keys(self.crypto.server.rsa.pubkey)
+                        if keys is not None:
+                            self.crypto.server.rsa.privkey = keys[0]
                     # TODO: In the future also handle kex = DH and extract static DH params from cert
                 elif self.params.negotiated.key_exchange is not None and self.params.negotiated.sig == DSA:
                     # TODO: Handle DSA sig key loading here to allow sig checks
@@ -438,8 +1665,8 @@ class TLSSessionCtx(object):
                         warnings.warn("Unknown elliptic curve. Client KEX calculation is up to you")
                     # We are on a known curve
                     else:
-                        # TODO: DO not assume uncompressed EC points!
-                        # Uncompressed EC points are recorded in ANSI format => \x04 + x_point + y_point
+                        # EC points are recorded in ANSI format => \x04 + x_point + y_point, or
+                        # \x02/\x03 + x_point when compressed
                         ansi_ec_point_str = p[tls.TLSServerECDHParams].p
                         try:
                             ec_curve = ec_reg.get_curve(self.crypto.server.ecdh.curve_name)
@@ -451,30 +1678,113 @@ class TLSSessionCtx(object):
             if p.haslayer(tls.TLSClientKeyExchange):
                 if p.haslayer(tls.TLSClientRSAParams):
                     self.crypto.session.encrypted_premaster_secret = p[tls.TLSClientRSAParams].data
+                    premaster_secret = None
+                    if self.rsa_premaster_secrets is not None:
+                        premaster_secret = self.rsa_premaster_secrets.get(self.crypto.session.encrypted_premaster_secret)
+                    if premaster_secret is not None:
+                        self.crypto.session.premaster_secret = premaster_secret
                     # If we have the private key, let's decrypt the PMS
-                    if self.crypto.server.rsa.privkey is not None:
-                        self.crypto.session.premaster_secret = PKCS1_v1_5.new(self.crypto.server.rsa.privkey).decrypt(
-                            self.crypto.session.encrypted_premaster_secret, None)
+                    elif self.crypto.server.rsa.privkey is not None:
+                        self.crypto.session.premaster_secret = rsa_decrypt_pms(
+                            self.crypto.server.rsa.privkey, self.crypto.session.encrypted_premaster_secret)
                 elif p.haslayer(tls.TLSClientDHParams):
                     self.crypto.client.dh.y_c = p[tls.TLSClientDHParams].data
                 elif p.haslayer(tls.TLSClientECDHParams):
                     ec_curve = ec_reg.get_curve(self.crypto.server.ecdh.curve_name)
                     self.crypto.client.ecdh.pub = str_to_ec_point(p[tls.TLSClientECDHParams].data, ec_curve)
 
-                explicit_iv = True if self.params.negotiated.version > tls.TLSVersion.TLS_1_0 else False
-                self.sec_params = TLSSecurityParameters(self.crypto.session.prf,
-                                                        self.params.negotiated.ciphersuite,
-                                                        self.crypto.session.premaster_secret,
-                                                        self.crypto.session.randombytes.client,
-                                                        self.crypto.session.randombytes.server,
-                                                        explicit_iv)
-                self._assign_crypto_material(self.sec_params)
+                session_keys = self.session_keys
+                if session_keys is not None and session_keys.client_random == self.crypto.session.randombytes.client:
+                    self._init_sec_params(session_keys.master_secret, session_keys.key_block)
+                elif self.crypto.session.keylog_master_secret is None:
+                    self._init_sec_params()
+
+    def get_offered_session_ticket(self):
+        """ Returns the session ticket sent in the ClientHello. "" if an empty ticket was sent, None if none was
+        """
+        client_hello = self.params.handshake.client
+        if client_hello is not None:
+            for extension in client_hello.extensions or []:
+                if extension.type == tls.TLSExtensionType.SESSIONTICKET_TLS:
+                    # An empty extension is dissected without payload
+                    if extension.haslayer(tls.TLSExtSessionTicketTLS):
+                        return extension[tls.TLSExtSessionTicketTLS].data
+                    return ""
+        return None
+
+    def release_certificates(self):
+        """ Drops the references this context holds in certificate_store
+        """
+        for fingerprint in self.params.handshake.certificates:
+            self.certificate_store.release(fingerprint)
+        self.params.handshake.certificates = []
+
+    def _resume_session(self, server_hello):
+        # The server accepts resumption by echoing the session ID offered by the client (RFC 5077 section 3.4)
+        session = self.crypto.session.resumption
+        client_hello = self.params.handshake.client
+        if session is None or not server_hello.session_id or server_hello.session_id != client_hello.session_id:
+            return
+        if session.cipher_suite != server_hello.cipher_suite or session.version != server_hello.version:
+            warnings.warn("Resumed session does not match cached cipher suite or version. Keys are not derived")
+            return
+        self.params.negotiated.resumed = True
+        self._init_sec_params(master_secret=session.master_secret)
+
+    def _track_finished(self, content_type):
+        handshake = self.params.handshake
+        if content_type == tls.TLSContentType.CHANGE_CIPHER_SPEC:
+            handshake.change_cipher_specs += 1
+        elif content_type == tls.TLSContentType.HANDSHAKE and handshake.finished < handshake.change_cipher_specs:
+            handshake.finished += 1
+            # Only sessions both peers completed are offered for resumption
+            if handshake.finished == 2:
+                self._cache_session()
+
+    def _cache_session(self):
+        if self.session_cache is not None and not self.params.negotiated.resumed:
+            self.session_cache.store(self)
+
+    def _init_sec_params(self, master_secret=None, key_block=None):
+        explicit_iv = True if self.params.negotiated.version > tls.TLSVersion.TLS_1_0 else False
+        self.sec_params = TLSSecurityParameters(self.crypto.session.prf,
+                                                self.params.negotiated.ciphersuite,
+                                                self.crypto.session.premaster_secret,
+                                                self.crypto.session.randombytes.client,
+                                                self.crypto.session.randombytes.server,
+                                                explicit_iv,
+                                                backend=self.crypto_backend,
+                                                master_secret=master_secret,
+                                                key_block=key_block)
+        self._assign_crypto_material(self.sec_params)
+
+    def load_session_keys(self, session_keys):
+        """ Installs SessionKeys produced by derive_session_keys(). Record protection is set up right away,
+            and a later ClientKeyExchange for the same client random reuses the keys instead of deriving them
+        """
+        self.session_keys = session_keys
+        self.params.negotiated.version = session_keys.tls_version
+        self.params.negotiated.ciphersuite = session_keys.cipher_suite
+        self.crypto.session.randombytes.client = session_keys.client_random
+        self.crypto.session.randombytes.server = session_keys.server_random
+        self.crypto.session.prf = TLSPRF.for_cipher_suite(session_keys.tls_version, session_keys.cipher_suite)
+        if self.params.negotiated.compression is None:
+            # Assume no compression until a ServerHello says otherwise
+            self.params.negotiated.compression = tls.TLSCompressionMethod.NULL
+            self.params.negotiated.compression_algo = TLSCompressionParameters.comp_params[tls.TLSCompressionMethod.NULL]["name"]
+            self.compression.method = TLSCompressionParameters.comp_params[tls.TLSCompressionMethod.NULL]["type"]
+        self._init_sec_params(session_keys.master_secret, session_keys.key_block)
 
     def _assign_crypto_material(self, sec_params):
-        self.crypto.session.key.length.mac = sec_params.negotiated_crypto_param["hash"]["type"].digest_size
+        self.crypto.session.key.length.mac = sec_params.mac_key_length
         self.crypto.session.key.length.encryption = sec_params.negotiated_crypto_param["cipher"]["key_len"]
-        self.crypto.session.key.length.iv = sec_params.negotiated_crypto_param["cipher"]["type"].block_size
+        if sec_params.aead:
+            self.crypto.session.key.length.iv = sec_params.iv_length
+        else:
+            self.crypto.session.key.length.iv = sec_params.negotiated_crypto_param["cipher"]["type"].block_size
 
+        if self.keylog_writer is not None and self.crypto.session.master_secret != sec_params.master_secret:
+            self.keylog_writer.write(sec_params.client_random, sec_params.master_secret)
         self.crypto.session.master_secret = sec_params.master_secret
 
         self.crypto.session.key.server.mac = sec_params.server_write_MAC_key
@@ -534,7 +1844,6 @@ class TLSSessionCtx(object):
     def get_client_dh_pubkey(self, priv_key=None):
         # ValueError is propagated to caller both if hex or int conversion fail
         import math
-        import random
         str_to_int = lambda x: int(binascii.hexlify(x), 16)
         nb_bits = lambda x: int(math.ceil(math.log(x) / math.log(2)))
         p = str_to_int(self.crypto.server.dh.p)
@@ -544,9 +1853,13 @@ class TLSSessionCtx(object):
         # Long story short, this provides 128bits of key space (sqrt(2**256)). TLS leaves this up to the implementation.
         # Another option is to gather random.randint(0, 2**nb_bits(p) - 1), but has little added security
         # In our case, since we don't care about security, it really doesn't matter what we pick
-        a = priv_key or random.randint(0, 2**256 - 1)
+        if priv_key is None and self.kex_pool is not None:
+            a, y_c = self.kex_pool.get_dh_keypair(p, g)
+        else:
+            a = priv_key or random.randint(0, 2**256 - 1)
+            y_c = pow(g, a, p)
         self.crypto.client.dh.x = int_to_str(a)
-        self.crypto.client.dh.y_c = int_to_str(pow(g, a, p))
+        self.crypto.client.dh.y_c = int_to_str(y_c)
         # Per RFC 4346 section 8.1.2
         # Leading bytes of Z that contain all zero bits are stripped before it is used as the
         # pre_master_secret.
@@ -554,19 +1867,21 @@ class TLSSessionCtx(object):
         return self.crypto.client.dh.y_c
 
     def get_client_ecdh_pubkey(self, priv_key=None):
+        curve_name = self.crypto.server.ecdh.curve_name
         # Will raise ValueError for unknown curves
-        ec_curve = ec_reg.get_curve(self.crypto.server.ecdh.curve_name)
-        server_keypair = ec.Keypair(ec_curve, pub=self.crypto.server.ecdh.pub)
-        if priv_key is None:
-            client_keypair = ec.make_keypair(ec_curve)
+        ec_reg.get_curve(curve_name)
+        if priv_key is None and self.kex_pool is not None:
+            client_keypair = self.kex_pool.get_ecdh_keypair(curve_name)
+        elif priv_key is None:
+            client_keypair = self.ec_backend.make_keypair(curve_name)
         else:
-            client_keypair = ec.Keypair(ec_curve, priv_key)
+            client_keypair = self.ec_backend.load_keypair(curve_name, priv_key)
         self.crypto.client.ecdh.priv = int_to_str(client_keypair.priv)
         self.crypto.client.ecdh.pub = client_keypair.pub
-        secret_point = ec.ECDH(client_keypair).get_secret(server_keypair)
         # PMS is x coordinate of secret
-        self.crypto.session.premaster_secret = int_to_str(secret_point.x)
-        return "\x04%s%s" % (int_to_str(client_keypair.pub.x), int_to_str(client_keypair.pub.y))
+        self.crypto.session.premaster_secret = self.ec_backend.get_secret(curve_name, client_keypair.priv,
+                                                                          self.crypto.server.ecdh.pub)
+        return ec_point_to_str(client_keypair.pub)
 
     def get_client_kex_data(self, val=None):
         if self.params.negotiated.key_exchange == tls.TLSKexNames.RSA:
@@ -603,7 +1918,7 @@ class TLSSessionCtx(object):
 
         if self.params.negotiated.version == tls.TLSVersion.TLS_1_2:
             prf_verify_data = self.crypto.session.prf.get_bytes(self.crypto.session.master_secret, label,
-                                                                SHA256.new("".join(verify_data)).digest(),
+                                                                self.crypto.session.prf.digest.new("".join(verify_data)).digest(),
                                                                 num_bytes=12)
         else:
             prf_verify_data = self.crypto.session.prf.get_bytes(self.crypto.session.master_secret, label,
@@ -640,14 +1955,41 @@ class TLSPRF(object):
     TLS_MD_IV_BLOCK_CONST = "IV block"
     TLS_MD_MASTER_SECRET_CONST = "master secret"
 
-    def __init__(self, tls_version):
+    def __init__(self, tls_version, digest=SHA256, cache=None):
+        """ digest is only used by the TLS 1.2 PRF. Earlier versions always combine MD5 and SHA1
+        cache is an optional LRUCache shared between PRF instances. Derived bytes are then kept in memory
+        """
         if tls_version not in tls.TLS_VERSIONS.keys():
             raise ValueError("Unknown TLS version: %d" % tls_version)
         self.tls_version = tls_version
+        self.digest = digest
+        self.cache = cache
+
+    @classmethod
+    def for_cipher_suite(cls, tls_version, cipher_suite, cache=None):
+        """ TLS 1.2 PRF uses SHA256, unless the cipher suite mandates a stronger hash (RFC 5246 section 5)
+        """
+        try:
+            hash_type = TLSSecurityParameters.crypto_params[cipher_suite]["hash"]["type"]
+        except KeyError:
+            hash_type = None
+        if tls_version == tls.TLSVersion.TLS_1_2 and hash_type is SHA384:
+            return cls(tls_version, digest=SHA384, cache=cache)
+        return cls(tls_version, cache=cache)
 
     def get_bytes(self, key, label, random, num_bytes):
+        if self.cache is not None:
+            cache_key = (self.tls_version, self.digest, key, label, random, num_bytes)
+            bytes_ = self.cache.get(cache_key)
+            if bytes_ is None:
+                bytes_ = self._prf(key, label, random, num_bytes)
+                self.cache.put(cache_key, bytes_)
+            return bytes_
+        return self._prf(key, label, random, num_bytes)
+
+    def _prf(self, key, label, random, num_bytes):
         if self.tls_version == tls.TLSVersion.TLS_1_2:
-            bytes_ = self._get_bytes(SHA256, key, label, random, num_bytes)
+            bytes_ = self._get_bytes(self.digest, key, label, random, num_bytes)
         else:
             key_len = (len(key) + 1) // 2
             key_left = key[:key_len]
@@ -658,19 +2000,28 @@ class TLSPRF(object):
             # Get bytes from SHA1
             sha1_bytes = self._get_bytes(SHA, key_right, label, random, num_bytes)
 
-            xored = []
-            for i in range(num_bytes):
-                xored.append(chr(ord(md5_bytes[i]) ^ ord(sha1_bytes[i])))
-            bytes_ = "".join(xored)
+            bytes_ = str_xor(md5_bytes, sha1_bytes)
         return bytes_
 
     def _get_bytes(self, digest, key, label, random, num_bytes):
-        bytes_ = ""
-        block = HMAC.new(key=key, msg="%s%s" % (label, random), digestmod=digest).digest()
-        while len(bytes_) < num_bytes:
-            bytes_ += HMAC.new(key=key, msg="%s%s%s" % (block, label, random), digestmod=digest).digest()
-            block = HMAC.new(key=key, msg=block, digestmod=digest).digest()
-        return bytes_[:num_bytes]
+        # Run the HMAC key schedule once, then copy the keyed state for every P_hash step
+        keyed_hmac = HMAC.new(key=key, digestmod=digest)
+        seed = "%s%s" % (label, random)
+        chunks = []
+        output_len = 0
+        block = self._hmac(keyed_hmac, seed)
+        while output_len < num_bytes:
+            chunk = self._hmac(keyed_hmac, "%s%s" % (block, seed))
+            chunks.append(chunk)
+            output_len += len(chunk)
+            block = self._hmac(keyed_hmac, block)
+        return "".join(chunks)[:num_bytes]
+
+    @staticmethod
+    def _hmac(keyed_hmac, msg):
+        hmac = keyed_hmac.copy()
+        hmac.update(msg)
+        return hmac.digest()
 
 
 class CryptoContainer(object):
@@ -679,6 +2030,7 @@ class CryptoContainer(object):
         if tls_ctx is None:
             raise ValueError("Valid TLS session context required")
         self.tls_ctx = tls_ctx
+        self.aead = self.tls_ctx.sec_params.aead
         is_cbc = self.tls_ctx.sec_params.negotiated_crypto_param["cipher"]["mode"] != None
         if self.tls_ctx.params.negotiated.version > tls.TLSVersion.TLS_1_0 and is_cbc:
             self.explicit_iv = os.urandom(self.tls_ctx.crypto.session.key.length.iv)
@@ -699,6 +2051,11 @@ class CryptoContainer(object):
             self.enc_cipher = tls_ctx.crypto.server.enc
             self.seq_number = tls_ctx.crypto.session.key.server.seq_num
             self.tls_ctx.crypto.session.key.server.seq_num += 1
+        # AEAD ciphers authenticate the record themselves. Explicit nonce and tag are added on encryption
+        if self.aead:
+            self.mac = ""
+            self.padding = ""
+            return
         # CBC mode
         self.hmac()
         if is_cbc:
@@ -735,6 +2092,8 @@ class CryptoContainer(object):
     def encrypt(self, data=None):
         """ If data is passed in, caller is responsible for block alignment
         """
+        if self.aead:
+            return self.enc_cipher.encrypt(data or str(self), self.content_type, self.version, self.seq_number)
         return self.enc_cipher.encrypt(data or str(self))
 
 class NullCipher(object):
@@ -781,6 +2140,81 @@ class NullHash(object):
         return copy.deepcopy(self)
 
 
+class AEADCipher(object):
+    """ Record level AEAD cipher (RFC 5246 section 6.2.3.3) on top of an AEAD primitive.
+
+        Implements a pycrypto like interface, but since nonce and additional data depend on the record,
+        encrypt/decrypt also take the record content type and version. The sequence number is tracked
+        per instance unless explicitly passed in. Ciphertexts are explicit nonce + encrypted data + tag.
+    """
+
+    block_size = 1
+    fixed_iv_length = 0
+    record_iv_length = 0
+    tag_length = 16
+
+    def __init__(self, aead, fixed_iv, seq_num=0):
+        self.aead = aead
+        self.fixed_iv = fixed_iv
+        self.seq_num = seq_num
+
+    def get_explicit_nonce(self, seq_num):
+        return ""
+
+    def get_nonce(self, seq_num, explicit_nonce):
+        # Partially implicit nonce (RFC 5116 section 3.2.1): fixed IV followed by the explicit nonce of the record
+        return "%s%s" % (self.fixed_iv, explicit_nonce)
+
+    @staticmethod
+    def get_additional_data(seq_num, content_type, version, length):
+        return struct.pack("!QBHH", seq_num, content_type, version, length)
+
+    def _next_seq_num(self, seq_num):
+        if seq_num is None:
+            seq_num = self.seq_num
+        self.seq_num = seq_num + 1
+        return seq_num
+
+    def encrypt(self, cleartext, content_type, version, seq_num=None):
+        seq_num = self._next_seq_num(seq_num)
+        explicit_nonce = self.get_explicit_nonce(seq_num)
+        additional_data = self.get_additional_data(seq_num, content_type, version, len(cleartext))
+        return "%s%s" % (explicit_nonce,
+                         self.aead.encrypt(self.get_nonce(seq_num, explicit_nonce), cleartext, additional_data))
+
+    def decrypt(self, ciphertext, content_type, version, seq_num=None):
+        if len(ciphertext) < self.record_iv_length + self.tag_length:
+            raise ValueError("AEAD ciphertext shorter than explicit nonce and tag")
+        seq_num = self._next_seq_num(seq_num)
+        explicit_nonce = ciphertext[:self.record_iv_length]
+        ciphertext = ciphertext[self.record_iv_length:]
+        additional_data = self.get_additional_data(seq_num, content_type, version,
+                                                   len(ciphertext) - self.tag_length)
+        return self.aead.decrypt(self.get_nonce(seq_num, explicit_nonce), ciphertext, additional_data)
+
+
+class AESGCMCipher(AEADCipher):
+    """ AES-GCM, RFC 5288. nonce = 4 bytes implicit salt + 8 bytes explicit nonce, sent with each record
+    """
+
+    fixed_iv_length = 4
+    record_iv_length = 8
+
+    def get_explicit_nonce(self, seq_num):
+        # Any unique value will do. The sequence number is what most implementations use
+        return struct.pack("!Q", seq_num)
+
+
+class ChaCha20Poly1305Cipher(AEADCipher):
+    """ ChaCha20-Poly1305, RFC 7905. nonce = 12 bytes implicit IV xored with the padded sequence number
+    """
+
+    fixed_iv_length = 12
+
+    def get_nonce(self, seq_num, explicit_nonce):
+        return binascii.unhexlify("%024x" % (int(binascii.hexlify(self.fixed_iv), 16) ^ seq_num))
+
+
 class DH(object):
     pass
 
@@ -845,27 +2279,39 @@ class TLSSecurityParameters(object):
             tls.TLSCipherSuite.ECDHE_ECDSA_WITH_AES_128_CBC_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xc023], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":ECDSA}, "cipher":{"type":AES, "name":"AES", "key_len":16, "mode":AES.MODE_CBC, "mode_name":"CBC"}, "hash":{"type":SHA256, "name":"SHA256"}},
             tls.TLSCipherSuite.ECDHE_ECDSA_WITH_AES_256_CBC_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0xc024], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":ECDSA}, "cipher":{"type":AES, "name":"AES", "key_len":32, "mode":AES.MODE_CBC, "mode_name":"CBC"}, "hash":{"type":SHA384, "name":"SHA384"}},
             tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_CBC_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xc027], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":RSA}, "cipher":{"type":AES, "name":"AES", "key_len":16, "mode":AES.MODE_CBC, "mode_name":"CBC"}, "hash":{"type":SHA256, "name":"SHA256"}},
-            tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_256_CBC_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0xc028], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":RSA}, "cipher":{"type":AES, "name":"AES", "key_len":16, "mode":AES.MODE_CBC, "mode_name":"CBC"}, "hash":{"type":SHA384, "name":"SHA384"}},
+            tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_256_CBC_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0xc028], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":RSA}, "cipher":{"type":AES, "name":"AES", "key_len":32, "mode":AES.MODE_CBC, "mode_name":"CBC"}, "hash":{"type":SHA384, "name":"SHA384"}},
+            # AEAD ciphers. Hash is only used by the PRF, records carry no MAC
+            tls.TLSCipherSuite.RSA_WITH_AES_128_GCM_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0x009c], "export":False, "key_exchange":{"type":RSA, "name":tls.TLSKexNames.RSA, "sig":None}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":16, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
+            tls.TLSCipherSuite.RSA_WITH_AES_256_GCM_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0x009d], "export":False, "key_exchange":{"type":RSA, "name":tls.TLSKexNames.RSA, "sig":None}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":32, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA384, "name":"SHA384"}},
+            tls.TLSCipherSuite.DHE_RSA_WITH_AES_128_GCM_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0x009e], "export":False, "key_exchange":{"type":DHE, "name":tls.TLSKexNames.DHE, "sig":RSA}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":16, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
+            tls.TLSCipherSuite.DHE_RSA_WITH_AES_256_GCM_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0x009f], "export":False, "key_exchange":{"type":DHE, "name":tls.TLSKexNames.DHE, "sig":RSA}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":32, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA384, "name":"SHA384"}},
+            tls.TLSCipherSuite.ECDHE_ECDSA_WITH_AES_128_GCM_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xc02b], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":ECDSA}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":16, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
+            tls.TLSCipherSuite.ECDHE_ECDSA_WITH_AES_256_GCM_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0xc02c], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":ECDSA}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":32, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA384, "name":"SHA384"}},
+            tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_GCM_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xc02f], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":RSA}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":16, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
+            tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_256_GCM_SHA384:   {"name":tls.TLS_CIPHER_SUITES[0xc030], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":RSA}, "cipher":{"type":AESGCMCipher, "name":"AES", "key_len":32, "mode":None, "mode_name":"GCM", "aead":True}, "hash":{"type":SHA384, "name":"SHA384"}},
+            tls.TLSCipherSuite.ECDHE_RSA_WITH_CHACHA20_POLY1305_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xcca8], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":RSA}, "cipher":{"type":ChaCha20Poly1305Cipher, "name":"CHACHA20", "key_len":32, "mode":None, "mode_name":"POLY1305", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
+            tls.TLSCipherSuite.ECDHE_ECDSA_WITH_CHACHA20_POLY1305_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xcca9], "export":False, "key_exchange":{"type":ECDHE, "name":tls.TLSKexNames.ECDHE, "sig":ECDSA}, "cipher":{"type":ChaCha20Poly1305Cipher, "name":"CHACHA20", "key_len":32, "mode":None, "mode_name":"POLY1305", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
+            tls.TLSCipherSuite.DHE_RSA_WITH_CHACHA20_POLY1305_SHA256:   {"name":tls.TLS_CIPHER_SUITES[0xccaa], "export":False, "key_exchange":{"type":DHE, "name":tls.TLSKexNames.DHE, "sig":RSA}, "cipher":{"type":ChaCha20Poly1305Cipher, "name":"CHACHA20", "key_len":32, "mode":None, "mode_name":"POLY1305", "aead":True}, "hash":{"type":SHA256, "name":"SHA256"}},
 
             # 0x0087: DHE_DSS_WITH_CAMELLIA_256_CBC_SHA => Camelia support should use camcrypt or the camelia patch for pycrypto
             # 0x0088: DHE_RSA_WITH_CAMELLIA_256_CBC_SHA => Camelia support should use camcrypt or the camelia patch for pycrypto
             }
-# Unsupported for now, until GCM/CCM and SRP are integrated
+# Unsupported for now, until CCM and SRP are integrated
 #         SRP_SHA_RSA_WITH_AES_256_CBC_SHA = 0xc021
 #         SRP_SHA_DSS_WITH_AES_256_CBC_SHA = 0xc022
 #         TLS_FALLBACK_SCSV = 0x5600
-#     0xc02b: 'ECDHE_ECDSA_WITH_AES_128_GCM_SHA256',
-#     0xc02c: 'ECDHE_ECDSA_WITH_AES_256_GCM_SHA384',
-#     0xc02f: 'ECDHE_RSA_WITH_AES_128_GCM_SHA256',
-#     0xc030: 'ECDHE_RSA_WITH_AES_256_GCM_SHA384',
 #     0xc0ac: 'ECDHE_ECDSA_WITH_AES_128_CCM',
 #     0xc0ad: 'ECDHE_ECDSA_WITH_AES_256_CCM',
 #     0xc0ae: 'ECDHE_ECDSA_WITH_AES_128_CCM_8',
 #     0xc0af: 'ECDHE_ECDSA_WITH_AES_256_CCM_8',
 
-    def __init__(self, prf, cipher_suite, pms, client_random, server_random, explicit_iv=False):
+    def __init__(self, prf, cipher_suite, pms, client_random, server_random, explicit_iv=False, backend=None,
+                 master_secret=None, key_block=None):
         """ /!\ This class is not thread safe
+            backend defaults to TLSSessionCtx.crypto_backend
+            master_secret and key_block skip the matching PRF derivation when already known, see derive_session_keys()
         """
+        self.backend = backend or TLSSessionCtx.crypto_backend
         try:
             self.negotiated_crypto_param = self.crypto_params[cipher_suite]
         except KeyError:
@@ -879,14 +2325,34 @@ class TLSSecurityParameters(object):
             if len(server_random) != 32:
                 raise ValueError("Server random must be 32 bytes")
             self.server_random = server_random
-            self.mac_key_length = self.negotiated_crypto_param["hash"]["type"].digest_size
-            self.cipher_key_length = self.negotiated_crypto_param["cipher"]["key_len"]
-            block_size = self.negotiated_crypto_param["cipher"]["type"].block_size
-            # Stream ciphers have a block size of one, but IV should be 0
-            self.iv_length = 0 if block_size == 1 else block_size
+            self.aead = self.negotiated_crypto_param["cipher"].get("aead", False)
+            self.mac_key_length, self.cipher_key_length, self.iv_length = \
+                self._get_key_lengths(self.negotiated_crypto_param)
             self.explicit_iv = explicit_iv
             self.prf = prf
-            self.__init_crypto(pms, client_random, server_random, explicit_iv)
+            self.__init_crypto(pms, client_random, server_random, explicit_iv, master_secret, key_block)
+
+    @staticmethod
+    def _get_key_lengths(crypto_param):
+        cipher_key_length = crypto_param["cipher"]["key_len"]
+        block_size = crypto_param["cipher"]["type"].block_size
+        if crypto_param["cipher"].get("aead", False):
+            # AEAD ciphers have no MAC key, and derive an implicit IV (RFC 5246 section 6.3)
+            mac_key_length = 0
+            iv_length = crypto_param["cipher"]["type"].fixed_iv_length
+        else:
+            mac_key_length = crypto_param["hash"]["type"].digest_size
+            # Stream ciphers have a block size of one, but IV should be 0
+            iv_length = 0 if block_size == 1 else block_size
+        return mac_key_length, cipher_key_length, iv_length
+
+    @classmethod
+    def get_key_block_length(cls, cipher_suite):
+        try:
+            crypto_param = cls.crypto_params[cipher_suite]
+        except KeyError:
+            raise RuntimeError("Cipher 0x%04x not supported" % cipher_suite)
+        return 2 * sum(cls._get_key_lengths(crypto_param))
 
     def get_client_hmac(self):
         return self.__client_hmac
@@ -896,25 +2362,25 @@ class TLSSecurityParameters(object):
 
     def get_server_enc_cipher(self):
         if self.explicit_iv and self.cipher_mode is not None:
-            return self.cipher_type.new(self.server_write_key, mode=self.cipher_mode, IV=self.server_write_IV)
+            return self.backend.new_cipher(self.cipher_type, self.server_write_key, self.cipher_mode, self.server_write_IV)
         else:
             return self.__server_enc_cipher
 
     def get_server_dec_cipher(self):
         if self.explicit_iv and self.cipher_mode is not None:
-            return self.cipher_type.new(self.server_write_key, mode=self.cipher_mode, IV=self.server_write_IV)
+            return self.backend.new_cipher(self.cipher_type, self.server_write_key, self.cipher_mode, self.server_write_IV)
         else:
             return self.__server_dec_cipher
 
     def get_client_enc_cipher(self):
         if self.explicit_iv and self.cipher_mode is not None:
-            return self.cipher_type.new(self.client_write_key, mode=self.cipher_mode, IV=self.client_write_IV)
+            return self.backend.new_cipher(self.cipher_type, self.client_write_key, self.cipher_mode, self.client_write_IV)
         else:
             return self.__client_enc_cipher
 
     def get_client_dec_cipher(self):
         if self.explicit_iv and self.cipher_mode is not None:
-            return self.cipher_type.new(self.client_write_key, mode=self.cipher_mode, IV=self.client_write_IV)
+            return self.backend.new_cipher(self.cipher_type, self.client_write_key, self.cipher_mode, self.client_write_IV)
         else:
             return self.__client_dec_cipher
 
@@ -928,7 +2394,7 @@ class TLSSecurityParameters(object):
         i += self.cipher_key_length
         self.server_write_key = data[i:i+self.cipher_key_length]
         i += self.cipher_key_length
-        if explicit_iv:
+        if explicit_iv and not self.aead:
             self.client_write_IV = "\x00"*self.iv_length
             self.server_write_IV = "\x00"*self.iv_length
         else:
@@ -937,33 +2403,50 @@ class TLSSecurityParameters(object):
             self.server_write_IV = data[i:i+self.iv_length]
             i += self.iv_length
 
-    def __init_crypto(self, pms, client_random, server_random, explicit_iv):
-        self.master_secret = self.prf.get_bytes(pms,
-                                                   TLSPRF.TLS_MD_MASTER_SECRET_CONST,
-                                                   client_random + server_random,
-                                                   num_bytes=48)
-        key_block = self.prf.get_bytes(self.master_secret,
-                                          TLSPRF.TLS_MD_KEY_EXPANSION_CONST,
-                                          server_random + client_random,
-                                          num_bytes=2*(self.mac_key_length + self.cipher_key_length + self.iv_length) )
+    def __init_crypto(self, pms, client_random, server_random, explicit_iv, master_secret=None, key_block=None):
+        if master_secret is None:
+            master_secret = self.prf.get_bytes(pms,
+                                               TLSPRF.TLS_MD_MASTER_SECRET_CONST,
+                                               client_random + server_random,
+                                               num_bytes=48)
+        self.master_secret = master_secret
+        key_block_length = 2 * (self.mac_key_length + self.cipher_key_length + self.iv_length)
+        if key_block is None:
+            key_block = self.prf.get_bytes(self.master_secret,
+                                           TLSPRF.TLS_MD_KEY_EXPANSION_CONST,
+                                           server_random + client_random,
+                                           num_bytes=key_block_length)
+        elif len(key_block) < key_block_length:
+            raise ValueError("Key block must be at least %d bytes" % key_block_length)
         self.__init_key_material(key_block, explicit_iv)
         self.cipher_mode = self.negotiated_crypto_param["cipher"]["mode"]
         self.cipher_type = self.negotiated_crypto_param["cipher"]["type"]
         self.hash_type = self.negotiated_crypto_param["hash"]["type"]
-        # Block ciphers
-        if self.cipher_mode is not None:
-            self.__client_enc_cipher = self.cipher_type.new(self.client_write_key, mode=self.cipher_mode, IV=self.client_write_IV)
-            self.__client_dec_cipher = self.cipher_type.new(self.client_write_key, mode=self.cipher_mode, IV=self.client_write_IV)
-            self.__server_enc_cipher = self.cipher_type.new(self.server_write_key, mode=self.cipher_mode, IV=self.server_write_IV)
-            self.__server_dec_cipher = self.cipher_type.new(self.server_write_key, mode=self.cipher_mode, IV=self.server_write_IV)
-        # Stream ciphers
-        else:
-            self.__client_enc_cipher = self.cipher_type.new(self.client_write_key)
-            self.__client_dec_cipher = self.cipher_type.new(self.client_write_key)
-            self.__server_enc_cipher = self.cipher_type.new(self.server_write_key)
-            self.__server_dec_cipher = self.cipher_type.new(self.server_write_key)
-        self.__client_hmac = HMAC.new(self.client_write_MAC_key, digestmod=self.hash_type)
-        self.__server_hmac = HMAC.new(self.server_write_MAC_key, digestmod=self.hash_type)
+        if self.aead:
+            self.__client_enc_cipher = self.backend.new_aead(self.cipher_type, self.client_write_key,
+                                                             self.client_write_IV)
+            self.__client_dec_cipher = self.backend.new_aead(self.cipher_type, self.client_write_key,
+                                                             self.client_write_IV)
+            self.__server_enc_cipher = self.backend.new_aead(self.cipher_type, self.server_write_key,
+                                                             self.server_write_IV)
+            self.__server_dec_cipher = self.backend.new_aead(self.cipher_type, self.server_write_key,
+                                                             self.server_write_IV)
+            # Integrity is provided by the cipher
+            self.__client_hmac = None
+            self.__server_hmac = None
+            return
+        # Block ciphers get an IV, stream ciphers do not
+        iv = lambda iv_: iv_ if self.cipher_mode is not None else None
+        self.__client_enc_cipher = self.backend.new_cipher(self.cipher_type, self.client_write_key, self.cipher_mode,
+                                                           iv(self.client_write_IV))
+        self.__client_dec_cipher = self.backend.new_cipher(self.cipher_type, self.client_write_key, self.cipher_mode,
+                                                           iv(self.client_write_IV))
+        self.__server_enc_cipher = self.backend.new_cipher(self.cipher_type, self.server_write_key, self.cipher_mode,
+                                                           iv(self.server_write_IV))
+        self.__server_dec_cipher = self.backend.new_cipher(self.cipher_type, self.server_write_key, self.cipher_mode,
+                                                           iv(self.server_write_IV))
+        self.__client_hmac = self.backend.new_hmac(self.client_write_MAC_key, self.hash_type)
+        self.__server_hmac = self.backend.new_hmac(self.server_write_MAC_key, self.hash_type)
 
     def __str__(self):
         s=[]
@@ -974,6 +2457,108 @@ class TLSSecurityParameters(object):
         s.append("%20s| %s" % ("master_secret [bytes]", binascii.hexlify(self.master_secret)))
         return "\n".join(s)
 
+KeyDerivationInput = namedtuple("KeyDerivationInput", ["tls_version", "cipher_suite", "client_random", "server_random",
+                                                       "premaster_secret", "master_secret"])
+# Either premaster_secret or master_secret must be provided
+KeyDerivationInput.__new__.__defaults__ = (None, None)
+SessionKeys = namedtuple("SessionKeys", ["tls_version", "cipher_suite", "client_random", "server_random",
+                                         "master_secret", "key_block"])
+
+
+def _derive_session_keys(input_):
+    prf = TLSPRF.for_cipher_suite(input_.tls_version, input_.cipher_suite)
+    master_secret = input_.master_secret
+    if master_secret is None:
+        if input_.premaster_secret is None:
+            raise ValueError("Either a premaster secret or a master secret is required")
+        master_secret = prf.get_bytes(input_.premaster_secret, TLSPRF.TLS_MD_MASTER_SECRET_CONST,
+                                      input_.client_random + input_.server_random, num_bytes=48)
+    key_block = prf.get_bytes(master_secret, TLSPRF.TLS_MD_KEY_EXPANSION_CONST,
+                              input_.server_random + input_.client_random,
+                              num_bytes=TLSSecurityParameters.get_key_block_length(input_.cipher_suite))
+    return SessionKeys(input_.tls_version, input_.cipher_suite, input_.client_random, input_.server_random,
+                       master_secret, key_block)
+
+
+def derive_session_keys(inputs, processes=None, chunksize=256):
+    """ Derives master secrets and key blocks for many sessions at once
+
+        inputs is an iterable of KeyDerivationInput. Returns a list of SessionKeys in the same order,
+        which TLSSessionCtx.load_session_keys() or TLSSecurityParameters(master_secret=, key_block=) consume.
+        With processes set (0 means one per CPU), derivation is spread over a multiprocessing pool.
+    """
+    inputs = [KeyDerivationInput(*input_) for input_ in inputs]
+    if processes is None:
+        return [_derive_session_keys(input_) for input_ in inputs]
+    pool = multiprocessing.Pool(processes or None)
+    try:
+        return pool.map(_derive_session_keys, inputs, chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+# Private keys of decrypt_premaster_secrets() pool workers by TLSRSAKeyStore fingerprint. Set by _init_pms_worker()
+_pms_worker_keys = None
+
+
+def _init_pms_worker(priv_keys):
+    global _pms_worker_keys
+    # PyCrypto refuses to use RNG state inherited through fork(). RSA blinding needs it
+    if hasattr(Random, "atfork"):
+        Random.atfork()
+    _pms_worker_keys = dict((fingerprint, RSA.importKey(priv_key)) for fingerprint, priv_key in priv_keys.items())
+
+
+def _decrypt_pms(job):
+    fingerprint, encrypted_pms = job
+    return rsa_decrypt_pms(_pms_worker_keys[fingerprint], encrypted_pms)
+
+
+def decrypt_premaster_secrets(rsa_key_store, key_exchanges, processes=None, chunksize=64):
+    """ Decrypts many RSA encrypted premaster secrets at once
+
+        key_exchanges is an iterable of (server certificate DER, encrypted premaster secret), see
+        ssl_tls_capture.extract_encrypted_premaster_secrets(). Each is decrypted with the key of rsa_key_store, a
+        TLSRSAKeyStore or a single private key, matching its certificate. Returns a dict of encrypted premaster
+        secret to premaster secret, leaving out unknown keys and failed decryptions. Seed contexts with it through
+        TLSSessionCtx.rsa_premaster_secrets. With processes set (0 means one per CPU), decryption is spread over a
+        multiprocessing pool.
+    """
+    if not isinstance(rsa_key_store, TLSRSAKeyStore):
+        priv_key = rsa_key_store
+        rsa_key_store = TLSRSAKeyStore()
+        rsa_key_store.add_key(priv_key)
+    # certificate: fingerprint of its private key, or None
+    fingerprints = {}
+    priv_keys = {}
+    jobs = []
+    for certificate, encrypted_pms in key_exchanges:
+        if certificate not in fingerprints:
+            fingerprints[certificate] = None
+            try:
+                keys = rsa_key_store.get_keys(x509_extract_pubkey_from_der(certificate))
+            except (ValueError, IndexError, TypeError, AttributeError):
+                warnings.warn("Unable to extract the public key of a server certificate")
+                keys = None
+            if keys is not None:
+                fingerprints[certificate] = rsa_key_store.fingerprint(keys[1])
+                priv_keys[fingerprints[certificate]] = keys[0]
+        if fingerprints[certificate] is not None:
+            jobs.append((fingerprints[certificate], encrypted_pms))
+    if processes is None:
+        premaster_secrets = [rsa_decrypt_pms(priv_keys[fingerprint], pms) for fingerprint, pms in jobs]
+    else:
+        pool = multiprocessing.Pool(processes or None, _init_pms_worker, (
+            dict((fingerprint, priv_key.exportKey("DER")) for fingerprint, priv_key in priv_keys.items()),))
+        try:
+            premaster_secrets = pool.map(_decrypt_pms, jobs, chunksize)
+        finally:
+            pool.close()
+            pool.join()
+    return dict((encrypted, pms) for (_, encrypted), pms in zip(jobs, premaster_secrets) if pms is not None)
+
+
 class NullCompression(object):
     """ Implements a zlib like interface for null compression
     """
@@ -4,6 +4,8 @@ import binascii
 import os
 import re
 import socket
+import tempfile
+import threading
 import unittest
 import scapy_ssl_tls.ssl_tls as tls
 import scapy_ssl_tls.ssl_tls_crypto as tlsc
@@ -738,6 +740,16 @@ UM6j0ZuSMFOCr/lGPAoOQU0fskidGEHi1/kW+suSr28TqsyYZpwBDQ==
         self.assertTrue(len(ciphertext))
         self.assertEqual(ciphertext, ciphertext_2)
 
+    def test_tls_certificate_x509_pubkey_is_cached(self):
+        tlsc.X509_PUBKEY_CACHE.clear()
+        pubkey = tlsc.x509_extract_pubkey_from_der(self.der_cert)
+        self.assertIs(pubkey, tlsc.x509_extract_pubkey_from_der(self.der_cert))
+        self.assertIs(pubkey, tlsc.x509_extract_pubkey_from_der(x509.X509Cert(self.der_cert)))
+        self.assertEqual((2, 1), (tlsc.X509_PUBKEY_CACHE.hits, tlsc.X509_PUBKEY_CACHE.misses))
+        with self.assertRaises(ValueError):
+            tlsc.x509_extract_pubkey_from_der("\x30\x04\x30\x02\x05\x00")
+        self.assertEqual(1, len(tlsc.X509_PUBKEY_CACHE))
+
 
 class TestTLSTopLevelFunctions(unittest.TestCase):
     def test_tls_payload_fragmentation_raises_error_with_negative_size(self):
@@ -745,5 +757,143 @@ class TestTLSTopLevelFunctions(unittest.TestCase):
             tls.tls_fragment_payload("AAAA", size=-1)
 
 
+class TestLoopbackTransport(unittest.TestCase):
+    def setUp(self):
+        keys_dir = os.path.join(os.path.dirname(__file__), "integration", "keys")
+        with open(os.path.join(keys_dir, "cert.der"), "rb") as f:
+            self.certificates = [tls.TLSCertificate(data=x509.X509Cert(f.read()))]
+        self.keyfile = os.path.join(keys_dir, "key.pem")
+        unittest.TestCase.setUp(self)
+
+    def test_data_sent_on_one_endpoint_is_received_on_the_other(self):
+        client, server = tls.tls_socketpair()
+        self.assertTrue(client.tls_ctx.client)
+        self.assertFalse(server.tls_ctx.client)
+        record = tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello()
+        client.sendall(record)
+        self.assertEqual(str(server.recvall()), str(record))
+        self.assertEqual(len(server.recvall(timeout=0.01).records), 0)
+
+    def test_closed_peer_is_reported_as_eof(self):
+        client, server = tls.tls_socketpair()
+        client.close()
+        self.assertEqual(server.recv(10), "")
+        with self.assertRaises(socket.error):
+            server.sendall("data")
+
+    def test_handshake_completes_without_external_server(self):
+        client, server = tls.tls_socketpair()
+        server.tls_ctx.rsa_load_keys_from_file(self.keyfile)
+        server_thread = threading.Thread(target=tls.tls_do_server_handshake, args=(server, self.certificates))
+        server_thread.start()
+        tls.tls_do_handshake(client, tls.TLSVersion.TLS_1_0, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+        server_thread.join()
+        self.assertEqual(client.tls_ctx.crypto.session.master_secret, server.tls_ctx.crypto.session.master_secret)
+        client.sendall(tls.to_raw(tls.TLSPlaintext(data="ping"), client.tls_ctx))
+        self.assertEqual(server.recvall()[tls.TLSPlaintext].data, "ping")
+
+    def _do_handshake(self, client_cache, server_cache, version=tls.TLSVersion.TLS_1_0, **kwargs):
+        client_ctx, server_ctx = tlsc.TLSSessionCtx(), tlsc.TLSSessionCtx(client=False)
+        client_ctx.session_cache, server_ctx.session_cache = client_cache, server_cache
+        client, server = tls.tls_socketpair(client_ctx, server_ctx)
+        server.tls_ctx.rsa_load_keys_from_file(self.keyfile)
+        server_thread = threading.Thread(target=tls.tls_do_server_handshake, args=(server, self.certificates),
+                                         kwargs={"issue_ticket": True})
+        server_thread.start()
+        tls.tls_do_handshake(client, version, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA], **kwargs)
+        server_thread.join()
+        client.sendall(tls.to_raw(tls.TLSPlaintext(data="ping"), client.tls_ctx))
+        self.assertEqual(server.recvall()[tls.TLSPlaintext].data, "ping")
+        return client, server
+
+    def test_keylog_enables_passive_decryption(self):
+        client, server = tls.tls_socketpair()
+        server.tls_ctx.rsa_load_keys_from_file(self.keyfile)
+        wire = []
+        for endpoint, is_client in ((client, True), (server, False)):
+            sendall = endpoint._s.sendall
+            endpoint._s.sendall = lambda data, sendall=sendall, is_client=is_client: \
+                (wire.append((is_client, data)), sendall(data))
+        server_thread = threading.Thread(target=tls.tls_do_server_handshake, args=(server, self.certificates))
+        server_thread.start()
+        tls.tls_do_handshake(client, tls.TLSVersion.TLS_1_2, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+        server_thread.join()
+        server.sendall(tls.to_raw(tls.TLSPlaintext(data="pong"), server.tls_ctx))
+        client.recvall()
+
+        keylog_file = tempfile.NamedTemporaryFile(suffix=".keylog", delete=False)
+        keylog_file.write("CLIENT_RANDOM %s %s\n" % (binascii.hexlify(client.tls_ctx.crypto.session.randombytes.client),
+                                                     binascii.hexlify(client.tls_ctx.crypto.session.master_secret)))
+        keylog_file.close()
+        try:
+            passive_ctx = tlsc.TLSSessionCtx()
+            passive_ctx.keylog = tlsc.TLSKeyLog(keylog_file.name)
+            for is_client, data in wire:
+                passive_ctx.set_mode(server=is_client)
+                records = tls.SSL(data, ctx=passive_ctx)
+            self.assertEqual("pong", records[tls.TLSPlaintext].data)
+            self.assertEqual(client.tls_ctx.crypto.session.master_secret, passive_ctx.crypto.session.master_secret)
+        finally:
+            os.unlink(keylog_file.name)
+
+    def test_session_id_resumption_skips_key_exchange(self):
+        client_cache, server_cache = tlsc.TLSSessionCache(), tlsc.TLSSessionCache()
+        client, server = self._do_handshake(client_cache, server_cache)
+        self.assertFalse(client.tls_ctx.params.negotiated.resumed)
+        session_id = client.tls_ctx.params.handshake.server.session_id
+        resumed_client, resumed_server = self._do_handshake(client_cache, server_cache, session_id=session_id)
+        self.assertTrue(resumed_client.tls_ctx.params.negotiated.resumed)
+        self.assertTrue(resumed_server.tls_ctx.params.negotiated.resumed)
+        self.assertEqual(client.tls_ctx.crypto.session.master_secret,
+                         resumed_server.tls_ctx.crypto.session.master_secret)
+        self.assertFalse(resumed_client.tls_ctx.packets.history[-1].haslayer(tls.TLSClientKeyExchange))
+        self.assertFalse(any(pkt.haslayer(tls.TLSClientKeyExchange) for pkt in resumed_server.tls_ctx.packets.history))
+        self.assertNotEqual(client.tls_ctx.crypto.session.key.client.encryption,
+                            resumed_client.tls_ctx.crypto.session.key.client.encryption)
+        self.assertEqual((1, 0), (client_cache.hits, client_cache.misses))
+        self.assertEqual((1, 0), (server_cache.hits, server_cache.misses))
+
+    def test_unknown_session_falls_back_to_full_handshake(self):
+        client_cache, server_cache = tlsc.TLSSessionCache(), tlsc.TLSSessionCache()
+        client, _ = self._do_handshake(client_cache, server_cache)
+        server_cache.clear()
+        session_id = client.tls_ctx.params.handshake.server.session_id
+        resumed_client, resumed_server = self._do_handshake(client_cache, server_cache, session_id=session_id)
+        self.assertFalse(resumed_client.tls_ctx.params.negotiated.resumed)
+        self.assertFalse(resumed_server.tls_ctx.params.negotiated.resumed)
+        self.assertEqual((0, 1), (server_cache.hits, server_cache.misses))
+
+    def test_session_ticket_resumption(self):
+        client_cache, server_cache = tlsc.TLSSessionCache(), tlsc.TLSSessionCache()
+        client, server = self._do_handshake(client_cache, server_cache, version=tls.TLSVersion.TLS_1_2, ticket="")
+        ticket = client.tls_ctx.crypto.session.ticket
+        self.assertTrue(ticket)
+        self.assertEqual(ticket, server.tls_ctx.crypto.session.ticket)
+        resumed_client, resumed_server = self._do_handshake(client_cache, server_cache,
+                                                            version=tls.TLSVersion.TLS_1_2, ticket=ticket)
+        self.assertTrue(resumed_client.tls_ctx.params.negotiated.resumed)
+        self.assertTrue(resumed_server.tls_ctx.params.negotiated.resumed)
+        self.assertEqual(client.tls_ctx.crypto.session.master_secret,
+                         resumed_client.tls_ctx.crypto.session.master_secret)
+
+    @unittest.skipIf(tlsc.CryptoAESGCM is None and not hasattr(AES, "MODE_GCM"),
+                     "AEAD requires pycryptodome or cryptography")
+    def test_aead_handshake_and_records_round_trip(self):
+        for cipher_suite in (tls.TLSCipherSuite.RSA_WITH_AES_128_GCM_SHA256,
+                             tls.TLSCipherSuite.RSA_WITH_AES_256_GCM_SHA384):
+            client, server = tls.tls_socketpair()
+            server.tls_ctx.rsa_load_keys_from_file(self.keyfile)
+            server_thread = threading.Thread(target=tls.tls_do_server_handshake, args=(server, self.certificates))
+            server_thread.start()
+            tls.tls_do_handshake(client, tls.TLSVersion.TLS_1_2, [cipher_suite])
+            server_thread.join()
+            self.assertEqual(client.tls_ctx.crypto.session.master_secret, server.tls_ctx.crypto.session.master_secret)
+            for data in ("ping", "pong"):
+                client.sendall(tls.to_raw(tls.TLSPlaintext(data=data), client.tls_ctx))
+                self.assertEqual(server.recvall()[tls.TLSPlaintext].data, data)
+            server.sendall(tls.to_raw(tls.TLSPlaintext(data="reply"), server.tls_ctx))
+            self.assertEqual(client.recvall()[tls.TLSPlaintext].data, "reply")
+
+
 if __name__ == "__main__":
     unittest.main()
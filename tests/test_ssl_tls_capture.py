@@ -0,0 +1,640 @@
+#! -*- coding: utf-8 -*-
+
+import ctypes
+import ctypes.util
+import os
+import Queue
+import socket
+import struct
+import tempfile
+import warnings
+import threading
+import time
+import unittest
+import scapy_ssl_tls.ssl_tls as tls
+import scapy_ssl_tls.ssl_tls_crypto as tlsc
+import scapy_ssl_tls.ssl_tls_capture as tlscap
+
+from distutils.spawn import find_executable
+from scapy.all import conf, RawPcapReader, rdpcap, wrpcap
+from scapy.layers import x509
+from scapy.layers.inet import IP, TCP
+from scapy.layers.inet6 import IPv6
+from scapy.layers.l2 import Dot1Q, Ether
+
+def env_local_file(file):
+    return os.path.join(os.path.dirname(__file__), 'files', file)
+
+
+KEYS_DIR = os.path.join(os.path.dirname(__file__), "integration", "keys")
+ETHER = Ether(src="00:00:5e:00:53:01", dst="00:00:5e:00:53:02")
+KEY_STORE = tlsc.TLSRSAKeyStore()
+KEY_STORE.load_file(os.path.join(KEYS_DIR, "key.pem"))
+
+
+def passive_ctx():
+    tls_ctx = tlsc.TLSSessionCtx()
+    tls_ctx.rsa_key_store = KEY_STORE
+    return tls_ctx
+
+
+def capture_session(certificates, client_data, server_data):
+    """ Returns the (from_client, data) writes of a loopback session """
+    client, server = tls.tls_socketpair()
+    server.tls_ctx.rsa_load_keys_from_file(os.path.join(KEYS_DIR, "key.pem"))
+    wire = []
+    for endpoint, from_client in ((client, True), (server, False)):
+        sendall = endpoint._s.sendall
+        endpoint._s.sendall = lambda data, sendall=sendall, from_client=from_client: \
+            (wire.append((from_client, data)), sendall(data))
+    server_thread = threading.Thread(target=tls.tls_do_server_handshake, args=(server, certificates))
+    server_thread.start()
+    tls.tls_do_handshake(client, tls.TLSVersion.TLS_1_2, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA])
+    server_thread.join()
+    client.sendall(tls.to_raw(tls.TLSPlaintext(data=client_data), client.tls_ctx))
+    server.recvall()
+    server.sendall(tls.to_raw(tls.TLSPlaintext(data=server_data), server.tls_ctx))
+    client.recvall()
+    return wire
+
+
+def to_frames(wire, client, server, mss=None):
+    frames = []
+    seqs = {True: 1000, False: 5000}
+    for from_client, data in wire:
+        src, dst = (client, server) if from_client else (server, client)
+        for offset in range(0, len(data), mss or len(data)):
+            segment = data[offset:offset + mss] if mss else data
+            frames.append(ETHER / IP(src=src[0], dst=dst[0]) /
+                          TCP(sport=src[1], dport=dst[1], flags="PA", seq=seqs[from_client]) / segment)
+            seqs[from_client] += len(segment)
+    return frames
+
+
+class TestParseTCPFrame(unittest.TestCase):
+
+    def test_ipv4_segment_is_parsed(self):
+        frame = ETHER / IP(src="192.0.2.1", dst="192.0.2.2") / TCP(sport=1234, dport=443, flags="PA") / "data"
+        # Ethernet padding is not part of the payload
+        segment = tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(frame) + "\x00" * 8)
+        self.assertEqual("data", segment.payload)
+        self.assertEqual((("\xc0\x00\x02\x01", 1234), ("\xc0\x00\x02\x02", 443)), (segment.src, segment.dst))
+        self.assertEqual(tlscap.flow_key(segment), tlscap.flow_key(segment._replace(src=segment.dst, dst=segment.src)))
+
+    def test_vlan_and_ipv6_segment_is_parsed(self):
+        frame = ETHER / Dot1Q(vlan=3) / IPv6(src="2001:db8::1", dst="2001:db8::2") / TCP(sport=1, dport=2) / "data"
+        segment = tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(frame))
+        self.assertEqual("data", segment.payload)
+        self.assertEqual(2, segment.dst[1])
+
+    def test_non_tcp_frames_are_skipped(self):
+        self.assertIsNone(tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(ETHER / IP(proto=17) / "data")))
+        self.assertIsNone(tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(ETHER / IP(frag=1) / TCP())))
+        self.assertIsNone(tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, "\x00" * 10))
+
+
+def can_open_packet_socket():
+    try:
+        socket.socket(socket.AF_PACKET, socket.SOCK_RAW).close()
+    except (AttributeError, socket.error):
+        return False
+    return True
+
+
+@unittest.skipUnless(can_open_packet_socket(), "AF_PACKET sockets are not available")
+class TestPacketRingReader(unittest.TestCase):
+
+    def _ping(self):
+        """ Sends "ping" over a loopback connection. Returns the server port """
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        port = server.getsockname()[1]
+        client = socket.create_connection(("127.0.0.1", port))
+        connection, _ = server.accept()
+        client.sendall("ping")
+        connection.recv(4)
+        for sock in (client, connection, server):
+            sock.close()
+        return port
+
+    def test_loopback_segments_are_captured(self):
+        with tlscap.PacketRingReader("lo", block_size=1 << 16, block_count=4, timeout_ms=10, idle=0.2) as ring:
+            self.assertEqual(tlscap.DLT_EN10MB, ring.linktype)
+            port = self._ping()
+            segments = [tlscap.parse_tcp_frame(ring.linktype, frame) for frame, _, _ in ring]
+            stats = ring.stats()
+        payloads = [segment.payload for segment in segments if segment is not None and port in
+                    (segment.src[1], segment.dst[1])]
+        self.assertIn("ping", payloads)
+        self.assertGreaterEqual(stats.packets, len(payloads))
+        self.assertEqual(0, stats.drops)
+
+    def test_compiled_filter_is_attached(self):
+        # ret #0
+        with tlscap.PacketRingReader("lo", bpf=[(0x06, 0, 0, 0)], block_size=1 << 16, block_count=4, timeout_ms=10,
+                                     idle=0.2) as ring:
+            self._ping()
+            self.assertEqual([], list(ring))
+
+    def test_abandoned_block_is_handed_back(self):
+        with tlscap.PacketRingReader("lo", block_size=1 << 16, block_count=4, timeout_ms=10, idle=0.2) as ring:
+            self._ping()
+            frames = iter(ring)
+            first = next(frames)
+            frames.close()
+            self.assertEqual(1, ring.block)
+            self.assertEqual(tlscap.TP_STATUS_KERNEL, ring._block_header.unpack_from(ring._map, 0)[2])
+            # Iteration resumes with the next block
+            self.assertNotIn(first, list(ring))
+
+
+def compile_filter(expression):
+    """ Returns the number of BPF instructions of an expression compiled for Ethernet, by tcpdump or else by libpcap.
+        Skips the test when neither is available
+    """
+    if find_executable(conf.prog.tcpdump) and can_open_packet_socket():
+        return len(tlscap.compile_bpf("lo", expression))
+    library = ctypes.util.find_library("pcap")
+    if library is None:
+        raise unittest.SkipTest("Neither tcpdump nor libpcap is available")
+    pcap = ctypes.CDLL(library)
+    pcap.pcap_open_dead.restype = ctypes.c_void_p
+    pcap.pcap_geterr.restype = ctypes.c_char_p
+    handle = ctypes.c_void_p(pcap.pcap_open_dead(tlscap.DLT_EN10MB, 65535))
+    # struct bpf_program
+    program = (ctypes.c_uint * 4)()
+    try:
+        if pcap.pcap_compile(handle, program, expression, 1, 0xffffffff):
+            raise ValueError("Invalid filter %r: %s" % (expression, pcap.pcap_geterr(handle)))
+        pcap.pcap_freecode(program)
+        return program[0]
+    finally:
+        pcap.pcap_close(handle)
+
+
+class TestTLSBPFFilter(unittest.TestCase):
+
+    def test_hosts_and_ports_are_matched(self):
+        self.assertEqual("tcp and (port 443)", tlscap.tls_bpf_filter())
+        self.assertEqual("tcp and (host 192.0.2.1 or host 2001:db8::1) and (port 443 or port 8443)",
+                         tlscap.tls_bpf_filter(["192.0.2.1", "2001:db8::1"], [443, 8443]))
+        self.assertEqual("tcp", tlscap.tls_bpf_filter(ports=()))
+
+    def test_handshake_only_matches_record_headers(self):
+        bpf = tlscap.tls_bpf_filter(["192.0.2.1"], handshake_only=True,
+                                    content_types=[tls.TLSContentType.HANDSHAKE])
+        self.assertTrue(bpf.startswith("tcp and (host 192.0.2.1) and (port 443) and ("))
+        self.assertIn("tcp[tcpflags] & (tcp-syn|tcp-fin|tcp-rst) != 0", bpf)
+        self.assertIn("(tcp[((tcp[12:1] & 0xf0) >> 2)] = 0x16) and tcp[((tcp[12:1] & 0xf0) >> 2) + 1] = 0x03", bpf)
+        self.assertIn("tcp[((tcp[12:1] & 0xf0) >> 2)] & 0x80 != 0 and tcp[((tcp[12:1] & 0xf0) >> 2) + 2] = 0x01", bpf)
+        self.assertNotIn("0x15", bpf)
+        self.assertEqual(bpf.count("("), bpf.count(")"))
+
+    def test_expressions_compile(self):
+        for bpf in (tlscap.tls_bpf_filter(), tlscap.tls_bpf_filter(["192.0.2.1", "2001:db8::1"], [443, 8443]),
+                    tlscap.tls_bpf_filter(handshake_only=True),
+                    tlscap.tls_bpf_filter(["192.0.2.1"], [443, 8443], handshake_only=True)):
+            self.assertGreater(compile_filter(bpf), 0)
+
+
+class TestPcapFileReader(unittest.TestCase):
+
+    def setUp(self):
+        self.pcap = tempfile.NamedTemporaryFile(suffix=".pcap", delete=False)
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        os.unlink(self.pcap.name)
+        unittest.TestCase.tearDown(self)
+
+    def test_records_match_scapy_reader(self):
+        pcap = env_local_file("RSA_WITH_AES_128_CBC_SHA.pcap")
+        with tlscap.PcapFileReader(pcap) as reader:
+            records = list(reader)
+            self.assertEqual(tlscap.DLT_EN10MB, reader.linktype)
+        expected = RawPcapReader(pcap).read_all()
+        self.assertEqual([frame for frame, _ in expected], [frame for frame, _, _ in records])
+        self.assertEqual([sec + usec / 1000000.0 for _, (sec, usec, _) in expected],
+                         [timestamp for _, timestamp, _ in records])
+
+    def test_big_endian_nanosecond_pcap(self):
+        self.pcap.write("\xa1\xb2\x3c\x4d" + struct.pack(">HHiIII", 2, 4, 0, 0, 65535, tlscap.DLT_RAW))
+        self.pcap.write(struct.pack(">IIII", 10, 500000000, 4, 60) + "abcd")
+        # Truncated record
+        self.pcap.write(struct.pack(">IIII", 11, 0, 10, 10) + "ab")
+        self.pcap.close()
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            with tlscap.PcapFileReader(self.pcap.name) as reader:
+                self.assertEqual([("abcd", 10.5, 60)], list(reader))
+                self.assertEqual(tlscap.DLT_RAW, reader.linktype)
+        self.assertEqual(1, len(caught))
+
+    def test_non_pcap_file_raises(self):
+        self.pcap.write("\x0a\x0d\x0d\x0a" + "\x00" * 28)
+        self.pcap.close()
+        with self.assertRaises(ValueError):
+            tlscap.PcapFileReader(self.pcap.name)
+
+
+class TestTCPStream(unittest.TestCase):
+
+    def test_out_of_order_and_retransmitted_segments(self):
+        stream = tlscap.TCPStream()
+        self.assertEqual("", stream.feed(100, "", syn=True))
+        self.assertEqual("", stream.feed(106, "fgh"))
+        self.assertEqual("abcdefgh", stream.feed(101, "abcde"))
+        # Retransmission and overlap
+        self.assertEqual("", stream.feed(101, "abc"))
+        self.assertEqual("ij", stream.feed(108, "hij"))
+        self.assertEqual((0, 0), (len(stream.pending), stream.buffered))
+
+    def test_mid_stream_pickup_and_sequence_wrap(self):
+        stream = tlscap.TCPStream()
+        # Capture started after the handshake, first segment seen is delivered
+        self.assertEqual("ab", stream.feed(0xfffffffe, "ab"))
+        self.assertEqual("", stream.feed(0x00000002, "ef"))
+        self.assertEqual("cdef", stream.feed(0x00000000, "cd"))
+        self.assertEqual("g", stream.feed(0x00000002, "efg"))
+
+    def test_unfilled_gap_is_skipped(self):
+        stream = tlscap.TCPStream(max_buffer=4)
+        stream.feed(0, "ab")
+        self.assertEqual("", stream.feed(10, "xyz"))
+        self.assertEqual("xyzuv", stream.feed(13, "uv"))
+        self.assertEqual(1, stream.gaps)
+
+
+class TestTCPReassembler(unittest.TestCase):
+
+    def segment(self, flags, seq=0, payload="", from_client=True):
+        client, server = ("\x0a\x00\x00\x01", 40000), ("\x0a\x00\x00\x02", 443)
+        src, dst = (client, server) if from_client else (server, client)
+        return tlscap.TCPSegment(src, dst, seq, flags, payload)
+
+    def test_connection_is_torn_down_on_fin_and_rst(self):
+        reassembler = tlscap.TCPReassembler()
+        flow, data = reassembler.feed(self.segment(tlscap.TCP_SYN, 10))
+        self.assertEqual(1, len(reassembler))
+        self.assertEqual("data", reassembler.feed(self.segment(tlscap.TCP_ACK | tlscap.TCP_FIN, 11, "data"))[1])
+        reassembler.feed(self.segment(tlscap.TCP_ACK | tlscap.TCP_FIN, 50, from_client=False))
+        self.assertTrue(flow.closed)
+        self.assertEqual(0, len(reassembler))
+        flow, _ = reassembler.feed(self.segment(tlscap.TCP_ACK, 10, "data"))
+        reassembler.feed(self.segment(tlscap.TCP_RST, 14))
+        self.assertTrue(flow.closed)
+        self.assertEqual((None, ""), reassembler.feed(self.segment(tlscap.TCP_RST, 14)))
+
+    def test_syn_on_known_connection_starts_a_new_one(self):
+        reassembler = tlscap.TCPReassembler()
+        flow, _ = reassembler.feed(self.segment(tlscap.TCP_SYN, 10))
+        reassembler.feed(self.segment(tlscap.TCP_ACK, 11, "data"))
+        new_flow, _ = reassembler.feed(self.segment(tlscap.TCP_SYN, 9000))
+        self.assertTrue(flow.closed)
+        self.assertIsNot(flow, new_flow)
+        self.assertEqual("next", reassembler.feed(self.segment(tlscap.TCP_ACK, 9001, "next"))[1])
+
+    def test_idle_connections_are_evicted(self):
+        reassembler = tlscap.TCPReassembler(idle_timeout=10)
+        reassembler.feed(self.segment(tlscap.TCP_ACK, 1, "a"), timestamp=0)
+        other = self.segment(tlscap.TCP_ACK, 1, "a")._replace(src=("\x0a\x00\x00\x03", 40000))
+        reassembler.feed(other, timestamp=5)
+        reassembler.feed(other, timestamp=11)
+        self.assertEqual((1, 1), (len(reassembler), reassembler.evicted))
+        self.assertIn(tlscap.flow_key(other), reassembler)
+
+    def test_least_recently_active_connection_is_evicted(self):
+        evicted = []
+        reassembler = tlscap.TCPReassembler(max_flows=2, on_evict=evicted.append)
+        segments = [self.segment(tlscap.TCP_ACK, 1, "a")._replace(src=("\x0a\x00\x00" + chr(i), 40000))
+                    for i in range(3, 6)]
+        first, second = [reassembler.feed(segment)[0] for segment in segments[:2]]
+        reassembler.feed(segments[0]._replace(seq=2))
+        reassembler.feed(segments[2])
+        self.assertEqual([second], evicted)
+        self.assertTrue(second.closed)
+        self.assertIn(first.key, reassembler)
+        self.assertEqual((2, 3, 0, 1), (len(reassembler), reassembler.opened, reassembler.closed,
+                                        reassembler.lru_evicted))
+
+
+class TestTLSPrefilter(unittest.TestCase):
+
+    def test_tls_and_sslv2_headers_are_accepted(self):
+        client_hello = str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+        for payload in (client_hello, client_hello[:2], str(tls.TLSRecord(version=tls.TLSVersion.SSL_3_0)),
+                        str(tls.SSLv2Record() / tls.SSLv2ClientHello())):
+            self.assertIsNone(tlscap.TLSPrefilter.classify(payload))
+
+    def test_implausible_headers_are_rejected_and_counted(self):
+        prefilter = tlscap.TLSPrefilter()
+        self.assertFalse(prefilter(""))
+        self.assertFalse(prefilter("GET / HTTP/1.1\r\n"))
+        self.assertFalse(prefilter("\x16\xfe\xfd"))
+        self.assertFalse(prefilter("\x17\x03\x05\x00\x10"))
+        self.assertFalse(prefilter("\x17\x03\x03\xff\xff"))
+        self.assertFalse(prefilter("\x80\x00"))
+        self.assertTrue(prefilter("\x17\x03\x03\x00\x10"))
+        self.assertEqual(1, prefilter.accepted)
+        self.assertEqual({"empty": 1, "content_type": 1, "version": 2, "length": 2}, prefilter.rejected)
+
+    def test_decryptor_dissects_accepted_payload_only(self):
+        decryptor = tlscap.TLSFlowDecryptor()
+        client, server = ("\x0a\x00\x00\x01", 40000), ("\x0a\x00\x00\x02", 443)
+        self.assertEqual([], decryptor.process(0, None, tlscap.TCPSegment(client, server, 1, tlscap.TCP_ACK,
+                                                                         "GET / HTTP/1.1\r\n")))
+        self.assertEqual([], decryptor.process(1, None, tlscap.TCPSegment(server, client, 1, tlscap.TCP_ACK, "")))
+        self.assertEqual((0, 1, 1), (decryptor.prefilter.accepted, decryptor.prefilter.rejected["content_type"],
+                                     decryptor.prefilter.rejected["empty"]))
+        self.assertEqual(0, len(decryptor))
+
+
+class TestTLSRecordStream(unittest.TestCase):
+
+    def test_records_are_split_on_boundaries(self):
+        records = str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello()) + \
+            str(tls.TLSRecord() / tls.TLSAlert())
+        stream = tlscap.TLSRecordStream()
+        self.assertEqual("", stream.feed(records[:3]))
+        self.assertEqual("", stream.feed(records[3:10]))
+        self.assertEqual(records[:-7], stream.feed(records[10:-1]))
+        self.assertEqual(records[-7:], stream.feed(records[-1:]))
+        self.assertEqual("", stream.buffer)
+
+    def test_non_tls_stream_raises(self):
+        with self.assertRaises(ValueError):
+            tlscap.TLSRecordStream().feed("GET / HTTP/1.1\r\n")
+        with self.assertRaises(ValueError):
+            tlscap.TLSRecordStream().feed("\x17\x03\x03\xff\xff")
+
+
+class TestDecryptPcap(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(KEYS_DIR, "cert.der"), "rb") as f:
+            certificates = [tls.TLSCertificate(data=x509.X509Cert(f.read()))]
+        sessions = [to_frames(capture_session(certificates, "ping %d" % i, "pong %d" % i),
+                              ("10.0.0.%d" % (i + 1), 40000 + i), ("10.0.1.1", 443))
+                    for i in range(4)]
+        # Interleave sessions packet by packet
+        frames = []
+        for i in range(max(len(session) for session in sessions)):
+            frames.extend(session[i] for session in sessions if i < len(session))
+        # Not TLS
+        frames.insert(1, ETHER / IP(src="10.0.2.1", dst="10.0.1.1") / TCP(sport=1, dport=80) / "GET / HTTP/1.0")
+        pcap = tempfile.NamedTemporaryFile(suffix=".pcap", delete=False)
+        pcap.close()
+        wrpcap(pcap.name, frames)
+        self.pcap = pcap.name
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        os.unlink(self.pcap)
+        unittest.TestCase.tearDown(self)
+
+    def _application_data(self, records):
+        return [(record.src, record.from_client, record.data) for record in records
+                if record.content_type == tls.TLSContentType.APPLICATION_DATA]
+
+    def test_sessions_are_decrypted(self):
+        records = list(tlscap.decrypt_pcap(self.pcap, passive_ctx))
+        application_data = self._application_data(records)
+        self.assertEqual(8, len(application_data))
+        self.assertIn((("10.0.0.2", 40001), True, "ping 1"), application_data)
+        self.assertIn((("10.0.1.1", 443), False, "pong 3"), application_data)
+        self.assertFalse(any(record.encrypted for record in records))
+        self.assertEqual(sorted(records, key=lambda record: record.index), records)
+
+    def test_reordered_and_duplicated_segments_are_reassembled(self):
+        with open(os.path.join(KEYS_DIR, "cert.der"), "rb") as f:
+            certificates = [tls.TLSCertificate(data=x509.X509Cert(f.read()))]
+        frames = to_frames(capture_session(certificates, "ping" * 1000, "pong"), ("10.0.0.1", 40000),
+                           ("10.0.1.1", 443), mss=500)
+        # Swap two segments of the client write and retransmit one
+        frames[-4], frames[-3] = frames[-3], frames[-4]
+        frames.insert(-2, frames[-5])
+        wrpcap(self.pcap, frames)
+        application_data = self._application_data(tlscap.decrypt_pcap(self.pcap, passive_ctx))
+        self.assertEqual([(("10.0.0.1", 40000), True, "ping" * 1000), (("10.0.1.1", 443), False, "pong")],
+                         application_data)
+
+    def test_openssl_capture_is_decrypted(self):
+        key_store = tlsc.TLSRSAKeyStore()
+        key_store.load_file(env_local_file("openssl_1_0_1_f_server.pem"))
+
+        def ctx_factory():
+            tls_ctx = tlsc.TLSSessionCtx()
+            tls_ctx.rsa_key_store = key_store
+            return tls_ctx
+        application_data = [data for _, _, data in self._application_data(
+            tlscap.decrypt_pcap(env_local_file("RSA_WITH_AES_128_CBC_SHA_w_key.pcap"), ctx_factory)) if data]
+        self.assertTrue(application_data[0].startswith("GET / HTTP/1.1\r\n"))
+        # The response spans several segments
+        self.assertTrue(application_data[1].startswith("HTTP/1.0 200 ok\r\n"))
+
+    def test_contexts_are_released_with_their_connection(self):
+        certificate_store = tlsc.TLSCertificateStore()
+
+        def ctx_factory():
+            tls_ctx = passive_ctx()
+            tls_ctx.certificate_store = certificate_store
+            return tls_ctx
+        decryptor = tlscap.TLSFlowDecryptor(ctx_factory, tlscap.TCPReassembler(idle_timeout=60))
+        with tlscap.PcapFileReader(self.pcap) as reader:
+            for index, (frame, timestamp, _) in enumerate(reader):
+                decryptor.process(index, timestamp, tlscap.parse_tcp_frame(reader.linktype, frame))
+        self.assertEqual(4, len(decryptor))
+        self.assertEqual(1, len(certificate_store))
+        decryptor.reassembler.evict_idle(timestamp + 61)
+        self.assertEqual((0, 4, 4), (len(decryptor), decryptor.created, decryptor.released))
+        self.assertEqual(0, len(certificate_store))
+
+    def test_metadata_only_stops_after_handshake(self):
+        records = list(tlscap.decrypt_pcap(self.pcap, passive_ctx, metadata_only=True))
+        self.assertEqual([], self._application_data(records))
+        self.assertEqual(8, sum(1 for record in records if record.content_type == tls.TLSContentType.HANDSHAKE and
+                                record.data.startswith("\x14")))
+        with open(os.path.join(KEYS_DIR, "cert.der"), "rb") as f:
+            certificates = [tls.TLSCertificate(data=x509.X509Cert(f.read()))]
+        wire = capture_session(certificates, "ping", "pong")
+        decryptor = tlscap.TLSFlowDecryptor(passive_ctx, metadata_only=True)
+        for index, frame in enumerate(to_frames(wire, ("10.0.0.1", 40000), ("10.0.1.1", 443))):
+            decryptor.process(index, None, tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(frame)))
+        session = next(iter(decryptor.reassembler.flows.values())).state
+        self.assertTrue(session.done)
+        # Application data is still counted
+        for endpoint, record_stream in session.record_streams.items():
+            from_client = endpoint == session.client
+            self.assertEqual(sum(len(data) for client, data in wire if client == from_client), record_stream.bytes)
+        self.assertEqual(5, session.record_streams[session.client].records)
+
+    def test_metadata_only_stops_after_fatal_alert(self):
+        decryptor = tlscap.TLSFlowDecryptor(metadata_only=True)
+        client, server = ("\x0a\x00\x00\x01", 40000), ("\x0a\x00\x00\x02", 443)
+        client_hello = str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+        alert = str(tls.TLSRecord() / tls.TLSAlert(level=tls.TLSAlertLevel.FATAL,
+                                                   description=tls.TLSAlertDescription.HANDSHAKE_FAILURE))
+        decryptor.process(0, None, tlscap.TCPSegment(client, server, 1, tlscap.TCP_ACK, client_hello))
+        self.assertEqual(1, len(decryptor.process(1, None, tlscap.TCPSegment(server, client, 1, tlscap.TCP_ACK,
+                                                                            alert))))
+        self.assertEqual([], decryptor.process(2, None, tlscap.TCPSegment(server, client, 1 + len(alert),
+                                                                          tlscap.TCP_ACK, alert)))
+        session = decryptor.reassembler.flows.values()[0].state
+        self.assertTrue(session.done)
+        self.assertEqual(2, session.record_streams[server].records)
+
+    def test_sharded_decryption_matches_serial_order(self):
+        serial = list(tlscap.decrypt_pcap(self.pcap, passive_ctx))
+        self.assertEqual(serial, list(tlscap.decrypt_pcap(self.pcap, passive_ctx, processes=3, batch_size=2)))
+
+    def test_pipeline_decrypts_each_connection_in_order(self):
+        with tlscap.PcapFileReader(self.pcap) as reader:
+            with tlscap.TLSCapturePipeline(reader, passive_ctx, processes=2, batch_size=4) as pipeline:
+                records = list(pipeline.records())
+            stats = pipeline.stats()
+        self.assertEqual(sorted(tlscap.decrypt_pcap(self.pcap, passive_ctx)), sorted(records))
+        for src in set(record.src for record in records):
+            indexes = [record.index for record in records if record.src == src]
+            self.assertEqual(sorted(indexes), indexes)
+        self.assertEqual((0, 0), (stats.dropped_batches, stats.backlog))
+        self.assertEqual(stats.frames, stats.segments)
+
+    def test_pipeline_drops_batches_instead_of_blocking(self):
+        def slow_ctx():
+            time.sleep(0.5)
+            return passive_ctx()
+        with tlscap.PcapFileReader(self.pcap) as reader:
+            with tlscap.TLSCapturePipeline(reader, slow_ctx, processes=1, batch_size=1, queue_size=1) as pipeline:
+                list(pipeline.records())
+            stats = pipeline.stats()
+        self.assertGreater(stats.dropped_batches, 0)
+        self.assertEqual(stats.segments, stats.batches + stats.dropped_segments)
+        self.assertEqual(0, stats.backlog)
+        # Each connection lost segments at least once
+        self.assertGreaterEqual(stats.dropped_flows, 4)
+
+    def test_pipeline_stop_closes_blocked_source(self):
+        class BlockedSource(object):
+            linktype = tlscap.DLT_EN10MB
+
+            def __init__(self):
+                self.closed = threading.Event()
+
+            def __iter__(self):
+                # Never idle, never any frame
+                self.closed.wait()
+                raise ValueError("closed")
+
+            def close(self):
+                self.closed.set()
+        source = BlockedSource()
+        pipeline = tlscap.TLSCapturePipeline(source, passive_ctx, processes=1)
+        pipeline.start()
+        started = time.time()
+        pipeline.stop(timeout=0.2)
+        self.assertLess(time.time() - started, 2)
+        self.assertTrue(source.closed.is_set())
+        self.assertFalse(pipeline._thread.is_alive())
+        self.assertEqual([], list(pipeline.records()))
+
+    def test_dropped_flows_are_reset_by_their_worker(self):
+        frames = [tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(frame)) for frame in rdpcap(self.pcap)]
+        segments = [segment for segment in frames if segment is not None]
+        key = tlscap.flow_key(segments[0])
+        flow_segments = [(index, None, segment) for index, segment in enumerate(segments)
+                         if tlscap.flow_key(segment) == key]
+        in_queue, out_queue = Queue.Queue(), Queue.Queue()
+        # The second segment of the connection was lost with its batch
+        in_queue.put(flow_segments[:1])
+        in_queue.put([(None, None, key)] + flow_segments[2:])
+        in_queue.put(None)
+        with warnings.catch_warnings(record=True):
+            tlscap._decrypt_worker(passive_ctx, False, in_queue, out_queue)
+        first, rest = out_queue.get(), out_queue.get()
+        self.assertEqual([index for index, _, _ in flow_segments[:1]], [index for index, _ in first])
+        self.assertEqual([index for index, _, _ in flow_segments[2:]], [index for index, _ in rest])
+        # Segments after the reset start no session
+        self.assertEqual([], [record for _, records in rest for record in records])
+
+    def test_reset_connection_does_not_wait_on_lost_segments(self):
+        segments = [segment for segment in (tlscap.parse_tcp_frame(tlscap.DLT_EN10MB, str(frame))
+                                            for frame in rdpcap(self.pcap)) if segment is not None]
+        key = tlscap.flow_key(segments[0])
+        flow_segments = [segment for segment in segments if tlscap.flow_key(segment) == key]
+        decryptor = tlscap.TLSFlowDecryptor(passive_ctx)
+        decryptor.process(0, None, flow_segments[0])
+        with warnings.catch_warnings(record=True):
+            self.assertTrue(decryptor.reset(key))
+        self.assertFalse(decryptor.reset(key))
+        self.assertEqual((1, 1), (decryptor.created, decryptor.released))
+        self.assertNotIn(key, decryptor.reassembler)
+        for segment in flow_segments[2:]:
+            self.assertEqual([], decryptor.process(0, None, segment))
+        if key in decryptor.reassembler:
+            streams = decryptor.reassembler.flows[key].streams.values()
+            self.assertEqual([{}, {}], [stream.pending for stream in streams])
+
+    def test_rsa_key_exchanges_are_decrypted_up_front(self):
+        with open(os.path.join(KEYS_DIR, "cert.der"), "rb") as f:
+            cert = f.read()
+        key_exchanges = tlscap.extract_encrypted_premaster_secrets(self.pcap)
+        self.assertEqual(4, len(key_exchanges))
+        self.assertEqual([cert] * 4, [key_exchange.certificate for key_exchange in key_exchanges])
+        serial = list(tlscap.decrypt_pcap(self.pcap, passive_ctx))
+        self.assertEqual(serial, list(tlscap.decrypt_pcap(self.pcap, rsa_key_store=KEY_STORE)))
+        self.assertEqual(serial, list(tlscap.decrypt_pcap(self.pcap, processes=2, rsa_key_store=KEY_STORE)))
+
+    def test_non_rsa_key_exchanges_are_skipped(self):
+        with open(os.path.join(KEYS_DIR, "cert.der"), "rb") as f:
+            cert = f.read()
+        client_key_exchange = str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientKeyExchange() /
+                                  tls.TLSClientRSAParams(data="e" * 256))
+        frames = []
+        for i, cipher_suite in enumerate((tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_CBC_SHA,
+                                          tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)):
+            wire = [(True, str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())),
+                    (False, str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello(cipher_suite=cipher_suite)) +
+                     str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSCertificateList(
+                         certificates=[tls.TLSCertificate(data=x509.X509Cert(cert))]))),
+                    (True, client_key_exchange)]
+            frames.extend(to_frames(wire, ("10.0.0.%d" % (i + 1), 40000), ("10.0.1.1", 443)))
+        wrpcap(self.pcap, frames)
+        self.assertEqual([tlscap.RSAKeyExchange(cert, "e" * 256)], tlscap.extract_encrypted_premaster_secrets(self.pcap))
+
+    def test_sessions_without_keys_stay_encrypted(self):
+        records = list(tlscap.decrypt_pcap(self.pcap))
+        self.assertTrue(all(record.encrypted for record in records
+                            if record.content_type == tls.TLSContentType.APPLICATION_DATA))
+        self.assertEqual(8, len(self._application_data(records)))
+
+
+
+class TestDecryptSharded(unittest.TestCase):
+
+    def test_quiet_flow_does_not_hold_back_results(self):
+        processes, batch_size, queue_size = 2, 4, 2
+        server = ("\x0a\x00\x01\x01", 443)
+        quiet, busy = [("\x0a\x00\x00\x01", port) for port in range(40000, 40002)]
+        self.assertNotEqual(hash(tlscap.flow_key(tlscap.TCPSegment(quiet, server, 0, 0, ""))) % processes,
+                            hash(tlscap.flow_key(tlscap.TCPSegment(busy, server, 0, 0, ""))) % processes)
+        client_hello = str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+        read = []
+
+        def segments():
+            # The quiet flow sends a single segment first, the busy one keeps going
+            yield 0, None, tlscap.TCPSegment(quiet, server, 1, tlscap.TCP_ACK, client_hello)
+            for index in range(1, 300):
+                read.append(index)
+                yield index, None, tlscap.TCPSegment(busy, server, 1 + (index - 1) * len(client_hello),
+                                                     tlscap.TCP_ACK, client_hello)
+        indexes = []
+        for record in tlscap._decrypt_sharded(segments(), None, processes, batch_size, queue_size, False):
+            indexes.append(record.index)
+            # Segments read ahead of the merge stay within what the queues hold
+            self.assertLessEqual(read[-1] - record.index, processes * queue_size * batch_size)
+        self.assertEqual(range(300), indexes)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,14 +1,23 @@
 #! -*- coding: utf-8 -*-
 
+import copy
+import datetime
+import gc
+import multiprocessing
 import os
 import binascii
+import struct
+import tempfile
+import threading
+import time
 import unittest
+import weakref
 import tinyec.ec as ec
 import tinyec.registry as reg
 import scapy_ssl_tls.ssl_tls as tls
 import scapy_ssl_tls.ssl_tls_crypto as tlsc
 
-from Crypto.Hash import HMAC, MD5, SHA, SHA256
+from Crypto.Hash import HMAC, MD5, SHA, SHA256, SHA384
 from Crypto.Cipher import AES, DES3, PKCS1_v1_5
 from Crypto.PublicKey import RSA
 
@@ -17,6 +26,9 @@ def env_local_file(file):
     return os.path.join(os.path.dirname(__file__), 'files', file)
 
 
+aead_supported = tlsc.CryptoAESGCM is not None or hasattr(AES, "MODE_GCM")
+
+
 class TestNullCiper(unittest.TestCase):
     def test_null_cipher_returns_cleartext_on_encrypt(self):
         null_cipher = tlsc.NullCipher.new(key="junk_key", iv="junk_iv")
@@ -212,6 +224,595 @@ xVgf/Neb/avXgIgi6drj8dp1fWA=
                          tls_ctx.crypto.session.premaster_secret)
 
 
+class TestECBackends(unittest.TestCase):
+    def setUp(self):
+        self.curve_name = "secp256r1"
+        self.curve = reg.get_curve(self.curve_name)
+        self.server_pub = ec.Point(
+            self.curve,
+            71312736565121892539464098105317518227531978702333415386264829982789952731614L,
+            108064706642599821618918248475955325719985341096102200103424860263181813987462L)
+        self.client_privkey = 15320484772785058360598040144348894600917526501829289880527760633524785596585L
+        self.pms = "'(\x17\x94l\xd7AO\x03\xd4Fi\x05}mP\x1aX5C7\xf0_\xa9\xb0\xac\xba{r\x1f\x12\x8f"
+        unittest.TestCase.setUp(self)
+
+    def test_unknown_backend_raises_error(self):
+        with self.assertRaises(ValueError):
+            tlsc.get_ec_backend("unknown")
+
+    def test_tinyec_backend_secret_matches_fixed_data(self):
+        backend = tlsc.get_ec_backend("tinyec")
+        self.assertEqual(self.pms, backend.get_secret(self.curve_name, self.client_privkey, self.server_pub))
+        keypair = backend.load_keypair(self.curve_name, self.client_privkey)
+        self.assertEqual(self.client_privkey * self.curve.g, keypair.pub)
+
+    @unittest.skipIf(tlsc.crypto_ec is None, "cryptography is not installed")
+    def test_cryptography_backend_matches_tinyec_backend(self):
+        backend = tlsc.get_ec_backend("cryptography")
+        self.assertEqual(self.pms, backend.get_secret(self.curve_name, self.client_privkey, self.server_pub))
+        keypair = backend.load_keypair(self.curve_name, self.client_privkey)
+        self.assertEqual(self.client_privkey * self.curve.g, keypair.pub)
+        keypair = backend.make_keypair(self.curve_name)
+        self.assertEqual(keypair.priv * self.curve.g, keypair.pub)
+
+    @unittest.skipIf(tlsc.crypto_ec is None, "cryptography is not installed")
+    def test_cryptography_backend_falls_back_to_tinyec_on_unsupported_curve(self):
+        backend = tlsc.get_ec_backend("cryptography")
+        self.assertNotIn("brainpoolP160r1", backend.curves)
+        keypair = backend.make_keypair("brainpoolP160r1")
+        self.assertEqual(keypair.curve, reg.get_curve("brainpoolP160r1"))
+
+    def test_secret_is_padded_to_field_length(self):
+        backend = tlsc.get_ec_backend("tinyec")
+        # Find a private key whose shared secret x coordinate has a leading zero byte
+        priv = 1
+        while (priv * self.server_pub).x >> 248:
+            priv += 1
+        secret = backend.get_secret(self.curve_name, priv, self.server_pub)
+        self.assertEqual(32, len(secret))
+        self.assertEqual("\x00", secret[0])
+
+    def test_uncompressed_point_encoding_round_trips(self):
+        encoded = tlsc.ec_point_to_str(self.server_pub)
+        self.assertEqual(65, len(encoded))
+        self.assertEqual(self.server_pub, tlsc.str_to_ec_point(encoded, self.curve))
+
+    def test_compressed_point_encoding_round_trips(self):
+        for curve_name in ("secp256r1", "secp224r1", "secp384r1"):
+            curve = reg.get_curve(curve_name)
+            for priv in (2, 3):
+                point = priv * curve.g
+                encoded = tlsc.ec_point_to_str(point, compressed=True)
+                self.assertIn(encoded[0], ("\x02", "\x03"))
+                self.assertEqual(point, tlsc.str_to_ec_point(encoded, curve))
+
+    def test_point_without_valid_prefix_raises_error(self):
+        with self.assertRaises(ValueError):
+            tlsc.str_to_ec_point("\x05" + tlsc.ec_point_to_str(self.server_pub)[1:], self.curve)
+
+
+class TestTLSKexKeyPool(unittest.TestCase):
+    def setUp(self):
+        self.p = int("da583c16d9852289d0e4af756f4cca92dd4be533b804fb0fed94ef9c8a4403ed574650d36999db29d7762"
+                     "76ba2d3d412e218f4dd1e084cf6d8003e7c4774e833", 16)
+        self.g = 2
+        unittest.TestCase.setUp(self)
+
+    def test_invalid_pool_size_raises_error(self):
+        with self.assertRaises(ValueError):
+            tlsc.TLSKexKeyPool(size=0)
+
+    def test_empty_pool_generates_keypair_synchronously(self):
+        pool = tlsc.TLSKexKeyPool(size=2)
+        a, y_c = pool.get_dh_keypair(self.p, self.g)
+        self.assertEqual(pow(self.g, a, self.p), y_c)
+        self.assertEqual(pool.misses, 1)
+        self.assertEqual(pool.hits, 0)
+
+    def test_filled_pool_hands_out_each_keypair_once(self):
+        pool = tlsc.TLSKexKeyPool(size=2)
+        pool.register_dh_group(self.p, self.g)
+        pool.register_curve("secp256r1")
+        pool.fill()
+        dh_keypairs = [pool.get_dh_keypair(self.p, self.g) for _ in range(2)]
+        self.assertNotEqual(dh_keypairs[0], dh_keypairs[1])
+        keypair = pool.get_ecdh_keypair("secp256r1")
+        self.assertEqual(keypair.curve, reg.get_curve("secp256r1"))
+        self.assertEqual(pool.hits, 3)
+        self.assertEqual(pool.misses, 0)
+
+    def test_least_recently_used_group_is_dropped(self):
+        pool = tlsc.TLSKexKeyPool(size=1, max_groups=2)
+        pool.register_curve("secp256r1")
+        pool.register_dh_group(self.p, self.g)
+        pool.get_ecdh_keypair("secp256r1")
+        pool.register_curve("secp384r1")
+        self.assertEqual([("ecdh", "secp256r1"), ("ecdh", "secp384r1")], list(pool._pools.keys()))
+        pool.fill()
+        self.assertEqual(2, len(pool._pools))
+
+    def test_counters_are_consistent_across_threads(self):
+        pool = tlsc.TLSKexKeyPool(size=40)
+        pool.register_dh_group(self.p, self.g)
+        pool.fill()
+        threads = [threading.Thread(target=lambda: [pool.get_dh_keypair(self.p, self.g) for _ in range(20)])
+                   for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual((40, 40), (pool.hits, pool.misses))
+
+    def test_unknown_curve_cannot_be_registered(self):
+        with self.assertRaises(ValueError):
+            tlsc.TLSKexKeyPool().register_curve("unknown_curve")
+
+    def test_background_thread_refills_pool(self):
+        pool = tlsc.TLSKexKeyPool(size=1).start()
+        try:
+            pool.get_ecdh_keypair("secp256r1")
+            for _ in range(100):
+                if pool._pools[("ecdh", "secp256r1")]:
+                    break
+                time.sleep(0.05)
+            pool.get_ecdh_keypair("secp256r1")
+            self.assertEqual(pool.hits, 1)
+        finally:
+            pool.stop()
+
+    def test_context_draws_client_ecdh_keys_from_pool(self):
+        pool = tlsc.TLSKexKeyPool(size=1)
+        pool.register_curve("secp256r1")
+        pool.fill()
+        pooled_keypair = pool._pools[("ecdh", "secp256r1")][0]
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.kex_pool = pool
+        tls_ctx.crypto.server.ecdh.curve_name = "secp256r1"
+        tls_ctx.crypto.server.ecdh.pub = ec.make_keypair(reg.get_curve("secp256r1")).pub
+        tls_ctx.get_client_ecdh_pubkey()
+        self.assertEqual(pooled_keypair.pub, tls_ctx.crypto.client.ecdh.pub)
+        self.assertEqual(pool.hits, 1)
+
+
+class TestTLSSessionCache(unittest.TestCase):
+
+    def _get_ctx(self, session_id="s" * 32, ticket=None):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello(session_id=session_id))
+        tls_ctx.crypto.session.master_secret = "m" * 48
+        tls_ctx.crypto.session.ticket = ticket
+        return tls_ctx
+
+    def test_session_is_found_by_session_id_and_ticket(self):
+        cache = tlsc.TLSSessionCache()
+        cache.store(self._get_ctx(ticket="t" * 16))
+        self.assertEqual(2, len(cache))
+        session = cache.lookup(session_id="s" * 32)
+        self.assertEqual("m" * 48, session.master_secret)
+        self.assertEqual(tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, session.cipher_suite)
+        self.assertEqual(session, cache.lookup(session_id="x", ticket="t" * 16))
+        self.assertIsNone(cache.lookup(session_id="x", ticket="y"))
+        self.assertEqual((2, 1), (cache.hits, cache.misses))
+
+    def test_sessions_without_master_secret_or_id_are_not_stored(self):
+        cache = tlsc.TLSSessionCache()
+        tls_ctx = self._get_ctx()
+        tls_ctx.crypto.session.master_secret = None
+        cache.store(tls_ctx)
+        cache.store(self._get_ctx(session_id=""))
+        self.assertEqual(0, len(cache))
+
+    def test_session_is_stored_once_both_finished_messages_are_seen(self):
+        cache = tlsc.TLSSessionCache()
+        tls_ctx = self._get_ctx()
+        tls_ctx.session_cache = cache
+        finished = tls.TLSRecord(content_type=tls.TLSContentType.HANDSHAKE) / tls.TLSCiphertext(data="f" * 32)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSChangeCipherSpec())
+        tls_ctx.insert(finished)
+        # Aborted before the peer's Finished
+        self.assertEqual(0, len(cache))
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSChangeCipherSpec())
+        tls_ctx.insert(finished)
+        self.assertEqual(1, len(cache))
+        self.assertEqual("m" * 48, cache.lookup("s" * 32, None).master_secret)
+
+    def test_expired_sessions_are_not_returned(self):
+        cache = tlsc.TLSSessionCache(lifetime=-1)
+        cache.store(self._get_ctx())
+        self.assertIsNone(cache.lookup(session_id="s" * 32))
+        self.assertEqual(1, cache.misses)
+
+    def test_copied_context_shares_cache(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.session_cache = tlsc.TLSSessionCache()
+        self.assertIs(tls_ctx.session_cache, copy.deepcopy(tls_ctx).session_cache)
+
+
+class TestTLSKeyLog(unittest.TestCase):
+
+    def setUp(self):
+        self.keylog_file = tempfile.NamedTemporaryFile(suffix=".keylog", delete=False)
+        self.keylog_file.write("# SSL/TLS secrets log file\n"
+                               "RSA 0011223344556677 %s\n"
+                               "CLIENT_RANDOM %s %s\n"
+                               "CLIENT_RANDOM %s %s\r\n" % ("aa" * 48, "01" * 32, "02" * 48, "03" * 32, "04" * 48))
+        self.keylog_file.close()
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        os.unlink(self.keylog_file.name)
+        unittest.TestCase.tearDown(self)
+
+    def _append(self, data):
+        with open(self.keylog_file.name, "ab") as f:
+            f.write(data)
+
+    def test_master_secret_is_found_by_client_random(self):
+        keylog = tlsc.TLSKeyLog(self.keylog_file.name)
+        self.assertEqual(2, len(keylog))
+        self.assertEqual("\x02" * 48, keylog.get_master_secret("\x01" * 32))
+        self.assertEqual("\x04" * 48, keylog.get_master_secret("\x03" * 32))
+        self.assertIsNone(keylog.get_master_secret("\x05" * 32))
+        keylog.close()
+        self.assertIsNone(keylog.get_master_secret("\x01" * 32))
+
+    def test_refresh_indexes_appended_lines(self):
+        keylog = tlsc.TLSKeyLog(self.keylog_file.name)
+        self._append("CLIENT_RANDOM %s %s" % ("05" * 32, "06" * 40))
+        keylog.refresh()
+        self.assertNotIn("\x05" * 32, keylog)
+        self._append("%s\nCLIENT_RANDOM %s %s\n" % ("06" * 8, "01" * 32, "07" * 48))
+        keylog.refresh()
+        self.assertEqual("\x06" * 48, keylog.get_master_secret("\x05" * 32))
+        self.assertEqual("\x07" * 48, keylog.get_master_secret("\x01" * 32))
+        self.assertEqual(3, len(keylog))
+
+    def test_refresh_rebuilds_index_of_truncated_file(self):
+        keylog = tlsc.TLSKeyLog(self.keylog_file.name)
+        with open(self.keylog_file.name, "wb") as f:
+            f.write("CLIENT_RANDOM %s %s\n" % ("05" * 32, "06" * 48))
+        keylog.refresh()
+        self.assertEqual(1, len(keylog))
+        self.assertIsNone(keylog.get_master_secret("\x01" * 32))
+        self.assertEqual("\x06" * 48, keylog.get_master_secret("\x05" * 32))
+        open(self.keylog_file.name, "wb").close()
+        keylog.refresh()
+        self.assertEqual(0, len(keylog))
+        self.assertIsNone(keylog.get_master_secret("\x05" * 32))
+
+    def test_refresh_rebuilds_index_of_rotated_file(self):
+        keylog = tlsc.TLSKeyLog(self.keylog_file.name)
+        # Same size as the indexed file, only the inode tells them apart
+        rotated = self.keylog_file.name + ".new"
+        with open(self.keylog_file.name, "rb") as f:
+            data = f.read()
+        with open(rotated, "wb") as f:
+            f.write(data.replace("02" * 48, "07" * 48).replace("03" * 32, "05" * 32))
+        os.rename(rotated, self.keylog_file.name)
+        keylog.refresh()
+        self.assertEqual(2, len(keylog))
+        self.assertEqual("\x07" * 48, keylog.get_master_secret("\x01" * 32))
+        self.assertEqual("\x04" * 48, keylog.get_master_secret("\x05" * 32))
+        self.assertNotIn("\x03" * 32, keylog)
+
+    def test_context_uses_logged_master_secret(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.keylog = tlsc.TLSKeyLog(self.keylog_file.name)
+        client_hello = tls.TLSClientHello(gmt_unix_time=0x01010101, random_bytes="\x01" * 28)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / client_hello)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello(
+            cipher_suite=tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_CBC_SHA))
+        self.assertEqual("\x02" * 48, tls_ctx.crypto.session.master_secret)
+        self.assertIsNotNone(tls_ctx.crypto.client.enc)
+
+
+def _write_keylog_lines(writer, seed, count):
+    for i in range(count):
+        writer.write(chr(seed) * 31 + chr(i), chr(seed) * 48)
+    writer.flush()
+
+
+class TestTLSKeyLogWriter(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mktemp(suffix=".keylog")
+        unittest.TestCase.setUp(self)
+
+    def tearDown(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        unittest.TestCase.tearDown(self)
+
+    def test_lines_are_written_in_batches(self):
+        writer = tlsc.TLSKeyLogWriter(self.path, batch_size=2, flush_interval=3600)
+        writer.write("\x01" * 32, "\x02" * 48)
+        self.assertFalse(os.path.exists(self.path))
+        writer.write("\x03" * 32, "\x04" * 48)
+        with open(self.path) as f:
+            self.assertEqual("CLIENT_RANDOM %s %s\n" % ("01" * 32, "02" * 48), f.readline())
+        writer.write("\x05" * 32, "\x06" * 48)
+        writer.flush()
+        self.assertEqual(3, writer.written)
+        keylog = tlsc.TLSKeyLog(self.path)
+        self.assertEqual("\x06" * 48, keylog.get_master_secret("\x05" * 32))
+
+    def test_pending_lines_are_flushed_by_timer(self):
+        writer = tlsc.TLSKeyLogWriter(self.path, batch_size=64, flush_interval=0.05)
+        writer.write("\x01" * 32, "\x02" * 48)
+        for _ in range(100):
+            if writer.written:
+                break
+            time.sleep(0.05)
+        self.assertEqual("\x02" * 48, tlsc.TLSKeyLog(self.path).get_master_secret("\x01" * 32))
+
+    def test_writer_is_not_kept_alive_for_exit_flush(self):
+        writer = tlsc.TLSKeyLogWriter(self.path)
+        self.assertIn(writer, tlsc._KEYLOG_WRITERS)
+        ref = weakref.ref(writer)
+        del writer
+        gc.collect()
+        self.assertIsNone(ref())
+
+    def test_processes_append_whole_lines(self):
+        writer = tlsc.TLSKeyLogWriter(self.path, batch_size=8)
+        processes = [multiprocessing.Process(target=_write_keylog_lines, args=(writer, seed, 50))
+                     for seed in range(1, 5)]
+        for process in processes:
+            process.start()
+        _write_keylog_lines(writer, 5, 50)
+        for process in processes:
+            process.join()
+        keylog = tlsc.TLSKeyLog(self.path)
+        self.assertEqual(250, len(keylog))
+        self.assertEqual("\x03" * 48, keylog.get_master_secret("\x03" * 31 + chr(49)))
+
+    def test_context_logs_master_secret_once(self):
+        writer = tlsc.TLSKeyLogWriter(self.path, batch_size=1)
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.keylog_writer = writer
+        keys = tlsc.derive_session_keys([tlsc.KeyDerivationInput(
+            tls.TLSVersion.TLS_1_0, tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, "a" * 32, "z" * 32,
+            premaster_secret="\x03\x01" + "p" * 46)])[0]
+        tls_ctx.load_session_keys(keys)
+        tls_ctx.load_session_keys(keys)
+        self.assertEqual(1, writer.written)
+        self.assertEqual(keys.master_secret, tlsc.TLSKeyLog(self.path).get_master_secret("a" * 32))
+
+
+class TestTLSRSAKeyStore(unittest.TestCase):
+
+    def setUp(self):
+        self.keys_dir = os.path.join(os.path.dirname(__file__), "integration", "keys")
+        with open(os.path.join(self.keys_dir, "cert.der"), "rb") as f:
+            self.cert = f.read()
+        with open(os.path.join(self.keys_dir, "key.pem")) as f:
+            self.priv_key = RSA.importKey(f.read())
+        unittest.TestCase.setUp(self)
+
+    def test_directory_keys_are_indexed_by_modulus(self):
+        key_store = tlsc.TLSRSAKeyStore()
+        # CA, client and server keys. Certificates are skipped
+        self.assertEqual(3, key_store.load_directory(self.keys_dir))
+        self.assertEqual(3, len(key_store))
+        pub_key = tlsc.x509_extract_pubkey_from_der(self.cert)
+        self.assertIn(pub_key, key_store)
+        priv_key, _ = key_store.get_keys(pub_key)
+        self.assertEqual(self.priv_key.d, priv_key.d)
+        self.assertIsNone(key_store.get_keys(RSA.construct((long(pub_key.n) + 2, pub_key.e))))
+
+    def test_public_keys_are_rejected(self):
+        key_store = tlsc.TLSRSAKeyStore()
+        with self.assertRaises(ValueError):
+            key_store.add_key(self.priv_key.publickey())
+        self.assertEqual(key_store.fingerprint(self.priv_key), key_store.add_key(self.priv_key.exportKey("DER")))
+
+    def test_context_picks_key_matching_certificate(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.rsa_key_store = tlsc.TLSRSAKeyStore()
+        tls_ctx.rsa_key_store.load_directory(self.keys_dir)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello())
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSCertificateList(
+            certificates=[tls.TLSCertificate(data=self.cert)]))
+        self.assertEqual(self.priv_key.d, tls_ctx.crypto.server.rsa.privkey.d)
+        encrypted_pms = PKCS1_v1_5.new(self.priv_key.publickey()).encrypt("\x03\x01" + "p" * 46)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientKeyExchange() /
+                       tls.TLSClientRSAParams(data=encrypted_pms))
+        self.assertEqual("\x03\x01" + "p" * 46, tls_ctx.crypto.session.premaster_secret)
+
+
+class TestRSAPMSDecryption(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), "integration", "keys", "key.pem")) as f:
+            self.priv_key = RSA.importKey(f.read())
+        self.pms = "\x03\x03" + "p" * 46
+        self.encrypted_pms = PKCS1_v1_5.new(self.priv_key.publickey()).encrypt(self.pms)
+        tlsc.RSA_PMS_CACHE.clear()
+        tlsc.RSA_PKCS1_CIPHERS.clear()
+        unittest.TestCase.setUp(self)
+
+    def test_decrypted_pms_is_cached(self):
+        self.assertEqual(self.pms, tlsc.rsa_decrypt_pms(self.priv_key, self.encrypted_pms))
+        self.assertEqual(self.pms, tlsc.rsa_decrypt_pms(self.priv_key, self.encrypted_pms))
+        self.assertEqual((1, 1), (tlsc.RSA_PMS_CACHE.hits, tlsc.RSA_PMS_CACHE.misses))
+        other_pms = "\x03\x03" + "q" * 46
+        self.assertEqual(other_pms, tlsc.rsa_decrypt_pms(
+            self.priv_key, PKCS1_v1_5.new(self.priv_key.publickey()).encrypt(other_pms)))
+        # One cipher object per key
+        self.assertEqual(1, len(tlsc.RSA_PKCS1_CIPHERS))
+        self.assertEqual(1, tlsc.RSA_PKCS1_CIPHERS.hits)
+
+    def test_failed_decryption_is_not_cached(self):
+        self.assertIsNone(tlsc.rsa_decrypt_pms(self.priv_key, "\x00" * len(self.encrypted_pms)))
+        self.assertEqual(0, len(tlsc.RSA_PMS_CACHE))
+
+    def test_retransmitted_client_key_exchange_is_decrypted_once(self):
+        client_key_exchange = tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientKeyExchange() / \
+            tls.TLSClientRSAParams(data=self.encrypted_pms)
+        for _ in range(2):
+            tls_ctx = tlsc.TLSSessionCtx()
+            tls_ctx.rsa_load_keys(self.priv_key.exportKey())
+            tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+            tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello())
+            tls_ctx.insert(client_key_exchange)
+            self.assertEqual(self.pms, tls_ctx.crypto.session.premaster_secret)
+        self.assertEqual(1, tlsc.RSA_PMS_CACHE.misses)
+        self.assertEqual(1, tlsc.RSA_PMS_CACHE.hits)
+
+    def test_bulk_decryption_seeds_contexts(self):
+        with open(os.path.join(os.path.dirname(__file__), "integration", "keys", "cert.der"), "rb") as f:
+            cert = f.read()
+        with open(os.path.join(os.path.dirname(__file__), "integration", "keys", "scapy-tls-client.crt.der"),
+                  "rb") as f:
+            other_cert = f.read()
+        pms = ["\x03\x03" + chr(i) * 46 for i in range(3)]
+        encrypted_pms = [PKCS1_v1_5.new(self.priv_key.publickey()).encrypt(p_) for p_ in pms]
+        key_exchanges = [(cert, encrypted) for encrypted in encrypted_pms]
+        key_store = tlsc.TLSRSAKeyStore()
+        key_store.add_key(self.priv_key)
+        # No key for the certificate, and a failed decryption
+        premaster_secrets = tlsc.decrypt_premaster_secrets(
+            key_store, key_exchanges + [(other_cert, "\x01" * 256), (cert, "\x00" * 256)], processes=2)
+        self.assertEqual(premaster_secrets, tlsc.decrypt_premaster_secrets(self.priv_key, key_exchanges))
+        self.assertEqual(dict(zip(encrypted_pms, pms)), premaster_secrets)
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.rsa_premaster_secrets = premaster_secrets
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello())
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientKeyExchange() /
+                       tls.TLSClientRSAParams(data=encrypted_pms[1]))
+        self.assertEqual(pms[1], tls_ctx.crypto.session.premaster_secret)
+
+
+class TestTLSCertificateStore(unittest.TestCase):
+
+    def setUp(self):
+        keys_dir = os.path.join(os.path.dirname(__file__), "integration", "keys")
+        with open(os.path.join(keys_dir, "cert.der"), "rb") as f:
+            self.cert = f.read()
+        with open(os.path.join(keys_dir, "scapy-tls-client.crt.der"), "rb") as f:
+            self.client_cert = f.read()
+        unittest.TestCase.setUp(self)
+
+    def _handshake(self, certificate_store):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.certificate_store = certificate_store
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello())
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello())
+        # Dissect from bytes as captured sessions would
+        tls_ctx.insert(tls.TLSRecord(str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSCertificateList(
+            certificates=[tls.TLSCertificate(data=self.cert), tls.TLSCertificate(data=self.client_cert)]))))
+        return tls_ctx
+
+    def test_sessions_share_certificates(self):
+        certificate_store = tlsc.TLSCertificateStore()
+        tls_ctx1 = self._handshake(certificate_store)
+        tls_ctx2 = self._handshake(certificate_store)
+        fingerprint = certificate_store.fingerprint(self.cert)
+        self.assertEqual([fingerprint, certificate_store.fingerprint(self.client_cert)],
+                         tls_ctx1.params.handshake.certificates)
+        self.assertEqual(2, len(certificate_store))
+        self.assertEqual(2, certificate_store.refcount(fingerprint))
+        self.assertEqual(self.cert, certificate_store.get_der(fingerprint))
+        certificates1 = tls_ctx1.packets.history[-1][tls.TLSCertificateList].certificates
+        certificates2 = tls_ctx2.packets.history[-1][tls.TLSCertificateList].certificates
+        self.assertIs(certificates1[0].data, certificates2[0].data)
+        self.assertIs(certificates1[1].data, certificates2[1].data)
+        self.assertIs(certificate_store.get_certificate(fingerprint), certificates2[0].data)
+        self.assertEqual(self.cert, str(certificates2[0].data))
+        self.assertEqual(tlsc.x509_extract_pubkey_from_der(self.cert).n, tls_ctx2.crypto.server.rsa.pubkey.n)
+
+    def _retained_ders(self, record):
+        layers = []
+        layer = record
+        while layer:
+            layers.append(layer)
+            layer = layer.payload
+        for certificate in record[tls.TLSCertificateList].certificates:
+            layers.extend([certificate, certificate.data])
+        return [raw for layer in layers for raw in (layer.original, layer.raw_packet_cache)
+                if raw is not None and self.cert in raw]
+
+    def test_records_retain_only_the_shared_der(self):
+        certificate_store = tlsc.TLSCertificateStore()
+        tls_ctx1 = self._handshake(certificate_store)
+        tls_ctx2 = self._handshake(certificate_store)
+        der = certificate_store.get_der(certificate_store.fingerprint(self.cert))
+        retained1 = self._retained_ders(tls_ctx1.packets.history[-1])
+        retained2 = self._retained_ders(tls_ctx2.packets.history[-1])
+        self.assertEqual(1, len(retained1))
+        self.assertIs(der, retained1[0])
+        self.assertEqual(1, len(retained2))
+        self.assertIs(retained1[0], retained2[0])
+        # Records still build to their original bytes
+        self.assertEqual(str(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSCertificateList(
+            certificates=[tls.TLSCertificate(data=self.cert), tls.TLSCertificate(data=self.client_cert)])),
+            str(tls_ctx2.packets.history[-1]))
+
+    def test_released_certificates_are_dropped(self):
+        certificate_store = tlsc.TLSCertificateStore()
+        tls_ctx1 = self._handshake(certificate_store)
+        tls_ctx2 = self._handshake(certificate_store)
+        fingerprint = certificate_store.fingerprint(self.cert)
+        tls_ctx1.release_certificates()
+        self.assertEqual([], tls_ctx1.params.handshake.certificates)
+        self.assertEqual(1, certificate_store.refcount(fingerprint))
+        tls_ctx2.release_certificates()
+        self.assertEqual(0, certificate_store.refcount(fingerprint))
+        self.assertNotIn(fingerprint, certificate_store)
+        self.assertIsNone(certificate_store.get_der(fingerprint))
+
+
+class TestX509Metadata(unittest.TestCase):
+
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(__file__), "integration", "keys", "cert.der"), "rb") as f:
+            self.rsa_cert = f.read()
+        with open(env_local_file("ec_san_cert.der"), "rb") as f:
+            self.ec_cert = f.read()
+        unittest.TestCase.setUp(self)
+
+    def test_rsa_certificate_metadata(self):
+        metadata = tlsc.x509_extract_metadata(self.rsa_cert)
+        self.assertEqual(SHA256.new(self.rsa_cert).digest(), metadata.fingerprint)
+        self.assertEqual(0xd1e1f53a9203251a, metadata.serial)
+        # Self signed
+        self.assertEqual(metadata.issuer, metadata.subject)
+        self.assertEqual(datetime.datetime(2015, 5, 22, 19, 16, 12), metadata.not_before)
+        self.assertEqual(datetime.datetime(2025, 5, 19, 19, 16, 12), metadata.not_after)
+        self.assertEqual(("RSA", 2048), (metadata.key_type, metadata.key_size))
+        self.assertEqual([], metadata.san)
+        self.assertEqual(tlsc.x509_extract_pubkey_from_der(self.rsa_cert).n, RSA.importKey(metadata.spki).n)
+
+    def test_ec_certificate_metadata(self):
+        metadata = tlsc.x509_extract_metadata(self.ec_cert)
+        self.assertEqual(0x1234, metadata.serial)
+        self.assertEqual(("EC", 256), (metadata.key_type, metadata.key_size))
+        self.assertIn("ec.scapy-ssl-tls.test", metadata.subject)
+        self.assertEqual(datetime.datetime(2036, 10, 16, 18, 34, 52), metadata.not_after)
+        self.assertEqual(["ec.scapy-ssl-tls.test", "*.scapy-ssl-tls.test", "192.0.2.1", "2001:db8::1"], metadata.san)
+
+    def test_malformed_certificate_raises(self):
+        with self.assertRaises(ValueError):
+            tlsc.x509_extract_metadata(self.rsa_cert[:100])
+        with self.assertRaises(ValueError):
+            tlsc.x509_extract_metadata("\x30\x04\x30\x02\x05\x00")
+
+    def test_oid_first_arcs_are_split_after_base128_decoding(self):
+        self.assertEqual("1.2.840.113549.1.1.11", tlsc._der_decode_oid("\x2a\x86\x48\x86\xf7\x0d\x01\x01\x0b"))
+        self.assertEqual("2.5.29.17", tlsc._der_decode_oid("\x55\x1d\x11"))
+        # Second arc >= 40 under arc 2, and a multi-byte first subidentifier
+        self.assertEqual("2.100.3", tlsc._der_decode_oid("\x81\x34\x03"))
+        self.assertEqual("2.999", tlsc._der_decode_oid("\x88\x37"))
+
+    def test_serial_is_decoded_as_signed_integer(self):
+        self.assertEqual(0xd1e1f53a9203251a, tlsc._der_decode_integer("\x00\xd1\xe1\xf5\x3a\x92\x03\x25\x1a"))
+        self.assertEqual(-1, tlsc._der_decode_integer("\xff"))
+        self.assertEqual(-0x7f00, tlsc._der_decode_integer("\x81\x00"))
+        self.assertEqual(0x7f, tlsc._der_decode_integer("\x7f"))
+
+
 class TestTLSSecurityParameters(unittest.TestCase):
 
     def setUp(self):
@@ -300,6 +901,157 @@ class TestTLSSecurityParameters(unittest.TestCase):
         self.assertTrue(tls_ctx.crypto.server.rsa.pubkey)
 
 
+class TestCryptoBackends(unittest.TestCase):
+
+    def setUp(self):
+        self.prf = tlsc.TLSPRF(tls.TLSVersion.TLS_1_0)
+        self.pre_master_secret = "\x03\x01aaaaaaaaaaaaaaaaaaaaaabbbbbbbbbbbbbbbbbbbbbbbb"
+        self.client_random = "a" * 32
+        self.server_random = "z" * 32
+        unittest.TestCase.setUp(self)
+
+    def _get_sec_params(self, cipher_suite, backend):
+        return tlsc.TLSSecurityParameters(self.prf, cipher_suite, self.pre_master_secret, self.client_random,
+                                          self.server_random, backend=backend)
+
+    def test_unknown_backend_raises_error(self):
+        with self.assertRaises(ValueError):
+            tlsc.get_crypto_backend("unknown")
+
+    def test_security_parameters_default_to_context_backend(self):
+        sec_params = self._get_sec_params(tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, None)
+        self.assertIs(sec_params.backend, tlsc.TLSSessionCtx.crypto_backend)
+
+    @unittest.skipIf(tlsc.CryptoCipher is None, "cryptography is not installed")
+    def test_cryptography_backend_interoperates_with_pycrypto_backend(self):
+        plaintext = "a" * 32
+        for cipher_suite in (tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA, tls.TLSCipherSuite.RSA_WITH_RC4_128_SHA,
+                             tls.TLSCipherSuite.RSA_WITH_3DES_EDE_CBC_SHA, tls.TLSCipherSuite.RSA_WITH_DES_CBC_SHA):
+            pycrypto_params = self._get_sec_params(cipher_suite, tlsc.get_crypto_backend("pycrypto"))
+            cryptography_params = self._get_sec_params(cipher_suite, tlsc.get_crypto_backend("cryptography"))
+            ciphertext = pycrypto_params.get_client_enc_cipher().encrypt(plaintext)
+            self.assertEqual(ciphertext, cryptography_params.get_client_enc_cipher().encrypt(plaintext))
+            self.assertEqual(plaintext, cryptography_params.get_client_dec_cipher().decrypt(ciphertext))
+            pycrypto_hmac = pycrypto_params.get_client_hmac().copy()
+            cryptography_hmac = cryptography_params.get_client_hmac().copy()
+            pycrypto_hmac.update(plaintext)
+            cryptography_hmac.update(plaintext)
+            self.assertEqual(pycrypto_hmac.digest(), cryptography_hmac.digest())
+
+    @unittest.skipIf(tlsc.CryptoCipher is None, "cryptography is not installed")
+    def test_cryptography_cipher_keeps_cbc_state_and_rejects_unaligned_data(self):
+        sec_params = self._get_sec_params(tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
+                                          tlsc.get_crypto_backend("cryptography"))
+        enc_cipher = sec_params.get_client_enc_cipher()
+        dec_cipher = sec_params.get_client_dec_cipher()
+        self.assertEqual(enc_cipher.mode, AES.MODE_CBC)
+        ciphertexts = [enc_cipher.encrypt("a" * 16), enc_cipher.encrypt("a" * 16)]
+        self.assertNotEqual(ciphertexts[0], ciphertexts[1])
+        self.assertEqual("a" * 32, dec_cipher.decrypt("".join(ciphertexts)))
+        with self.assertRaises(ValueError):
+            dec_cipher.decrypt("a" * 15)
+
+    def test_context_backend_is_used_for_record_protection(self):
+        backend = tlsc.get_crypto_backend("pycrypto")
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.crypto_backend = backend
+        pkt = tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientHello(random_bytes="a" * 28)
+        tls_ctx.insert(pkt)
+        pkt = tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello(random_bytes="z" * 28,
+                                                                      cipher_suite=tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA)
+        tls_ctx.insert(pkt)
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSClientKeyExchange() /
+                       tls.TLSClientRSAParams(data="x" * 128))
+        self.assertIs(tls_ctx.sec_params.backend, backend)
+
+    def test_fastest_backend_becomes_default(self):
+        default_backend = tlsc.TLSSessionCtx.crypto_backend
+        try:
+            backend = tlsc.select_fastest_crypto_backend(data_len=1024, rounds=2)
+            self.assertIn(backend.name, tlsc.CRYPTO_BACKENDS)
+            self.assertIs(tlsc.TLSSessionCtx.crypto_backend, backend)
+        finally:
+            tlsc.TLSSessionCtx.crypto_backend = default_backend
+
+
+@unittest.skipIf(not aead_supported, "AEAD requires pycryptodome or cryptography")
+class TestAEADCipher(unittest.TestCase):
+
+    def setUp(self):
+        self.prf = tlsc.TLSPRF(tls.TLSVersion.TLS_1_2)
+        self.pre_master_secret = "\x03\x03aaaaaaaaaaaaaaaaaaaaaabbbbbbbbbbbbbbbbbbbbbbbb"
+        self.client_random = "a" * 32
+        self.server_random = "z" * 32
+        self.version = tls.TLSVersion.TLS_1_2
+        self.content_type = tls.TLSContentType.APPLICATION_DATA
+        unittest.TestCase.setUp(self)
+
+    def test_gcm_record_matches_fixed_data(self):
+        cipher = tlsc.PyCryptoBackend().new_aead(tlsc.AESGCMCipher, "k" * 16, "salt")
+        ciphertext = cipher.encrypt("hello", self.content_type, self.version, seq_num=1)
+        self.assertEqual(binascii.unhexlify("000000000000000138c84fb14676399f497abebabfb8fc01e66d9dcb6e"), ciphertext)
+        self.assertEqual(2, cipher.seq_num)
+        cipher = tlsc.PyCryptoBackend().new_aead(tlsc.AESGCMCipher, "k" * 16, "salt")
+        self.assertEqual("hello", cipher.decrypt(ciphertext, self.content_type, self.version, seq_num=1))
+
+    @unittest.skipIf(tlsc.CryptoChaCha20Poly1305 is None and tlsc.ChaCha20_Poly1305 is None,
+                     "ChaCha20-Poly1305 requires pycryptodome or cryptography")
+    def test_chacha20_poly1305_record_matches_fixed_data(self):
+        cipher = tlsc.PyCryptoBackend().new_aead(tlsc.ChaCha20Poly1305Cipher, "k" * 32, "".join(chr(i) for i in range(12)))
+        ciphertext = cipher.encrypt("hello", self.content_type, self.version, seq_num=1)
+        self.assertEqual(binascii.unhexlify("cef1b62f339fe156b9b2ca98e52e980c3c730910ba"), ciphertext)
+
+    def test_decryption_tracks_sequence_number_and_authenticates_header(self):
+        enc_cipher = tlsc.PyCryptoBackend().new_aead(tlsc.AESGCMCipher, "k" * 16, "salt")
+        dec_cipher = tlsc.PyCryptoBackend().new_aead(tlsc.AESGCMCipher, "k" * 16, "salt")
+        for data in ("first", "second"):
+            ciphertext = enc_cipher.encrypt(data, self.content_type, self.version)
+            self.assertEqual(data, dec_cipher.decrypt(ciphertext, self.content_type, self.version))
+        ciphertext = enc_cipher.encrypt("third", self.content_type, self.version)
+        with self.assertRaises(ValueError):
+            dec_cipher.decrypt(ciphertext, tls.TLSContentType.HANDSHAKE, self.version)
+        with self.assertRaises(ValueError):
+            dec_cipher.decrypt(ciphertext[:10], self.content_type, self.version)
+
+    def test_aead_security_parameters_have_implicit_iv_and_no_mac(self):
+        sec_params = tlsc.TLSSecurityParameters(self.prf, tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_GCM_SHA256,
+                                                self.pre_master_secret, self.client_random, self.server_random,
+                                                explicit_iv=True)
+        self.assertTrue(sec_params.aead)
+        self.assertEqual(0, sec_params.mac_key_length)
+        self.assertEqual("", sec_params.client_write_MAC_key)
+        self.assertEqual(4, len(sec_params.client_write_IV))
+        self.assertNotEqual("\x00" * 4, sec_params.client_write_IV)
+        self.assertIsNone(sec_params.get_client_hmac())
+        ciphertext = sec_params.get_client_enc_cipher().encrypt("data", self.content_type, self.version)
+        self.assertEqual(8 + len("data") + 16, len(ciphertext))
+        self.assertEqual("data", sec_params.get_client_dec_cipher().decrypt(ciphertext, self.content_type,
+                                                                             self.version))
+
+    def test_sha384_cipher_suite_uses_sha384_prf(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello(
+            version=tls.TLSVersion.TLS_1_2, cipher_suite=tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_256_GCM_SHA384))
+        self.assertIs(SHA384, tls_ctx.crypto.session.prf.digest)
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.insert(tls.TLSRecord() / tls.TLSHandshake() / tls.TLSServerHello(
+            version=tls.TLSVersion.TLS_1_2, cipher_suite=tls.TLSCipherSuite.ECDHE_RSA_WITH_AES_128_GCM_SHA256))
+        self.assertIs(SHA256, tls_ctx.crypto.session.prf.digest)
+
+    def test_crypto_container_produces_aead_record(self):
+        tls_ctx = tlsc.TLSSessionCtx()
+        tls_ctx.params.negotiated.version = self.version
+        tls_ctx.sec_params = tlsc.TLSSecurityParameters(self.prf, tls.TLSCipherSuite.RSA_WITH_AES_128_GCM_SHA256,
+                                                        self.pre_master_secret, self.client_random,
+                                                        self.server_random)
+        tls_ctx._assign_crypto_material(tls_ctx.sec_params)
+        crypto_container = tlsc.CryptoContainer(tls_ctx, "data", self.content_type)
+        self.assertEqual("data", str(crypto_container))
+        ciphertext = crypto_container.encrypt()
+        self.assertEqual(struct.pack("!Q", 0), ciphertext[:8])
+        self.assertEqual("data", tls_ctx.crypto.client.dec.decrypt(ciphertext, self.content_type, self.version))
+
+
 class TestNullCompression(unittest.TestCase):
     def test_null_compression_returns_input_on_compress(self):
         null_compression = tlsc.NullCompression()
@@ -518,6 +1270,98 @@ class TestTLSPRF(unittest.TestCase):
         i += len(self.server_key)
         # No IVs for TLS1.2
 
+    def test_prf_cache_returns_cached_bytes(self):
+        self._initialize_tls1_known_params()
+        cache = tlsc.LRUCache(size=2)
+        prf = tlsc.TLSPRF(tls.TLSVersion.TLS_1_0, cache=cache)
+        seed = "%s%s" % (self.client_random, self.server_random)
+        for _ in range(2):
+            self.assertEqual(self.ms, prf.get_bytes(self.pms, tlsc.TLSPRF.TLS_MD_MASTER_SECRET_CONST, seed, 48))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        # Same inputs under another PRF must not be served from the cache
+        prf_1_2 = tlsc.TLSPRF(tls.TLSVersion.TLS_1_2, cache=cache)
+        self.assertNotEqual(self.ms, prf_1_2.get_bytes(self.pms, tlsc.TLSPRF.TLS_MD_MASTER_SECRET_CONST, seed, 48))
+        self.assertEqual(2, cache.misses)
+
+
+class TestBulkKeyDerivation(unittest.TestCase):
+
+    def setUp(self):
+        self.pre_master_secret = "\x03\x01aaaaaaaaaaaaaaaaaaaaaabbbbbbbbbbbbbbbbbbbbbbbb"
+        self.inputs = [tlsc.KeyDerivationInput(tls.TLSVersion.TLS_1_0, tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
+                                               chr(i) * 32, "z" * 32, premaster_secret=self.pre_master_secret)
+                       for i in range(4)]
+        unittest.TestCase.setUp(self)
+
+    def test_session_keys_match_security_parameters(self):
+        for keys, input_ in zip(tlsc.derive_session_keys(self.inputs), self.inputs):
+            sec_params = tlsc.TLSSecurityParameters(tlsc.TLSPRF(input_.tls_version), input_.cipher_suite,
+                                                    self.pre_master_secret, input_.client_random,
+                                                    input_.server_random)
+            self.assertEqual(sec_params.master_secret, keys.master_secret)
+            self.assertEqual(tlsc.TLSSecurityParameters.get_key_block_length(input_.cipher_suite), len(keys.key_block))
+            self.assertEqual(sec_params.client_write_key + sec_params.server_write_key,
+                             keys.key_block[40:72])
+
+    def test_master_secret_input_skips_premaster_secret(self):
+        keys = tlsc.derive_session_keys(self.inputs[:1])[0]
+        input_ = self.inputs[0]._replace(premaster_secret=None, master_secret=keys.master_secret)
+        self.assertEqual(keys, tlsc.derive_session_keys([input_])[0])
+        with self.assertRaises(ValueError):
+            tlsc.derive_session_keys([input_._replace(master_secret=None)])
+
+    def test_process_pool_returns_keys_in_input_order(self):
+        self.assertEqual(tlsc.derive_session_keys(self.inputs), tlsc.derive_session_keys(self.inputs, processes=2))
+
+    def test_loaded_session_keys_decrypt_records(self):
+        keys = tlsc.derive_session_keys(self.inputs[:1])[0]
+        client_ctx = tlsc.TLSSessionCtx()
+        client_ctx.load_session_keys(keys)
+        server_ctx = tlsc.TLSSessionCtx(client=False)
+        server_ctx.load_session_keys(keys)
+        self.assertEqual(keys.master_secret, server_ctx.crypto.session.master_secret)
+        record = tls.to_raw(tls.TLSPlaintext(data="data"), client_ctx)
+        decrypted = tls.SSL(str(record), ctx=server_ctx)
+        self.assertEqual("data", decrypted[tls.TLSPlaintext].data)
+
+
+class TestLRUCache(unittest.TestCase):
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = tlsc.LRUCache(size=2)
+        cache.put("a", 1)
+        cache.put("b", 2)
+        self.assertEqual(1, cache.get("a"))
+        cache.put("c", 3)
+        self.assertNotIn("b", cache)
+        self.assertEqual(2, len(cache))
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual((1, 1), (cache.hits, cache.misses))
+        cache.clear()
+        self.assertEqual((0, 0, 0), (len(cache), cache.hits, cache.misses))
+
+    def test_invalid_size_raises(self):
+        with self.assertRaises(ValueError):
+            tlsc.LRUCache(size=0)
+
+    def test_len_waits_for_lock(self):
+        cache = tlsc.LRUCache(size=2)
+        cache.put("a", 1)
+        lengths = []
+        with cache._lock:
+            thread = threading.Thread(target=lambda: lengths.append(len(cache)))
+            thread.start()
+            thread.join(0.1)
+            self.assertTrue(thread.is_alive())
+        thread.join()
+        self.assertEqual([1], lengths)
+
+    def test_str_xor(self):
+        self.assertEqual("\x00\x03\xff", tlsc.str_xor("\x01\x02\xf0", "\x01\x01\x0f"))
+        self.assertEqual("", tlsc.str_xor("", ""))
+        with self.assertRaises(ValueError):
+            tlsc.str_xor("a", "ab")
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,47 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Compare record protection throughput (encryption + HMAC) of the available symmetric crypto backends
+
+    #> python benchmark_crypto.py [record_size] [rounds]
+'''
+from __future__ import print_function
+import sys
+import os
+
+try:
+    # This import works from the project directory
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+    sys.path.append(basedir)
+    import scapy_ssl_tls.ssl_tls as tls
+    import scapy_ssl_tls.ssl_tls_crypto as tlsc
+except ImportError:
+    # If you installed this package via pip, you just need to execute this
+    import scapy.layers.ssl_tls as tls
+    import scapy.layers.ssl_tls_crypto as tlsc
+
+CIPHER_SUITES = [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA,
+                 tls.TLSCipherSuite.RSA_WITH_AES_256_CBC_SHA,
+                 tls.TLSCipherSuite.RSA_WITH_3DES_EDE_CBC_SHA,
+                 tls.TLSCipherSuite.RSA_WITH_RC4_128_SHA]
+
+
+def main(record_size=2**14, rounds=256):
+    backends = []
+    for name in tlsc.CRYPTO_BACKENDS:
+        try:
+            backends.append(tlsc.get_crypto_backend(name))
+        except ImportError:
+            print("%s backend is not available" % name)
+    print("%-36s %-14s %12s" % ("cipher suite", "backend", "MiB/s"))
+    for cipher_suite in CIPHER_SUITES:
+        for backend in backends:
+            throughput = tlsc.benchmark_crypto_backend(backend, cipher_suite, record_size, rounds)
+            print("%-36s %-14s %12.2f" % (tls.TLS_CIPHER_SUITES[cipher_suite], backend.name, throughput / 2**20))
+    print("Fastest backend: %s" % tlsc.select_fastest_crypto_backend(data_len=record_size, rounds=rounds).name)
+
+
+if __name__ == "__main__":
+    record_size = int(sys.argv[1]) if len(sys.argv) > 1 else 2**14
+    rounds = int(sys.argv[2]) if len(sys.argv) > 2 else 256
+    main(record_size, rounds)
@@ -0,0 +1,51 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Compare ECDHE client key exchange cost of the available elliptic curve backends
+
+    #> python benchmark_ec.py [iterations] [curve_name ...]
+
+Each iteration generates a client key pair and derives the shared secret, as done by
+TLSSessionCtx.get_client_ecdh_pubkey()
+'''
+from __future__ import print_function
+import sys
+import os
+import time
+
+try:
+    # This import works from the project directory
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+    sys.path.append(basedir)
+    import scapy_ssl_tls.ssl_tls_crypto as tlsc
+except ImportError:
+    # If you installed this package via pip, you just need to execute this
+    import scapy.layers.ssl_tls_crypto as tlsc
+
+CURVES = ["secp256r1", "secp384r1", "secp521r1"]
+
+
+def benchmark(backend, curve_name, iterations):
+    server_keypair = backend.make_keypair(curve_name)
+    start = time.time()
+    for _ in range(iterations):
+        client_keypair = backend.make_keypair(curve_name)
+        backend.get_secret(curve_name, client_keypair.priv, server_keypair.pub)
+    return (time.time() - start) / iterations
+
+
+def main(iterations=20, curves=CURVES):
+    backends = [tlsc.get_ec_backend("tinyec")]
+    if tlsc.crypto_ec is not None:
+        backends.append(tlsc.get_ec_backend("cryptography"))
+    else:
+        print("cryptography is not installed. Only benchmarking tinyec")
+    print("%-16s %-14s %12s" % ("curve", "backend", "ms/exchange"))
+    for curve_name in curves:
+        for backend in backends:
+            print("%-16s %-14s %12.3f" % (curve_name, backend.name, benchmark(backend, curve_name, iterations) * 1000))
+
+
+if __name__ == "__main__":
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    main(iterations, sys.argv[2:] or CURVES)
@@ -0,0 +1,67 @@
+#! /usr/bin/env python
+# -*- coding: UTF-8 -*-
+'''
+Compare full and abbreviated (resumed) handshake latency over the in-memory loopback transport
+
+    #> python benchmark_resumption.py [handshakes] [resumption_ratio]
+
+resumption_ratio is the share of handshakes offering a cached session ID, 0.8 by default
+'''
+from __future__ import print_function
+import sys
+import os
+import random
+import threading
+import time
+
+try:
+    # This import works from the project directory
+    basedir = os.path.abspath(os.path.join(os.path.dirname(__file__), "../"))
+    sys.path.append(basedir)
+    import scapy_ssl_tls.ssl_tls as tls
+    import scapy_ssl_tls.ssl_tls_crypto as tlsc
+except ImportError:
+    # If you installed this package via pip, you just need to execute this
+    import scapy.layers.ssl_tls as tls
+    import scapy.layers.ssl_tls_crypto as tlsc
+
+KEYS_DIR = os.path.join(basedir, "tests", "integration", "keys")
+
+
+def handshake(certificates, client_cache, server_cache, session_id=""):
+    client_ctx, server_ctx = tlsc.TLSSessionCtx(), tlsc.TLSSessionCtx(client=False)
+    client_ctx.session_cache, server_ctx.session_cache = client_cache, server_cache
+    client, server = tls.tls_socketpair(client_ctx, server_ctx)
+    server.tls_ctx.rsa_load_keys_from_file(os.path.join(KEYS_DIR, "key.pem"))
+    server_thread = threading.Thread(target=tls.tls_do_server_handshake, args=(server, certificates))
+    start = time.time()
+    server_thread.start()
+    tls.tls_do_handshake(client, tls.TLSVersion.TLS_1_2, [tls.TLSCipherSuite.RSA_WITH_AES_128_CBC_SHA],
+                         session_id=session_id)
+    server_thread.join()
+    return time.time() - start, client.tls_ctx
+
+
+def main(handshakes=50, resumption_ratio=0.8):
+    with open(os.path.join(KEYS_DIR, "cert.der"), "rb") as f:
+        certificates = [tls.TLSCertificate(data=f.read())]
+    client_cache, server_cache = tlsc.TLSSessionCache(), tlsc.TLSSessionCache()
+    timings = {True: [], False: []}
+    session_id = ""
+    for _ in range(handshakes):
+        offered = session_id if random.random() < resumption_ratio else ""
+        elapsed, tls_ctx = handshake(certificates, client_cache, server_cache, offered)
+        timings[tls_ctx.params.negotiated.resumed].append(elapsed)
+        session_id = tls_ctx.params.handshake.server.session_id
+    print("%-12s %8s %12s" % ("handshake", "count", "ms/handshake"))
+    for resumed, name in ((False, "full"), (True, "abbreviated")):
+        if timings[resumed]:
+            print("%-12s %8d %12.3f" % (name, len(timings[resumed]),
+                                        sum(timings[resumed]) / len(timings[resumed]) * 1000))
+    print(server_cache)
+
+
+if __name__ == "__main__":
+    handshakes = int(sys.argv[1]) if len(sys.argv) > 1 else 50
+    ratio = float(sys.argv[2]) if len(sys.argv) > 2 else 0.8
+    main(handshakes, ratio)